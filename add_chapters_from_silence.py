@@ -1,103 +1,159 @@
-import subprocess as sp
+from silence import ffmpeg_silences, numpy_silences, keep_silence, np
+from silence import PROGRESS_WIDTH, cache_paths, save_key
+from mp4edit import write_metadata
+from probe import get_duration
+from timing import span, start_trace
 import argparse
+import shutil
+import time
 import os
 
 
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Add chapters to an m4b audiobook from detecting silence"
-)
-parser.add_argument("-i", "--input", help="Input m4b file", required=True)
-parser.add_argument(
-    "--min",
-    help="Minimum silence duration in seconds",
-    type=float,
-    required=True,
-)
-parser.add_argument(
-    "--max",
-    help="Maximum silence duration in seconds",
-    type=float,
-    required=True,
-)
-parser.add_argument(
-    "--level",
-    help="Silence level in dB (Default: -30)",
-    type=float,
-    default=-30,
-)
-parser.add_argument(
-    "--overwrite",
-    help="Overwrite existing chapters",
-    default=False,
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Detect silence
-input_file = os.path.abspath(args.input)
-min_silence = args.min
-max_silence = args.max
-noise_level = args.level
-
-print(f"Detecting silence in '{os.path.basename(input_file)}'...", end=" ", flush=True)
-detection_cmd = f'ffmpeg -i "{input_file}" -af silencedetect=n={noise_level}dB:d={min_silence} -f null -'
-detection_output = sp.run(
-    detection_cmd, shell=True, check=True, capture_output=True, text=True
-).stderr
-print("Done")
-
-# Parse silence detection output
-silences = []
-for line in detection_output.splitlines():
-    if "silence_start" in line:
-        start_time = float(line.split()[-1])
-    elif "silence_end" in line:
-        end_time = float(line.split()[4])
-        duration = float(line.split()[7])
-
-        if duration <= max_silence + 0.25:
-            print(f"Silence at: {start_time:.2f} - {end_time:.2f} ({duration:.2f}s)")
-            silence = {"start": start_time, "end": end_time, "duration": duration}
-            silences.append(silence)
-
-# Create chapters file
-chapters_file = os.path.abspath(
-    os.path.join(os.path.dirname(input_file), "chapters.txt")
-)
-with open(chapters_file, "w") as f:
+# Finds silences that could be chapter breaks. Ctrl+C stops early and keeps the
+# silences found so far
+def detect_silences(
+    input_file: str,
+    min_silence: float,
+    max_silence: float,
+    noise_level: float = -30,
+    engine: str = "ffmpeg",
+    use_cache: bool = True,
+) -> list:
+    print(f"Detecting silence in '{os.path.basename(input_file)}'...")
+    print("Press Ctrl+C to stop early and keep the silences found so far")
+    total_duration = get_duration(input_file)
+
+    silences = []
+    if engine == "numpy":
+        detection = numpy_silences(
+            input_file, noise_level, min_silence, total_duration, use_cache
+        )
+    else:
+        detection = ffmpeg_silences(
+            input_file, noise_level, min_silence, total_duration
+        )
+    with span("detect_silences", file=input_file, engine=engine) as details:
+        started = time.perf_counter()
+        try:
+            for silence in detection:
+                if keep_silence(silence, min_silence, max_silence):
+                    print(
+                        f"\rSilence at: {silence['start']:.2f} - {silence['end']:.2f} "
+                        f"({silence['duration']:.2f}s)".ljust(PROGRESS_WIDTH)
+                    )
+                    silences.append(silence)
+            print("\nDone")
+
+            elapsed = time.perf_counter() - started
+            details["speed"] = total_duration / max(elapsed, 1e-6)
+        except KeyboardInterrupt:
+            detection.close()
+            details["stopped"] = True
+            print(f"\nDetection stopped, keeping {len(silences)} silences found so far")
+        details["silences"] = len(silences)
+
+    return silences
+
+
+# Gets chapters that end at each silence
+def silence_chapters(silences: list) -> list:
+    chapters = []
     current_start = 0
     for i, silence in enumerate(silences):
-        title = f"Chapter {i + 1}"
-        end_time = silence["end"]
-
-        f.write(
-            "[CHAPTER]\n"
-            "TIMEBASE=1/1000\n"
-            f"START={int(current_start * 1000)}\n"
-            f"END={int(end_time * 1000)}\n"
-            f"title={title}\n\n"
-        )
+        chapter = {
+            "title": f"Chapter {i + 1}",
+            "start": current_start,
+            "end": silence["end"],
+        }
+        chapters.append(chapter)
+
+        current_start = silence["end"]
+
+    return chapters
+
+
+# Adds chapters to an m4b file, working on a copy unless overwriting
+def add_chapters(input_file: str, chapters: list, overwrite: bool = False) -> str:
+    if overwrite:
+        output_file = input_file
+    else:
+        output_file = input_file.replace(".m4b", "_chapterized.m4b")
+        with span("copy", file=output_file):
+            shutil.copyfile(input_file, output_file)
+
+    write_metadata(output_file, chapters=chapters)
+    print(f"Chapters added to '{output_file}'")
+
+    # The audio is untouched, so cached levels still match the new file
+    if overwrite and os.path.exists(cache_paths(input_file)[1]):
+        save_key(input_file)
+
+    return output_file
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Add chapters to an m4b audiobook from detecting silence"
+    )
+    parser.add_argument("-i", "--input", help="Input m4b file", required=True)
+    parser.add_argument(
+        "--min",
+        help="Minimum silence duration in seconds",
+        type=float,
+        required=True,
+    )
+    parser.add_argument(
+        "--max",
+        help="Maximum silence duration in seconds",
+        type=float,
+        required=True,
+    )
+    parser.add_argument(
+        "--level",
+        help="Silence level in dB (Default: -30)",
+        type=float,
+        default=-30,
+    )
+    parser.add_argument(
+        "--engine",
+        help="Silence detection engine: ffmpeg's silencedetect filter, or a faster "
+        "NumPy scan of the frame levels (Default: ffmpeg)",
+        choices=["ffmpeg", "numpy"],
+        default="ffmpeg",
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Don't read or save the level cache used by the numpy engine",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Overwrite existing chapters",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.engine == "numpy" and np is None:
+        parser.error("--engine numpy requires NumPy (pip install numpy)")
+    if args.trace:
+        start_trace(args.trace)
+
+    # Detect silence and create chapters from it
+    input_file = os.path.abspath(args.input)
+    silences = detect_silences(
+        input_file, args.min, args.max, args.level, args.engine, not args.no_cache
+    )
+    add_chapters(input_file, silence_chapters(silences), args.overwrite)
+
 
-        current_start = end_time
-
-# Add chapters to m4b file
-m4b_temp = os.path.abspath(input_file.replace(".m4b", "_temp.m4b"))
-chapters_cmd = (
-    f'ffmpeg -i "{input_file}" -f ffmetadata -i "{chapters_file}" '
-    "-map 0:a -map_chapters 1 -map_metadata 1 "
-    "-c:a copy "
-    f'-y "{m4b_temp}"'
-)
-sp.run(chapters_cmd, shell=True, check=True)
-
-# Rename temp file to original if needed
-if args.overwrite:
-    os.replace(m4b_temp, input_file)
-    print(f"Chapters added to '{input_file}'")
-else:
-    os.replace(m4b_temp, input_file.replace(".m4b", "_chapterized.m4b"))
-
-# Cleanup
-os.remove(chapters_file)
+if __name__ == "__main__":
+    main()
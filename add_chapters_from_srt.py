@@ -1,95 +1,228 @@
-import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mp4edit import write_metadata
+from timing import span, start_trace
 import argparse
+import shutil
 import re
 import os
 
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Add chapters to an m4b audiobook from SRT file if chapters titles start with 'chapter'"
-)
-parser.add_argument("-i", "--input", default="", help="Input M4B file", required=True)
-parser.add_argument("-s", "--srt", default="", help="Input SRT file", required=True)
-parser.add_argument(
-    "-k",
-    "--keywords",
-    default="",
-    help="Keywords to search for in SRT file (comma separated)",
-    required=True,
-)
-parser.add_argument(
-    "--overwrite",
-    default=False,
-    help="Overwrite existing chapters",
-    action="store_true",
-)
-parser.add_argument(
-    "--keep",
-    default=False,
-    help="Keep SRT file after processing",
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Search for chapters in SRT file
-srt_file = os.path.abspath(args.srt)
-keywords = args.keywords.split(",")
-with open(srt_file, "r") as f:
-    chapters = []
-    chapter_num = 1
-    prev_line = ""
-    for i, line in enumerate(f):
-        if any(
-            re.search(rf"\b{keyword}\b", line, re.IGNORECASE) for keyword in keywords
-        ):
-            # Extract time from the previous line
-            time_match = re.search(r"(\d+):(\d+):(\d+),(\d+)", prev_line)
+# Cue start times, as hh:mm:ss,mmm in SRT files or [hh:]mm:ss.mmm in WebVTT files
+CUE_TIME = re.compile(r"(?:(\d+):)?(\d+):(\d+)[,.](\d+)\s*-->")
+
+# Subtitle files that can be used for chapters
+SUBTITLE_EXTENSIONS = (".srt", ".vtt")
+
+
+# Reads an SRT or WebVTT file one cue at a time, yielding the start time and
+# the text of each cue joined onto one line
+def iter_cues(f):
+    start_time = None
+    text = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            if start_time is not None:
+                yield start_time, " ".join(text)
+            start_time = None
+            text = []
+        elif start_time is None:
+            # Skip cue numbers, ids and WebVTT headers until the timing line
+            time_match = CUE_TIME.match(line)
             if time_match:
-                hh, mm, ss, ms = map(int, time_match.groups())
-                start_time = hh * 3600 + mm * 60 + ss + ms / 1000
+                hh, mm, ss, ms = time_match.groups()
+                start_time = int(hh or 0) * 3600 + int(mm) * 60 + int(ss)
+                start_time += int(ms) / 10 ** len(ms)
+        else:
+            text.append(line)
+
+    if start_time is not None:
+        yield start_time, " ".join(text)
+
 
+# Builds one regex that finds any of the keywords as a whole word
+def keyword_pattern(keywords):
+    keywords = [keyword.strip() for keyword in keywords if keyword.strip()]
+    alternation = "|".join(f"(?:{keyword})" for keyword in keywords)
+
+    return re.compile(rf"\b(?:{alternation})\b", re.IGNORECASE)
+
+
+# Gets a chapter for each subtitle containing one of the keywords
+def srt_chapters(srt_file: str, keywords: list) -> list:
+    pattern = keyword_pattern(keywords)
+    with open(srt_file, "r", encoding="utf-8-sig", errors="replace") as f:
+        chapters = []
+        for start_time, text in iter_cues(f):
+            if pattern.search(text):
                 chapter = {
-                    "title": f"Chapter {chapter_num}",
+                    "title": f"Chapter {len(chapters) + 1}",
                     "start": start_time,
-                    "line": line.strip(),
+                    "line": text,
                 }
                 chapters.append(chapter)
-                chapter_num += 1
-
-        prev_line = line
-
-# Create chapters file
-chapters_file = os.path.abspath(os.path.join(os.path.dirname(srt_file), "chapters.txt"))
-with open(chapters_file, "w") as f:
-    for chapter in chapters:
-        f.write(
-            "[CHAPTER]\n"
-            "TIMEBASE=1/1000\n"
-            f"START={int(chapter['start'] * 1000)}\n"
-            f"END={int((chapter['start']) * 1000)}\n"
-            f"title={chapter['title']}\n\n"
+
+    return chapters
+
+
+# Adds chapters to an m4b file, working on a copy unless overwriting
+def add_chapters(input_file: str, chapters: list, overwrite: bool = False) -> str:
+    if overwrite:
+        output_file = input_file
+    else:
+        output_file = input_file.replace(".m4b", "_chapterized.m4b")
+        with span("copy", file=output_file):
+            shutil.copyfile(input_file, output_file)
+
+    write_metadata(output_file, chapters=chapters)
+    print(f"Chapters added to '{output_file}'")
+
+    return output_file
+
+
+# Adds chapters to an m4b file from its subtitles, removing them unless kept
+def chapterize(
+    input_file: str,
+    srt_file: str,
+    keywords: list,
+    overwrite: bool = False,
+    keep: bool = False,
+) -> str:
+    # Search for chapters in SRT file
+    chapters = srt_chapters(srt_file, keywords)
+
+    # Add chapters to m4b file
+    output_file = add_chapters(input_file, chapters, overwrite)
+
+    # Cleanup
+    if not keep:
+        os.remove(srt_file)
+
+    return output_file
+
+
+# Finds m4b files under a folder with an SRT or WebVTT file of the same name
+def find_subtitled_books(folder: str) -> list:
+    books = []
+    for root, _, files in os.walk(folder):
+        for file in sorted(files):
+            name, extension = os.path.splitext(file)
+            if extension != ".m4b" or name.endswith("_chapterized"):
+                continue
+
+            for subtitle_extension in SUBTITLE_EXTENSIONS:
+                srt_file = os.path.join(root, name + subtitle_extension)
+                if os.path.exists(srt_file):
+                    books.append((os.path.join(root, file), srt_file))
+                    break
+
+    return books
+
+
+# Chapterizes many books at once, parsing their subtitles in separate processes
+def chapterize_books(
+    books: list,
+    keywords: list,
+    overwrite: bool = False,
+    keep: bool = False,
+    jobs: int = None,
+) -> list:
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                chapterize, input_file, srt_file, keywords, overwrite, keep
+            ): (input_file, srt_file)
+            for input_file, srt_file in books
+        }
+
+        for future in as_completed(futures):
+            input_file, srt_file = futures[future]
+            result = {"input": input_file, "srt": srt_file}
+            try:
+                result["output"] = future.result()
+            except Exception as e:
+                result["error"] = str(e)
+                print(f"Could not add chapters to '{input_file}': {e}")
+            results.append(result)
+
+    return results
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Add chapters to an m4b audiobook from SRT file if chapters titles start with 'chapter'"
+    )
+    parser.add_argument("-i", "--input", default="", help="Input M4B file")
+    parser.add_argument("-s", "--srt", default="", help="Input SRT or WebVTT file")
+    parser.add_argument(
+        "-k",
+        "--keywords",
+        default="",
+        help="Keywords to search for in the subtitles (comma separated)",
+        required=True,
+    )
+    parser.add_argument(
+        "--overwrite",
+        default=False,
+        help="Overwrite existing chapters",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep subtitle files after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch",
+        default="",
+        help="Folder to search for m4b files with an SRT or WebVTT file of the "
+        "same name, which are all chapterized at once",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count(),
+        help="Number of books to chapterize at once with --batch "
+        "(Default: number of cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+
+    keywords = args.keywords.split(",")
+
+    # Chapterize every subtitled book in a folder
+    if args.batch:
+        books = find_subtitled_books(args.batch)
+        print(f"Adding chapters to {len(books)} books...")
+        results = chapterize_books(
+            books, keywords, args.overwrite, args.keep, args.jobs
         )
 
-# Add chapters to m4b file
-input_file = os.path.abspath(args.input)
-m4b_temp = os.path.abspath(args.input.replace(".m4b", "_temp.m4b"))
-chapters_cmd = (
-    f'ffmpeg -i "{input_file}" -f ffmetadata -i "{chapters_file}" '
-    "-map 0:a -map_chapters 1 -map_metadata 1 "
-    "-c:a copy "
-    f'-y "{m4b_temp}"'
-)
-sp.run(chapters_cmd, shell=True, check=True)
-
-# Rename temp file to original if needed
-if args.overwrite:
-    os.replace(m4b_temp, input_file)
-    print(f"Chapters added to '{input_file}'")
-else:
-    os.replace(m4b_temp, input_file.replace(".m4b", "_chapterized.m4b"))
-    print(f"Chapters added to '{input_file.replace('.m4b', '_chapterized.m4b')}'")
-
-# Cleanup
-os.remove(chapters_file)
-if not args.keep:
-    os.remove(srt_file)
+        failed = sum("error" in result for result in results)
+        print(f"Added chapters to {len(results) - failed} of {len(results)} books")
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if not (args.input and args.srt):
+        parser.error("-i/--input and -s/--srt are required without --batch")
+
+    srt_file = os.path.abspath(args.srt)
+    chapterize(
+        os.path.abspath(args.input), srt_file, keywords, args.overwrite, args.keep
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
-from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlencode
-import subprocess as sp
+from response_cache import SEARCH_TTL, METADATA_TTL
+from http_client import get
+import http_client
+from mp4edit import write_metadata, read_tags
+from cover_cache import get_cover, image_extension
+from timing import span, start_trace
+from library_index import index_folder, list_audio
+import library_index
 import argparse
+import shutil
 import json
+import csv
 import re
 import os
 
@@ -22,7 +31,7 @@ def search_audible(title, author, narrator=None):
     url = f"https://api.audible.com/1.0/catalog/products?{urlencode(params)}"
     print(f"Audible Search URL: {url}")
 
-    response = json.loads(get(url))
+    response = json.loads(get(url, ttl=SEARCH_TTL))
     num_results = response["total_results"]
     if num_results == 0:
         print(f"No results found for '{title}' by '{author}' on Audible\n")
@@ -35,7 +44,7 @@ def search_audible(title, author, narrator=None):
     url = f"https://api.audnex.us/books/{asin}"
     print(f"Audible Metadata Fetch URL: {url}")
 
-    response = json.loads(get(url))
+    response = json.loads(get(url, ttl=METADATA_TTL))
     metadata = {
         "title": response["title"],
         "authors": ", ".join(a["name"] for a in response["authors"]),
@@ -61,8 +70,8 @@ def search_googlebooks(title, author):
     url = f"https://www.googleapis.com/books/v1/volumes?{urlencode(params)}"
     print(f"Google Books Search URL: {url}")
 
-    response = json.loads(get(url))
-    num_results = len(response["items"])
+    response = json.loads(get(url, ttl=SEARCH_TTL))
+    num_results = len(response.get("items", []))
     if num_results == 0:
         print(f"No results found for '{title}' by '{author}' on Google Books\n")
         return None
@@ -73,7 +82,7 @@ def search_googlebooks(title, author):
     url = response["items"][0]["selfLink"]
     print(f"Google Books Metadata Fetch URL: {url}")
 
-    response = json.loads(get(url))
+    response = json.loads(get(url, ttl=METADATA_TTL))
     vol_info = response["volumeInfo"]
     metadata = {
         "title": vol_info["title"]
@@ -89,105 +98,353 @@ def search_googlebooks(title, author):
     return metadata
 
 
-# Makes web requests
-def get(url: str):
-    req = Request(url, headers={"User-Agent": "Totally not a bot"})
-    return urlopen(req).read()
-
-
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Add metadata from OpenLibrary and Audible to an m4b file"
-)
-parser.add_argument("-i", "--input", default="", help="Input m4b file", required=True)
-parser.add_argument(
-    "-t", "--title", default="", help="Title of the audiobook", required=True
-)
-parser.add_argument(
-    "-a",
-    "--author",
-    default="",
-    help="Author of the audiobook (comma separated)",
-    required=True,
-)
-parser.add_argument(
-    "-n",
-    "--narrator",
-    default="",
-    help="Narrator(s) of the audiobook (comma separated)",
-)
-parser.add_argument(
-    "--override", default=False, help="Override existing metadata", action="store_true"
-)
-parser.add_argument(
-    "--keep",
-    default=False,
-    help="Keep cover file after processing",
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Get arguments
-input_file = args.input
-title = args.title
-author = args.author
-narrator = args.narrator or ""
-
-
-# Search for metadata and combine results
-audible_data = search_audible(title, author, narrator)
-google_data = search_googlebooks(title, author)
-
-metadata = {}
-for key in ["title", "authors", "narrators", "cover", "description", "year"]:
-    audible_value = audible_data.get(key) if audible_data else None
-    google_value = google_data.get(key) if google_data else None
-
-    if audible_value:
-        metadata[key] = audible_value
-    elif google_value:
-        metadata[key] = google_value
+# Runs a metadata search, treating a failed provider as having no results
+def search(provider, search_fn, *args):
+    try:
+        return search_fn(*args)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not get metadata from {provider}: {e}\n")
+        return None
+
+
+# Searches both providers at once and combines the results
+def lookup_metadata(
+    title: str, author: str, narrator: str = "", cover_size: int = None
+) -> dict:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audible_search = executor.submit(
+            search, "Audible", search_audible, title, author, narrator
+        )
+        google_search = executor.submit(
+            search, "Google Books", search_googlebooks, title, author
+        )
+        audible_data = audible_search.result()
+        google_data = google_search.result()
+
+    metadata = {}
+    for key in ["title", "authors", "narrators", "cover", "description", "year"]:
+        audible_value = audible_data.get(key) if audible_data else None
+        google_value = google_data.get(key) if google_data else None
+
+        if audible_value:
+            metadata[key] = audible_value
+        elif google_value:
+            metadata[key] = google_value
+        else:
+            metadata[key] = None
+            print(f"Could not find {key} for '{title}' by '{author}'\n")
+
+    # Download cover image
+    metadata["cover_data"] = None
+    if metadata["cover"]:
+        cover_url = metadata["cover"]
+        print(f"Getting cover image from {cover_url}...")
+        metadata["cover_data"] = get_cover(cover_url, cover_size)
+
+    return metadata
+
+
+# Gets the m4b tags for looked up metadata
+def metadata_tags(metadata: dict) -> dict:
+    return {
+        "title": metadata["title"],
+        "album": metadata["title"],
+        "artist": metadata["authors"],
+        "album_artist": metadata["authors"],
+        "composer": metadata["narrators"],
+        "comment": metadata["description"],
+        "date": metadata["year"],
+    }
+
+
+# Adds metadata to an m4b file, working on a copy unless overriding
+def apply_metadata(
+    input_file: str, metadata: dict, override: bool = False, keep: bool = False
+) -> str:
+    cover = metadata["cover_data"]
+    if cover and keep:
+        cover_file = os.path.join(
+            os.path.dirname(os.path.abspath(input_file)),
+            f"cover.{image_extension(cover)}",
+        )
+        with open(cover_file, "wb") as f:
+            f.write(cover)
+
+    tags = metadata_tags(metadata)
+    if override:
+        output_file = input_file
     else:
-        metadata[key] = None
-        print(f"Could not find {key} for '{title}' by '{author}'\n")
-
-# Download cover image
-if metadata["cover"]:
-    cover_url = metadata["cover"]
-    print(f"Downloading cover image from {cover_url}...")
-
-    cover_file = os.path.abspath(os.path.join(os.path.dirname(input_file), "cover.jpg"))
-    with open(cover_file, "wb") as f:
-        f.write(get(cover_url))
-
-# Add metadata to m4b temp file
-m4b_temp = os.path.abspath(input_file.replace(".m4b", "_temp.m4b"))
-metadata_cmd = (
-    f'ffmpeg -i "{input_file}" -i "{cover_file}" '
-    "-map 0:a -map 1:v "
-    f'-metadata title="{metadata["title"]}" '
-    f'-metadata album="{metadata["title"]}" '
-    f'-metadata artist="{metadata["authors"]}" '
-    f'-metadata album_artist="{metadata["authors"]}" '
-    f'-metadata composer="{metadata["narrators"]}" '
-    f'-metadata comment="{metadata["description"]}" '
-    f'-metadata date="{metadata["year"]}" '
-    "-c:v png -c:a copy "
-    "-disposition:v:0 attached_pic "
-    "-threads 0 "
-    f'-y "{m4b_temp}"'
-)
-sp.run(metadata_cmd, shell=True, check=True)
-
-# Rename temp file to original if needed
-if args.override:
-    os.replace(m4b_temp, input_file)
-    print(f"Metadata added to '{input_file}'")
-else:
-    os.replace(m4b_temp, input_file.replace(".m4b", "_new.m4b"))
-    print(f"Metadata added to '{input_file.replace('.m4b', '_new.m4b')}'")
-
-# Cleanup
-if not args.keep and metadata["cover"]:
-    os.remove(cover_file)
+        output_file = input_file.replace(".m4b", "_new.m4b")
+        with span("copy", file=output_file):
+            shutil.copyfile(input_file, output_file)
+
+    write_metadata(output_file, tags=tags, cover=cover)
+    print(f"Metadata added to '{output_file}'")
+
+    return output_file
+
+
+# Reads books to tag from a CSV or JSONL manifest of input, title, author, narrator
+def read_manifest(manifest_file: str) -> list:
+    folder = os.path.dirname(os.path.abspath(manifest_file))
+    with open(manifest_file, newline="", encoding="utf-8") as f:
+        if manifest_file.lower().endswith((".jsonl", ".json")):
+            books = [json.loads(line) for line in f if line.strip()]
+        else:
+            books = list(csv.DictReader(f))
+
+    for book in books:
+        book["input"] = os.path.join(folder, book["input"])
+        book["narrator"] = book.get("narrator") or ""
+
+    return books
+
+
+# Finds m4b files under a folder, taking title and author from their tags or
+# from an Author/Title/book.m4b folder layout. With the library index, tags are
+# only read from files that changed since the last scan
+def scan_library(root: str) -> list:
+    if library_index.enabled:
+        rows = index_folder(root, recursive=True)
+        found = {row["path"]: row["tags"] for row in rows}
+    else:
+        found = {path: None for path, _, _ in list_audio(root, recursive=True)}
+
+    books = []
+    for input_file in natural_sort(found):
+        tags = found[input_file]
+        file = os.path.basename(input_file)
+        folder = os.path.dirname(input_file)
+        if not file.endswith(".m4b") or file.endswith(("_new.m4b", "_temp.m4b")):
+            continue
+
+        if tags is None:
+            try:
+                tags = read_tags(input_file)
+            except (OSError, ValueError):
+                tags = {}
+
+        book = {
+            "input": input_file,
+            "title": tags.get("title") or os.path.splitext(file)[0],
+            "author": tags.get("artist") or os.path.basename(os.path.dirname(folder)),
+            "narrator": tags.get("composer") or "",
+        }
+        books.append(book)
+
+    return books
+
+
+# Looks up and tags many books, overlapping network lookups with disk writes
+def tag_library(
+    books: list,
+    override: bool = False,
+    keep: bool = False,
+    lookup_jobs: int = 8,
+    tag_jobs: int = 2,
+    cover_size: int = None,
+) -> list:
+    report = []
+
+    def record(book, status, output="", error=""):
+        row = {
+            "input": book["input"],
+            "title": book["title"],
+            "author": book["author"],
+            "status": status,
+            "output": output,
+            "error": error,
+        }
+        report.append(row)
+
+    with ThreadPoolExecutor(max_workers=lookup_jobs) as lookups, ThreadPoolExecutor(
+        max_workers=tag_jobs
+    ) as taggers:
+        lookup_futures = {
+            lookups.submit(
+                lookup_metadata,
+                book["title"],
+                book["author"],
+                book["narrator"],
+                cover_size,
+            ): book
+            for book in books
+        }
+
+        # Start tagging each book as soon as its lookup finishes
+        tag_futures = {}
+        for future in as_completed(lookup_futures):
+            book = lookup_futures[future]
+            try:
+                metadata = future.result()
+            except Exception as e:
+                record(book, "failed", error=f"Lookup failed: {e}")
+                continue
+
+            if not metadata["title"]:
+                record(book, "failed", error="No metadata found")
+                continue
+
+            tag_future = taggers.submit(
+                apply_metadata, book["input"], metadata, override, keep
+            )
+            tag_futures[tag_future] = book
+
+        for future in as_completed(tag_futures):
+            book = tag_futures[future]
+            try:
+                record(book, "tagged", output=future.result())
+            except Exception as e:
+                record(book, "failed", error=f"Tagging failed: {e}")
+
+    return report
+
+
+# Writes the per-book results of a batch run as CSV
+def write_report(report: list, report_file: str):
+    with open(report_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(
+            f, fieldnames=["input", "title", "author", "status", "output", "error"]
+        )
+        writer.writeheader()
+        writer.writerows(report)
+
+
+# Natural sort function
+def natural_sort(lst):
+    def sort_key(key):
+        return [int(c) if c.isdigit() else c.lower() for c in re.split(r"(\d+)", key)]
+
+    return sorted(lst, key=sort_key)
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Add metadata from OpenLibrary and Audible to an m4b file"
+    )
+    parser.add_argument("-i", "--input", default="", help="Input m4b file")
+    parser.add_argument("-t", "--title", default="", help="Title of the audiobook")
+    parser.add_argument(
+        "-a",
+        "--author",
+        default="",
+        help="Author of the audiobook (comma separated)",
+    )
+    parser.add_argument(
+        "-n",
+        "--narrator",
+        default="",
+        help="Narrator(s) of the audiobook (comma separated)",
+    )
+    parser.add_argument(
+        "--manifest",
+        default="",
+        help="CSV or JSONL file of books to tag, with input, title, author and "
+        "narrator columns",
+    )
+    parser.add_argument(
+        "--scan",
+        default="",
+        help="Folder to search for m4b files to tag, using their existing tags or "
+        "an Author/Title folder layout for the search",
+    )
+    parser.add_argument(
+        "--report",
+        default="tagging_report.csv",
+        help="Where to write the results of --manifest or --scan "
+        "(Default: tagging_report.csv)",
+    )
+    parser.add_argument(
+        "--lookup-jobs",
+        default=8,
+        help="Number of books to look up at once in batch mode (Default: 8)",
+        type=int,
+    )
+    parser.add_argument(
+        "--tag-jobs",
+        default=2,
+        help="Number of books to write at once in batch mode (Default: 2)",
+        type=int,
+    )
+    parser.add_argument(
+        "--override",
+        default=False,
+        help="Override existing metadata",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep cover file after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cover-size",
+        default=0,
+        help="Shrink covers so neither side is bigger than this many pixels, "
+        "instead of embedding the original image (Default: original)",
+        type=int,
+    )
+    parser.add_argument(
+        "--offline",
+        default=False,
+        help="Only use cached Audible and Google Books responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-index",
+        default=False,
+        help="Probe every file instead of using the library index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    library_index.enabled = library_index.enabled and not args.no_index
+    http_client.offline = http_client.offline or args.offline
+    if args.trace:
+        start_trace(args.trace)
+
+    # Tag a whole library in batch mode
+    if args.manifest or args.scan:
+        books = (
+            read_manifest(args.manifest) if args.manifest else scan_library(args.scan)
+        )
+        print(f"Tagging {len(books)} books...\n")
+
+        report = tag_library(
+            books,
+            args.override,
+            args.keep,
+            args.lookup_jobs,
+            args.tag_jobs,
+            args.cover_size,
+        )
+        write_report(report, args.report)
+
+        failed = sum(row["status"] == "failed" for row in report)
+        print(
+            f"Tagged {len(report) - failed} of {len(report)} books, see '{args.report}'"
+        )
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if not (args.input and args.title and args.author):
+        parser.error("-i/--input, -t/--title and -a/--author are required")
+
+    # Search for metadata and add it to the m4b file
+    metadata = lookup_metadata(
+        args.title, args.author, args.narrator or "", args.cover_size
+    )
+    apply_metadata(args.input, metadata, args.override, args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
+from transcode import AAC_ARGS
+import subprocess as sp
+import statistics
+import threading
+import platform
+import argparse
+import tempfile
+import shutil
+import json
+import re
+import time
+import sys
+import os
+
+# Synthetic books, with a silent gap at the end of every chapter. Durations
+# are in seconds and are multiplied by --scale
+GAP = 2.0
+MP3_ARGS = "-c:a libmp3lame -b:a 64k -ar 44100 "
+BOOKS = {
+    "small_mp3": {"files": 24, "chapter": 30, "source": "noise", "ext": "mp3"},
+    "small_m4a": {"files": 24, "chapter": 30, "source": "tone", "ext": "m4a"},
+    "large_mp3": {
+        "files": 1,
+        "chapter": 120,
+        "chapters": 10,
+        "source": "noise",
+        "ext": "mp3",
+    },
+    "large_m4b": {
+        "files": 1,
+        "chapter": 120,
+        "chapters": 10,
+        "source": "noise",
+        "ext": "m4b",
+    },
+}
+
+# What the metadata stub returns
+ASIN = "B0BENCHMRK"
+TITLE = "Benchmark Book"
+AUTHOR = "Bench Author"
+BOOK_PAGE = "https://goldenaudiobooks.com/benchmark-book/"
+TRACK_URL = "https://ipaudio.club/wp-content/uploads/BOOK/Benchmark%20Book/{:02d}.mp3"
+
+# Each pipeline runs a script on a fresh copy of a book, where {book} is the
+# copied folder and {run} is a scratch folder
+PIPELINES = [
+    {
+        "name": "files_mp3",
+        "book": "small_mp3",
+        "args": ["create_m4b_from_files.py", "-i", "{book}", "--keep"],
+    },
+    {
+        "name": "files_mp3_parallel",
+        "book": "small_mp3",
+        "args": ["create_m4b_from_files.py", "-i", "{book}", "--keep", "--parallel"],
+    },
+    {
+        "name": "files_m4a_copy",
+        "book": "small_m4a",
+        "args": ["create_m4b_from_files.py", "-i", "{book}", "--keep"],
+    },
+    {
+        "name": "cue",
+        "book": "large_mp3",
+        "args": ["create_m4b_from_cue.py", "-i", "{book}", "-c", "{book}/book.cue"]
+        + ["--keep"],
+    },
+    {
+        "name": "asin",
+        "book": "small_mp3",
+        "args": ["create_m4b_from_asin.py", "-i", "{book}", "--asin", ASIN, "--keep"],
+    },
+    {
+        "name": "silence_ffmpeg",
+        "book": "large_m4b",
+        "args": ["add_chapters_from_silence.py", "-i", "{book}/book.m4b"]
+        + ["--min", str(GAP - 0.5), "--max", str(GAP + 0.5)],
+    },
+    {
+        "name": "silence_numpy",
+        "book": "large_m4b",
+        "args": ["add_chapters_from_silence.py", "-i", "{book}/book.m4b"]
+        + ["--min", str(GAP - 0.5), "--max", str(GAP + 0.5)]
+        + ["--engine", "numpy", "--no-cache"],
+    },
+    {
+        "name": "srt",
+        "book": "large_m4b",
+        "args": ["add_chapters_from_srt.py", "-i", "{book}/book.m4b"]
+        + ["-s", "{book}/book.srt", "-k", "chapter", "--keep"],
+    },
+    {
+        "name": "metadata",
+        "book": "large_m4b",
+        "args": ["add_metadata_to_m4b.py", "-i", "{book}/book.m4b"]
+        + ["-t", TITLE, "-a", AUTHOR],
+    },
+    {
+        "name": "download",
+        "book": None,
+        "args": ["dl_golden_audio.py", "--url", BOOK_PAGE, "--output", "{run}/dl"],
+    },
+    {
+        "name": "download_build",
+        "book": None,
+        "args": ["dl_golden_audio.py", "--url", BOOK_PAGE, "--output", "{run}/dl"]
+        + ["--build"],
+    },
+]
+
+
+# Generates an audio file of tone or noise with a silent gap ending each chapter
+def generate_audio(out_file, duration, chapter, source, codec_args):
+    if source == "tone":
+        source = f"sine=frequency=220:duration={duration}:sample_rate=44100"
+    else:
+        source = f"anoisesrc=d={duration}:c=pink:a=0.2:r=44100"
+
+    gate = f"if(gte(mod(t,{chapter}),{chapter - GAP}),0,1)"
+    cmd = (
+        f'ffmpeg -v error -f lavfi -i "{source}" '
+        f"-af \"volume='{gate}':eval=frame\" -ac 2 "
+        f"{codec_args}"
+        f'-y "{out_file}"'
+    )
+    sp.run(cmd, shell=True, check=True)
+
+
+# Writes a CUE sheet with a track for each chapter
+def write_cue(cue_file, audio_name, chapters, chapter):
+    with open(cue_file, "w") as f:
+        f.write(f'FILE "{audio_name}" MP3\n')
+        for i in range(chapters):
+            mm, ss = divmod(int(i * chapter), 60)
+            f.write(
+                f"  TRACK {i + 1:02d} AUDIO\n"
+                f'    TITLE "Chapter {i + 1}"\n'
+                f"    INDEX 01 {mm:02d}:{ss:02d}:00\n"
+            )
+
+
+# Writes an SRT file with a subtitle every few seconds, and a 'Chapter'
+# subtitle at the start of each chapter
+def write_srt(srt_file, chapters, chapter, every=5):
+    def timestamp(seconds):
+        hh, rest = divmod(int(seconds * 1000), 3600000)
+        mm, rest = divmod(rest, 60000)
+        ss, ms = divmod(rest, 1000)
+        return f"{hh:02d}:{mm:02d}:{ss:02d},{ms:03d}"
+
+    with open(srt_file, "w") as f:
+        start = 0
+        index = 1
+        while start < chapters * chapter:
+            number = start // chapter + 1
+            text = f"Chapter {number}" if start % chapter == 0 else "Lorem ipsum"
+            f.write(
+                f"{index}\n{timestamp(start)} --> {timestamp(start + every)}\n"
+                f"{text}\n\n"
+            )
+            start += every
+            index += 1
+
+
+# Generates the synthetic books and a cover image
+def generate_books(books_dir, scale):
+    os.makedirs(books_dir, exist_ok=True)
+    for name, spec in BOOKS.items():
+        folder = os.path.join(books_dir, name)
+        if os.path.isdir(folder):
+            continue
+
+        print(f"Generating {name}...")
+        temp_folder = f"{folder}.part"
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        os.makedirs(temp_folder)
+
+        chapter = spec["chapter"] * scale
+        codec_args = MP3_ARGS if spec["ext"] == "mp3" else AAC_ARGS
+        if spec["files"] > 1:
+            for i in range(spec["files"]):
+                out_file = os.path.join(temp_folder, f"{i + 1:02d}.{spec['ext']}")
+                generate_audio(out_file, chapter, chapter, spec["source"], codec_args)
+        else:
+            # One long file, with a CUE sheet or SRT file marking its chapters
+            audio_name = f"book.{spec['ext']}"
+            duration = chapter * spec["chapters"]
+            out_file = os.path.join(temp_folder, audio_name)
+            generate_audio(out_file, duration, chapter, spec["source"], codec_args)
+
+            cue_file = os.path.join(temp_folder, "book.cue")
+            write_cue(cue_file, audio_name, spec["chapters"], chapter)
+            srt_file = os.path.join(temp_folder, "book.srt")
+            write_srt(srt_file, spec["chapters"], chapter)
+
+        os.replace(temp_folder, folder)
+
+    cover_file = os.path.join(books_dir, "cover.jpg")
+    if not os.path.exists(cover_file):
+        cmd = (
+            "ffmpeg -v error -f lavfi -i color=c=steelblue:s=500x500 "
+            f'-frames:v 1 -y "{cover_file}"'
+        )
+        sp.run(cmd, shell=True, check=True)
+
+
+# Gets the responses the stub serves, by host and path
+def stub_responses(books_dir, scale):
+    spec = BOOKS["small_mp3"]
+    chapter_ms = int(spec["chapter"] * scale * 1000)
+    tracks = sorted(os.listdir(os.path.join(books_dir, "small_mp3")))
+    book = {
+        "asin": ASIN,
+        "title": TITLE,
+        "authors": [{"name": AUTHOR}],
+        "narrators": [{"name": "Bench Narrator"}],
+        "image": "https://m.media-amazon.com/images/I/benchmark.jpg",
+        "description": "A synthetic book for benchmarks.",
+        "copyright": "2024",
+    }
+    chapters = {
+        "chapters": [
+            {
+                "title": f"Chapter {i + 1}",
+                "startOffsetMs": i * chapter_ms + 4000,
+                "lengthMs": chapter_ms,
+            }
+            for i in range(len(tracks))
+        ]
+    }
+    volume = {
+        "volumeInfo": {
+            "title": TITLE,
+            "authors": [AUTHOR],
+            "imageLinks": {"thumbnail": book["image"]},
+            "description": book["description"],
+            "publishedDate": "2024-01-01",
+        }
+    }
+    volumes = {
+        "items": [{"selfLink": "https://www.googleapis.com/books/v1/volumes/bench"}]
+    }
+    products = {"total_results": 1, "products": [{"asin": ASIN}]}
+    links = "".join(
+        f'<a href="{TRACK_URL.format(i + 1)}">Track {i + 1}</a>\n'
+        for i in range(len(tracks))
+    )
+
+    responses = {
+        "/api.audible.com/1.0/catalog/products": json.dumps(products).encode(),
+        f"/api.audnex.us/books/{ASIN}": json.dumps(book).encode(),
+        f"/api.audnex.us/books/{ASIN}/chapters": json.dumps(chapters).encode(),
+        "/www.googleapis.com/books/v1/volumes": json.dumps(volumes).encode(),
+        "/www.googleapis.com/books/v1/volumes/bench": json.dumps(volume).encode(),
+        "/" + BOOK_PAGE.split("://")[1]: f"<html>{links}</html>".encode(),
+    }
+
+    # Images and tracks are served from disk
+    responses[route_path(book["image"])] = os.path.join(books_dir, "cover.jpg")
+    for i, track in enumerate(tracks):
+        path = unquote(route_path(TRACK_URL.format(i + 1)))
+        responses[path] = os.path.join(books_dir, "small_mp3", track)
+
+    return responses
+
+
+# Gets the path a URL is requested at on the stub
+def route_path(url):
+    return "/" + url.split("://")[1]
+
+
+# Starts a local server answering like Audible, audnex, Google Books and the
+# audiobook download sites. Range and HEAD requests are answered like a file
+# server would, unless ranges is off and the whole body is always sent. With
+# drop_after every body is cut off after that many bytes, like a flaky connection
+def start_stub(responses, drop_after=None, ranges=True):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.respond(self.body())
+
+        def do_HEAD(self):
+            self.respond(self.body(), send_body=False)
+
+        def body(self):
+            response = responses.get(unquote(urlsplit(self.path).path))
+            if isinstance(response, str):
+                with open(response, "rb") as f:
+                    return f.read()
+            return response
+
+        def respond(self, body, send_body=True):
+            if body is None:
+                self.send_error(404)
+                return
+
+            # Only open ended ranges are sent by the download client
+            start = 0
+            match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if match and ranges:
+                start = int(match.group(1))
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(body)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body) - start))
+            self.end_headers()
+            if not send_body:
+                return
+
+            body = body[start:]
+            if drop_after is not None and len(body) > drop_after:
+                self.wfile.write(body[:drop_after])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# Reads the bytes a process read and wrote through any kind of file, including
+# what its waited-for children did, or Nones without /proc
+def process_io(pid):
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None, None
+
+    return int(fields["rchar"]), int(fields["wchar"])
+
+
+# Runs a command and measures its time, CPU, memory and I/O, including the
+# ffmpeg processes it starts
+def measure(cmd, env, log_file):
+    with open(log_file, "ab") as log:
+        started = time.perf_counter()
+        process = sp.Popen(cmd, env=env, stdout=log, stderr=sp.STDOUT)
+
+        # The I/O counters can only be read while the exited process is still
+        # a zombie, so wait for it without reaping it first
+        read_bytes = write_bytes = None
+        if hasattr(os, "waitid"):
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            read_bytes, write_bytes = process_io(process.pid)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # Linux reports peak RSS in KiB and block I/O in 512 byte blocks. Block I/O
+    # only counts what missed the page cache, so read_bytes and write_bytes
+    # count everything read and written, cached or not
+    return {
+        "returncode": process.returncode,
+        "wall": wall,
+        "cpu_user": usage.ru_utime,
+        "cpu_system": usage.ru_stime,
+        "peak_rss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+        "block_read_bytes": usage.ru_inblock * 512,
+        "block_write_bytes": usage.ru_oublock * 512,
+    }
+
+
+# Runs a pipeline on fresh copies of its book and records each run. Every run
+# gets an empty cache, so no run is sped up by what an earlier one cached
+def run_pipeline(pipeline, books_dir, work_dir, env, repeat):
+    runs = []
+    for i in range(repeat):
+        run_dir = os.path.join(work_dir, f"{pipeline['name']}_{i}")
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+
+        book_dir = os.path.join(run_dir, "book")
+        if pipeline["book"]:
+            shutil.copytree(os.path.join(books_dir, pipeline["book"]), book_dir)
+
+        script, *args = pipeline["args"]
+        args = [arg.format(book=book_dir, run=run_dir) for arg in args]
+        cmd = [sys.executable, os.path.join(os.path.dirname(__file__), script)]
+
+        log_file = os.path.join(work_dir, f"{pipeline['name']}.log")
+        run_env = {**env, "XDG_CACHE_HOME": os.path.join(run_dir, "cache")}
+        run = measure(cmd + args, run_env, log_file)
+        runs.append(run)
+        shutil.rmtree(run_dir)
+
+        if run["returncode"] != 0:
+            print(f"  {pipeline['name']} failed, see '{log_file}'")
+            break
+
+    return runs
+
+
+# Gets the median of each measurement over the successful runs
+def summarize(runs):
+    runs = [run for run in runs if run["returncode"] == 0]
+    if not runs:
+        return None
+
+    keys = [
+        "wall",
+        "cpu_user",
+        "cpu_system",
+        "peak_rss",
+        "read_bytes",
+        "write_bytes",
+        "block_read_bytes",
+        "block_write_bytes",
+    ]
+    values = {key: [run.get(key) for run in runs] for key in keys}
+    return {
+        key: None if None in values[key] else statistics.median(values[key])
+        for key in keys
+    }
+
+
+# Gets the version of the code being benchmarked
+def git_version():
+    cmd = ["git", "describe", "--always", "--dirty"]
+    folder = os.path.dirname(os.path.abspath(__file__))
+    result = sp.run(cmd, cwd=folder, capture_output=True, text=True)
+
+    return result.stdout.strip() or "unknown"
+
+
+# Runs the benchmarks and returns the results
+def run_benchmarks(
+    work_dir: str, scale: float = 1, repeat: int = 3, only: list = None
+) -> dict:
+    books_dir = os.path.join(work_dir, f"books_x{scale:g}")
+    generate_books(books_dir, scale)
+
+    server, stub_url = start_stub(stub_responses(books_dir, scale))
+    env = {
+        **os.environ,
+        "AUDIOBOOK_TOOLS_STUB_URL": stub_url,
+        "AUDIOBOOK_TOOLS_OFFLINE": "0",
+    }
+
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": scale,
+        "repeat": repeat,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pipelines": {},
+    }
+    try:
+        for pipeline in PIPELINES:
+            if only and pipeline["name"] not in only:
+                continue
+
+            print(f"Running {pipeline['name']}...")
+            runs = run_pipeline(pipeline, books_dir, work_dir, env, repeat)
+            summary = summarize(runs)
+            results["pipelines"][pipeline["name"]] = {
+                "runs": runs,
+                "median": summary,
+            }
+            if summary:
+                print(f"  {summary['wall']:.2f}s wall, {summary['cpu_user']:.2f}s CPU")
+    finally:
+        server.shutdown()
+
+    return results
+
+
+# Prints how each pipeline's median wall time changed since earlier results
+def compare(results, baseline):
+    print(f"\n{'Pipeline':<20} {baseline['version']:>12} {results['version']:>12}")
+    for name, result in results["pipelines"].items():
+        old = baseline["pipelines"].get(name, {}).get("median")
+        new = result["median"]
+        if not old or not new:
+            continue
+
+        change = (new["wall"] - old["wall"]) / old["wall"] * 100
+        print(
+            f"{name:<20} {old['wall']:>11.2f}s {new['wall']:>11.2f}s {change:>+7.1f}%"
+        )
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scripts on synthetic audiobooks against a local metadata stub"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="benchmark.json",
+        help="JSON file to save results to (Default: benchmark.json)",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "audiobooktools_benchmark"),
+        help="Folder for the generated books, which are reused between runs",
+    )
+    parser.add_argument(
+        "--scale",
+        default=1,
+        help="Multiplier for the length of the generated books (Default: 1)",
+        type=float,
+    )
+    parser.add_argument(
+        "--repeat",
+        default=3,
+        help="Number of times to run each pipeline (Default: 3)",
+        type=int,
+    )
+    parser.add_argument(
+        "--only",
+        default="",
+        help="Pipelines to run (comma separated, Default: all): "
+        + ", ".join(pipeline["name"] for pipeline in PIPELINES),
+    )
+    parser.add_argument(
+        "--compare",
+        default="",
+        help="Earlier results to compare against",
+    )
+
+    args = parser.parse_args()
+
+    only = [name for name in args.only.split(",") if name]
+    results = run_benchmarks(args.workdir, args.scale, args.repeat, only)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to '{args.output}'")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
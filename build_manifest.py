@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
+import shutil
+import json
+import time
+import os
+
+# Intermediate files are kept in a folder next to the inputs, with a manifest of
+# what each one was made from, so a re-run only redoes the steps whose inputs
+# changed and an interrupted build picks up after its last finished step
+BUILD_DIR = ".m4b_build"
+MANIFEST_FILE = "manifest.json"
+HASH_CHUNK = 1 << 20
+
+lock = threading.Lock()
+
+
+# Opens the build folder of a book, loading what earlier runs made
+def open_build(folder: str) -> dict:
+    build_dir = os.path.join(os.path.abspath(folder), BUILD_DIR)
+    os.makedirs(build_dir, exist_ok=True)
+
+    manifest = {"inputs": {}, "outputs": {}}
+    try:
+        with open(os.path.join(build_dir, MANIFEST_FILE), "r") as f:
+            manifest.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+    return {"dir": build_dir, "manifest": manifest, "used": set()}
+
+
+# Opens the build folder of a book for an incremental build, or to resume an
+# earlier one, or returns None so the book is built without hashing its inputs
+def resume_build(folder: str, incremental: bool = False) -> dict:
+    if incremental or os.path.isdir(os.path.join(os.path.abspath(folder), BUILD_DIR)):
+        return open_build(folder)
+
+    return None
+
+
+# Writes the manifest, replacing the old one only once it's complete
+def save_build(build):
+    manifest_file = os.path.join(build["dir"], MANIFEST_FILE)
+    with lock:
+        with open(f"{manifest_file}.part", "w") as f:
+            json.dump(build["manifest"], f, indent=2)
+        os.replace(f"{manifest_file}.part", manifest_file)
+
+
+# Gets the name a file is recorded under, relative to the book folder
+def manifest_name(build, path):
+    return os.path.relpath(os.path.abspath(path), os.path.dirname(build["dir"]))
+
+
+# Gets the content hash of an input, reusing the last one if the file's size
+# and modification time haven't changed
+def input_hash(build, path):
+    stat = os.stat(path)
+    name = manifest_name(build, path)
+    entry = build["manifest"]["inputs"].get(name)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["hash"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+
+    with lock:
+        build["manifest"]["inputs"][name] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": digest.hexdigest(),
+        }
+    return digest.hexdigest()
+
+
+# Hashes the inputs of a build in parallel and saves them to the manifest
+def hash_inputs(build: dict, files: list, jobs: int = None) -> list:
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        hashes = list(executor.map(input_hash, [build] * len(files), files))
+
+    save_build(build)
+    return hashes
+
+
+# Gets the key of an output from everything that goes into making it
+def output_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+# Gets where to put an intermediate file, named after its key
+def build_path(build: dict, key: str, ext: str) -> str:
+    path = os.path.join(build["dir"], f"{key[:32]}{ext}")
+    build["used"].add(os.path.basename(path))
+    return path
+
+
+# Checks if a file was made from the given key and hasn't changed since
+def is_current(build: dict, path: str, key: str) -> bool:
+    entry = build["manifest"]["outputs"].get(manifest_name(build, path))
+    return (
+        entry is not None
+        and entry["key"] == key
+        and os.path.exists(path)
+        and os.path.getsize(path) == entry["size"]
+    )
+
+
+# Gets the details recorded with a file when it was made
+def recorded(build: dict, path: str) -> dict:
+    return build["manifest"]["outputs"][manifest_name(build, path)]
+
+
+# Records that a file was made from the given key, with any other details
+def mark_current(build: dict, path: str, key: str, **details):
+    with lock:
+        build["manifest"]["outputs"][manifest_name(build, path)] = {
+            "key": key,
+            "size": os.path.getsize(path),
+            "made": time.time(),
+            **details,
+        }
+    save_build(build)
+
+
+# Removes the build folder, or for an incremental build, only the files this
+# run didn't use
+def finish_build(build: dict, incremental: bool = False):
+    if not incremental:
+        shutil.rmtree(build["dir"])
+        return
+
+    # A run that found the m4b up to date never looked at the intermediates
+    if not build["used"]:
+        save_build(build)
+        return
+
+    prefix = os.path.join(BUILD_DIR, "")
+    outputs = build["manifest"]["outputs"]
+    for name in list(outputs):
+        if name.startswith(prefix) and os.path.basename(name) not in build["used"]:
+            del outputs[name]
+
+    inputs = build["manifest"]["inputs"]
+    book_dir = os.path.dirname(build["dir"])
+    for name in list(inputs):
+        if not os.path.exists(os.path.join(book_dir, name)):
+            del inputs[name]
+
+    for name in os.listdir(build["dir"]):
+        if name != MANIFEST_FILE and name not in build["used"]:
+            os.remove(os.path.join(build["dir"], name))
+
+    save_build(build)
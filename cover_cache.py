@@ -0,0 +1,172 @@
+from response_cache import CACHE_DIR, METADATA_TTL
+from http_client import get
+from timing import run_ffmpeg
+import http_client
+import threading
+import tempfile
+import hashlib
+import sqlite3
+import struct
+import time
+import os
+
+# Covers are stored once per image content, named by their hash, so books in
+# a series that share artwork share a file
+COVER_DIR = os.path.join(CACHE_DIR, "covers")
+COVER_DB = os.path.join(COVER_DIR, "covers.sqlite")
+MAX_COVER_BYTES = 128 << 20
+
+# JPEG quality used when a cover has to be downscaled (2 is best, 31 is worst)
+JPEG_QUALITY = 2
+
+connection = None
+lock = threading.Lock()
+
+
+# Opens the cover index, creating it if needed
+def open_cache():
+    global connection
+    if connection is None:
+        os.makedirs(COVER_DIR, exist_ok=True)
+        connection = sqlite3.connect(
+            COVER_DB, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "url TEXT PRIMARY KEY, name TEXT NOT NULL, fetched REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+
+    return connection
+
+
+# Gets the file extension for JPEG or PNG image data
+def image_extension(data):
+    return "png" if data.startswith(b"\x89PNG") else "jpg"
+
+
+# Gets the width and height of JPEG or PNG image data, or None if unknown
+def image_size(data):
+    if data.startswith(b"\x89PNG") and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+
+    # Walk the JPEG markers to the start of frame, which holds the size
+    offset = 2
+    while offset + 9 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        length = struct.unpack(">H", data[offset + 2 : offset + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+            return width, height
+        offset += 2 + length
+
+    return None
+
+
+# Reads a cached file and marks it as recently used, or returns None
+def load_file(db, name):
+    try:
+        with open(os.path.join(COVER_DIR, name), "rb") as f:
+            data = f.read()
+    except OSError:
+        db.execute("DELETE FROM files WHERE name = ?", (name,))
+        return None
+
+    db.execute("UPDATE files SET accessed = ? WHERE name = ?", (time.time(), name))
+    return data
+
+
+# Saves a file to the cache, evicting the least recently used ones if over the cap
+def save_file(db, name, data):
+    path = os.path.join(COVER_DIR, name)
+    if not os.path.exists(path):
+        temp_file = f"{path}.part"
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, path)
+
+    db.execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (name, len(data), time.time())
+    )
+
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+    if total <= MAX_COVER_BYTES:
+        return
+
+    rows = db.execute("SELECT name, size FROM files ORDER BY accessed").fetchall()
+    for old_name, size in rows:
+        if old_name == name:
+            continue
+        db.execute("DELETE FROM files WHERE name = ?", (old_name,))
+        if os.path.exists(os.path.join(COVER_DIR, old_name)):
+            os.remove(os.path.join(COVER_DIR, old_name))
+        total -= size
+        if total <= MAX_COVER_BYTES:
+            break
+
+
+# Shrinks a cover so neither side is over max_size, keeping its aspect ratio
+def downscale(data, max_size):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        in_file = os.path.join(temp_dir, f"cover.{image_extension(data)}")
+        out_file = os.path.join(temp_dir, "small.jpg")
+        with open(in_file, "wb") as f:
+            f.write(data)
+
+        cmd = (
+            f'ffmpeg -v error -i "{in_file}" '
+            f"-vf scale={max_size}:{max_size}:force_original_aspect_ratio=decrease "
+            f'-q:v {JPEG_QUALITY} -y "{out_file}"'
+        )
+        run_ffmpeg(cmd, "downscale_cover", size=max_size)
+
+        with open(out_file, "rb") as f:
+            return f.read()
+
+
+# Gets a cover image, downloading it only if it isn't cached. The original
+# image is returned as-is unless it's bigger than max_size, in which case a
+# downscaled JPEG is made once and cached. When offline, a cached cover is
+# used however old it is, and None is returned if there isn't one
+def get_cover(url: str, max_size: int = None, ttl: float = METADATA_TTL) -> bytes:
+    with lock:
+        db = open_cache()
+        row = db.execute(
+            "SELECT name, fetched FROM urls WHERE url = ?", (url,)
+        ).fetchone()
+        data = None
+        if row and (http_client.offline or time.time() - row[1] <= ttl):
+            name = row[0]
+            data = load_file(db, name)
+
+    if data is None and http_client.offline:
+        print(f"Skipping the cover, {url} is not cached and offline mode is on")
+        return None
+    if data is None:
+        data = get(url)
+        name = f"{hashlib.sha256(data).hexdigest()}.{image_extension(data)}"
+        with lock:
+            db = open_cache()
+            save_file(db, name, data)
+            db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?)", (url, name, time.time())
+            )
+
+    size = image_size(data)
+    if not max_size or (size and max(size) <= max_size):
+        return data
+
+    # Downscaled covers are named after the original, so they are shared too
+    small_name = f"{name.rsplit('.', 1)[0]}_{max_size}.jpg"
+    with lock:
+        small = load_file(open_cache(), small_name)
+    if small is None:
+        small = downscale(data, max_size)
+        with lock:
+            save_file(open_cache(), small_name, small)
+
+    return small
@@ -1,124 +1,367 @@
-from urllib.request import urlopen, Request
-import subprocess as sp
+from transcode import plan_transcode, print_plan, prepare_inputs, AAC_ARGS
+from build_manifest import resume_build, hash_inputs, output_key
+from build_manifest import is_current, mark_current, finish_build
+from create_m4b_from_files import find_audio_files
+from add_metadata_to_m4b import read_manifest
+from timing import run_ffmpeg, span, start_trace
+from response_cache import METADATA_TTL
+from http_client import get
+from cover_cache import get_cover, image_extension
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import http_client
+import library_index
 import argparse
-import glob
+import tempfile
+import hashlib
+import shutil
 import json
 import os
-import re
-
-
-# Natural sort function
-def natural_sort(lst):
-    def sort_key(key):
-        return [int(c) if c.isdigit() else c.lower() for c in re.split(r"(\d+)", key)]
-
-    return sorted(lst, key=sort_key)
-
-
-# Makes web requests
-def get(url: str):
-    req = Request(url, headers={"User-Agent": "Totally not a bot"})
-    return urlopen(req).read()
-
-
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Convert audio files to an m4b audiobook and add chapters and cover using the Audible API"
-)
-parser.add_argument(
-    "-i", "--inputdir", default="", help="Input directory", required=True
-)
-parser.add_argument("--asin", default="", help="Audible book id", required=True)
-parser.add_argument(
-    "--intro",
-    default=False,
-    help="Does book have 'This is Audible' at start?",
-    action="store_true",
-)
-parser.add_argument(
-    "--keep",
-    default=False,
-    help="Keep mp3 files after processing",
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Converts audio files to m4b
-glob_path = os.path.abspath(args.inputdir)
-
-audio_files = glob.glob(f"{glob_path}/*.mp3")
-audio_files += glob.glob(f"{glob_path}/*.m4b")
-audio_files += glob.glob(f"{glob_path}/*.aac")
-audio_files += glob.glob(f"{glob_path}/*.m4a")
-audio_files += glob.glob(f"{glob_path}/*.wav")
-
-audio_files = natural_sort(audio_files)
-
-folder = os.path.dirname(audio_files[0])
-m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
-
-input_file = os.path.abspath(os.path.join(folder, "input.txt"))
-with open(input_file, "w") as f:
-    for audio_file in audio_files:
-        audio_file = audio_file.replace("'", "'\\''")
-        f.write(f"file '{os.path.abspath(audio_file)}'\n")
-
-# Get chapters from Audible API
-asin = args.asin
-url = f"https://api.audnex.us/books/{asin}/chapters"
-res = get(url).decode("utf-8")
-chapters = json.loads(res)["chapters"]
-
-# Get book cover from Audible API
-url = f"https://api.audnex.us/books/{asin}"
-res = get(url).decode("utf-8")
-cover_url = json.loads(res)["image"]
-
-cover_file = os.path.abspath(os.path.join(folder, "cover.jpg"))
-with open(cover_file, "wb") as f:
-    f.write(get(cover_url))
-
-# Add chapter buffer if intro not present
-buffer = 0 if args.intro else 4000
-
-# Convert chapters into metadata format
-chapters_file = os.path.abspath(os.path.join(folder, "chapters.txt"))
-with open(chapters_file, "w") as f:
-    for i, chapter in enumerate(chapters):
-        title = chapter["title"]
+
+
+# Gets the chapters of a book from the Audible API, in seconds. Without the
+# 'This is Audible' intro, every chapter starts 4 seconds earlier
+def get_audible_chapters(asin: str, intro: bool = False) -> list:
+    url = f"https://api.audnex.us/books/{asin}/chapters"
+    res = get(url, ttl=METADATA_TTL).decode("utf-8")
+
+    # Add chapter buffer if intro not present
+    buffer = 0 if intro else 4000
+
+    chapters = []
+    for chapter in json.loads(res)["chapters"]:
         start = chapter["startOffsetMs"] - buffer
-        end = start + chapter["lengthMs"]
-
-        f.write(
-            "[CHAPTER]\n"
-            "TIMEBASE=1/1000\n"
-            f"START={start}\n"
-            f"END={end}\n"
-            f"title={title}\n\n"
+        chapter = {
+            "title": chapter["title"],
+            "start": start / 1000,
+            "end": (start + chapter["lengthMs"]) / 1000,
+        }
+        chapters.append(chapter)
+
+    return chapters
+
+
+# Gets the cover image of a book from the Audible API, shrunk so neither side
+# is bigger than max_size if given, or None if it isn't cached when offline
+def get_audible_cover(asin: str, max_size: int = None) -> bytes:
+    url = f"https://api.audnex.us/books/{asin}"
+    res = get(url, ttl=METADATA_TTL).decode("utf-8")
+    cover_url = json.loads(res)["image"]
+
+    return get_cover(cover_url, max_size)
+
+
+# Gets everything a build needs from Audible: the chapters, and the cover from
+# the book's details
+def fetch_audible(asin: str, intro: bool = False, cover_size: int = None) -> dict:
+    with span("fetch_audible", asin=asin):
+        return {
+            "chapters": get_audible_chapters(asin, intro),
+            "cover": get_audible_cover(asin, cover_size),
+        }
+
+
+# Joins audio files into an m4b with chapters and a cover image, if there is one
+def write_m4b(concat_files, codec_args, chapters, cover, m4b_file, folder):
+    input_file = os.path.abspath(os.path.join(folder, "input.txt"))
+    with open(input_file, "w") as f:
+        for audio_file in concat_files:
+            audio_file = audio_file.replace("'", "'\\''")
+            f.write(f"file '{os.path.abspath(audio_file)}'\n")
+
+    cover_file = None
+    if cover:
+        cover_file = os.path.abspath(
+            os.path.join(folder, f"cover.{image_extension(cover)}")
+        )
+        with open(cover_file, "wb") as f:
+            f.write(cover)
+
+    # Convert chapters into metadata format
+    chapters_file = os.path.abspath(os.path.join(folder, "chapters.txt"))
+    with open(chapters_file, "w") as f:
+        for chapter in chapters:
+            f.write(
+                "[CHAPTER]\n"
+                "TIMEBASE=1/1000\n"
+                f"START={round(chapter['start'] * 1000)}\n"
+                f"END={round(chapter['end'] * 1000)}\n"
+                f"title={chapter['title']}\n\n"
+            )
+
+    # Embed the cover image as-is, marked as an attached picture
+    cover_input = cover_map = ""
+    if cover_file:
+        cover_input = f'-i "{cover_file}" '
+        cover_map = "-map 2:v -c:v copy -disposition:v:0 attached_pic "
+
+    # Combine audio, metadata, and cover into M4B file
+    cmd_combined = (
+        f'ffmpeg -f concat -safe 0 -i "{input_file}" '  # Concatenate audio files
+        f'-f ffmetadata -i "{chapters_file}" '  # Metadata file for chapters
+        f"{cover_input}"  # Cover image, if there is one
+        "-map 0:a -map_chapters 1 -map_metadata 1 "  # Use audio stream, chapters, and metadata
+        f"{cover_map}"  # Use the cover image as video stream
+        f"{codec_args}"  # Audio encoding settings
+        "-threads 0 "  # Use all available threads
+        "-movflags +faststart "  # Optimize for streaming
+        f'-y "{m4b_file}"'  # Output file
+    )
+    run_ffmpeg(cmd_combined, "concat", file=m4b_file, inputs=len(concat_files))
+
+    os.remove(chapters_file)
+    if cover_file:
+        os.remove(cover_file)
+    os.remove(input_file)
+
+
+# Converts the audio files in a folder to an m4b with chapters and cover from
+# Audible, or from what fetch_audible already got for it. Files or segments are
+# encoded on jobs workers if given, and kept in the build folder with
+# incremental so a re-run only encodes what changed
+def create_m4b(
+    input_dir: str,
+    asin: str,
+    intro: bool = False,
+    keep: bool = False,
+    cover_size: int = None,
+    jobs: int = None,
+    audible: dict = None,
+    incremental: bool = False,
+) -> dict:
+    audio_files = find_audio_files(os.path.abspath(input_dir))
+
+    folder = os.path.dirname(audio_files[0])
+    m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
+
+    # Skip the m4b an earlier run made, so the book can be rebuilt
+    audio_files = [f for f in audio_files if os.path.abspath(f) != m4b_file]
+
+    # Decide which files can be copied and encode the rest if needed
+    plan = plan_transcode(audio_files)
+    print_plan(plan)
+
+    # Get chapters and book cover from Audible API
+    audible = audible or fetch_audible(asin, intro, cover_size)
+    chapters = audible["chapters"]
+    cover = audible["cover"]
+
+    # Only an incremental build, or a resumed one, needs its inputs hashed
+    build = resume_build(folder, incremental)
+    if build:
+        work_dir = build["dir"]
+        hashes = hash_inputs(build, audio_files)
+        cover_hash = hashlib.sha256(cover).hexdigest() if cover else None
+        m4b_key = output_key("asin", hashes, chapters, cover_hash, AAC_ARGS)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="encode_", dir=folder)
+
+    # Encode and join the audio, unless the last build made the m4b from the
+    # same files, chapters and cover. A single input is encoded in segments cut
+    # at the chapters, so an interrupted encode resumes from the last one
+    if build and is_current(build, m4b_file, m4b_key):
+        print(f"{os.path.basename(m4b_file)} is up to date")
+    else:
+        starts = [chapter["start"] for chapter in chapters]
+        concat_files, codec_args = prepare_inputs(plan, work_dir, jobs, build, starts)
+        write_m4b(concat_files, codec_args, chapters, cover, m4b_file, folder)
+        if build:
+            mark_current(build, m4b_file, m4b_key, chapters=chapters)
+
+    # Cleanup
+    if build:
+        finish_build(build, incremental)
+    else:
+        shutil.rmtree(work_dir)
+
+    if not keep:
+        for audio_file in audio_files:
+            os.remove(audio_file)
+
+    return {"file": m4b_file, "chapters": chapters, "plan": plan}
+
+
+# Builds one queued book once its Audible data has been fetched, returning its
+# result or error instead of raising
+def build_queued(book, fetched, keep, cover_size, jobs, incremental=False):
+    result = {"input": book["input"], "asin": book["asin"]}
+    try:
+        audible = fetched.result()
+    except Exception as e:
+        result["error"] = f"Fetching from Audible failed: {e}"
+        print(result["error"])
+        return result
+
+    try:
+        m4b = create_m4b(
+            book["input"],
+            book["asin"],
+            book["intro"],
+            keep,
+            cover_size,
+            jobs,
+            audible,
+            incremental,
         )
+        result["output"] = m4b["file"]
+    except Exception as e:
+        result["error"] = f"Build failed: {e}"
+        print(result["error"])
+
+    return result
+
+
+# Builds many books in order, fetching the chapters and covers of the books
+# still queued on fetch_jobs workers while the current one encodes on jobs
+# workers, so neither the network nor the CPU waits for the other
+def create_m4bs(
+    books: list,
+    keep: bool = False,
+    cover_size: int = None,
+    jobs: int = None,
+    fetch_jobs: int = 4,
+    incremental: bool = False,
+) -> list:
+    results = []
+    with ThreadPoolExecutor(max_workers=fetch_jobs) as fetches:
+        queued = deque(
+            fetches.submit(fetch_audible, book["asin"], book["intro"], cover_size)
+            for book in books
+        )
+
+        # Each fetch is taken off the queue as its book is built, so its cover
+        # is freed as soon as the book is done
+        for i, book in enumerate(books):
+            print(f"[{i + 1}/{len(books)}] {book['input']} ({book['asin']})")
+            result = build_queued(
+                book, queued.popleft(), keep, cover_size, jobs, incremental
+            )
+            results.append(result)
+
+    return results
+
+
+# Reads books to build from a CSV or JSONL manifest of input, asin and intro
+def read_books(manifest_file: str) -> list:
+    books = read_manifest(manifest_file)
+    for book in books:
+        book["intro"] = str(book.get("intro", "")).lower() in ("1", "true", "yes")
+
+    return books
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Convert audio files to an m4b audiobook and add chapters and cover using the Audible API"
+    )
+    parser.add_argument("-i", "--inputdir", default="", help="Input directory")
+    parser.add_argument("--asin", default="", help="Audible book id")
+    parser.add_argument(
+        "--manifest",
+        default="",
+        help="CSV or JSONL file of books to build one after another, with input, "
+        "asin and optionally intro columns",
+    )
+    parser.add_argument(
+        "--intro",
+        default=False,
+        help="Does book have 'This is Audible' at start?",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep mp3 files after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        help="Keep the encoded audio in a build folder next to the input files, so "
+        "a re-run only encodes what changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cover-size",
+        default=0,
+        help="Shrink the cover so neither side is bigger than this many pixels, "
+        "instead of embedding the original image (Default: original)",
+        type=int,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        help="Number of files or segments to encode at once "
+        "(Default: number of cores with --manifest, else 1)",
+        type=int,
+    )
+    parser.add_argument(
+        "--fetch-jobs",
+        default=4,
+        help="Number of books to fetch chapters and covers for at once with "
+        "--manifest (Default: 4)",
+        type=int,
+    )
+    parser.add_argument(
+        "--offline",
+        default=False,
+        help="Only use cached Audible responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-index",
+        default=False,
+        help="Probe every file instead of using the library index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    library_index.enabled = library_index.enabled and not args.no_index
+    if args.trace:
+        start_trace(args.trace)
+    http_client.offline = http_client.offline or args.offline
+
+    # Build every book in a manifest
+    if args.manifest:
+        books = read_books(args.manifest)
+        print(f"Building {len(books)} books...")
+        results = create_m4bs(
+            books,
+            args.keep,
+            args.cover_size,
+            args.jobs or os.cpu_count(),
+            args.fetch_jobs,
+            args.incremental,
+        )
+
+        failed = sum("error" in result for result in results)
+        print(f"Built {len(results) - failed} of {len(results)} books")
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if not (args.inputdir and args.asin):
+        parser.error("-i/--inputdir and --asin are required without --manifest")
+
+    # Converts audio files to m4b
+    create_m4b(
+        args.inputdir,
+        args.asin,
+        args.intro,
+        args.keep,
+        args.cover_size,
+        args.jobs,
+        incremental=args.incremental,
+    )
+
 
-# Combine audio, metadata, and cover into M4B file
-cmd_combined = (
-    f'ffmpeg -f concat -safe 0 -i "{input_file}" '  # Concatenate audio files
-    f'-f ffmetadata -i "{chapters_file}" '  # Metadata file for chapters
-    f'-i "{cover_file}" '  # Cover image
-    "-map 0:a -map_chapters 1 -map_metadata 1 "  # Use audio stream, chapters, and metadata
-    "-map 2:v "  # Use the cover image as video stream
-    "-c:a aac -b:a 112k -ar 44100 "  # Audio encoding settings
-    "-c:v png "  # Encode cover image
-    "-disposition:v:0 attached_pic "  # Mark cover as attached picture
-    "-threads 0 "  # Use all available threads
-    "-movflags +faststart "  # Optimize for streaming
-    f'-y "{m4b_file}"'  # Output file
-)
-sp.run(cmd_combined, shell=True, check=True)
-
-# Cleanup
-os.remove(chapters_file)
-os.remove(cover_file)
-os.remove(input_file)
-
-if not args.keep:
-    for audio_file in audio_files:
-        os.remove(audio_file)
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,199 @@
-import subprocess as sp
+from transcode import plan_transcode, print_plan, prepare_inputs, AAC_ARGS
+from build_manifest import resume_build, hash_inputs, output_key
+from build_manifest import is_current, mark_current, finish_build
+from create_m4b_from_files import find_audio_files
+from timing import run_ffmpeg, start_trace
+import library_index
+import tempfile
 import argparse
-import glob
+import shutil
 import os
 import re
 
 
-# Natural sort function
-def natural_sort(lst):
-    def sort_key(key):
-        return [int(c) if c.isdigit() else c.lower() for c in re.split(r"(\d+)", key)]
-
-    return sorted(lst, key=sort_key)
-
-
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Merges all audio files and a cue file into a m4b audiobook"
-)
-parser.add_argument(
-    "-i", "--inputdir", default="", help="Input directory", required=True
-)
-parser.add_argument("-c", "--cue", default="", help="Input CUE file", required=True)
-parser.add_argument(
-    "--keep",
-    default=False,
-    help="Keep audio files and cue file after processing",
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Convert mp3 files to m4b
-glob_path = os.path.abspath(args.inputdir)
-
-audio_files = glob.glob(f"{glob_path}/*.mp3")
-audio_files += glob.glob(f"{glob_path}/*.m4b")
-audio_files += glob.glob(f"{glob_path}/*.aac")
-audio_files += glob.glob(f"{glob_path}/*.m4a")
-audio_files += glob.glob(f"{glob_path}/*.wav")
-
-audio_files = natural_sort(audio_files)
-
-folder = os.path.dirname(audio_files[0]) or "./"
-m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
-
-input_file = os.path.abspath(os.path.join(folder, "input.txt"))
-with open(input_file, "w") as f:
-    for audio_file in audio_files:
-        audio_file = audio_file.replace("'", "'\\''")
-        f.write(f"file '{os.path.abspath(audio_file)}'\n")
-
-# Get chapters from CUE file
-cue_file = os.path.abspath(args.cue)
-with open(cue_file, "r") as f:
-    chapters = []
-    tracks = re.split(r"(?=TRACK)", f.read())
-    for track in tracks:
-        if "TRACK" in track:
-            lines = track.splitlines()
-            chapter = {}
-            for line in lines:
-                if "TRACK" in line:
-                    chapter["track"] = line.split()[1]
-                if "TITLE" in line:
-                    chapter["title"] = line.split('"')[1]
-                if "INDEX 01" in line:
-                    mm, ss, ff = map(int, line.split()[2].split(":"))
-                    chapter["start"] = mm * 60 + ss + ff / 75
-
-            chapters.append(chapter)
-
-# Create chapters file
-chapters_file = os.path.abspath(os.path.join(folder, "chapters.txt"))
-with open(chapters_file, "w") as f:
-    for i, chapter in enumerate(chapters):
-        title = chapter["title"]
-        start_time = chapter["start"]
-
-        f.write(
-            "[CHAPTER]\n"
-            "TIMEBASE=1/1000\n"
-            f"START={int(start_time * 1000)}\n"
-            f"END={int(start_time * 1000)}\n"
-            f"title={title}\n\n"
-        )
-
-# Combine audio and chapters into M4B file
-cmd = (
-    f'ffmpeg -f concat -safe 0 -i "{input_file}" '
-    f'-f ffmetadata -i "{chapters_file}" '
-    "-c:a aac -b:a 112k -ar 44100 "
-    f'-y "{m4b_file}"'
-)
-sp.run(cmd, shell=True, check=True)
-
-# Cleanup
-os.remove(chapters_file)
-os.remove(input_file)
-
-if not args.keep:
-    for audio_file in audio_files:
-        os.remove(audio_file)
-    os.remove(cue_file)
+# Gets the title and start time of each track in a CUE file
+def parse_cue(cue_file: str) -> list:
+    with open(cue_file, "r") as f:
+        chapters = []
+        tracks = re.split(r"(?=TRACK)", f.read())
+        for track in tracks:
+            if "TRACK" in track:
+                lines = track.splitlines()
+                chapter = {}
+                for line in lines:
+                    if "TRACK" in line:
+                        chapter["track"] = line.split()[1]
+                    if "TITLE" in line:
+                        chapter["title"] = line.split('"')[1]
+                    if "INDEX 01" in line:
+                        mm, ss, ff = map(int, line.split()[2].split(":"))
+                        chapter["start"] = mm * 60 + ss + ff / 75
+
+                chapters.append(chapter)
+
+    return chapters
+
+
+# Joins audio files into an m4b with chapters from a CUE file
+def write_m4b(concat_files, codec_args, chapters, m4b_file, folder):
+    input_file = os.path.abspath(os.path.join(folder, "input.txt"))
+    with open(input_file, "w") as f:
+        for audio_file in concat_files:
+            audio_file = audio_file.replace("'", "'\\''")
+            f.write(f"file '{os.path.abspath(audio_file)}'\n")
+
+    # Create chapters file
+    chapters_file = os.path.abspath(os.path.join(folder, "chapters.txt"))
+    with open(chapters_file, "w") as f:
+        for i, chapter in enumerate(chapters):
+            title = chapter["title"]
+            start_time = chapter["start"]
+
+            f.write(
+                "[CHAPTER]\n"
+                "TIMEBASE=1/1000\n"
+                f"START={int(start_time * 1000)}\n"
+                f"END={int(start_time * 1000)}\n"
+                f"title={title}\n\n"
+            )
+
+    # Combine audio and chapters into M4B file
+    cmd = (
+        f'ffmpeg -f concat -safe 0 -i "{input_file}" '
+        f'-f ffmetadata -i "{chapters_file}" '
+        f"{codec_args}"
+        f'-y "{m4b_file}"'
+    )
+    run_ffmpeg(cmd, "concat", file=m4b_file, inputs=len(concat_files))
+
+    os.remove(chapters_file)
+    os.remove(input_file)
+
+
+# Merges the audio files in a folder into an m4b with chapters from a CUE file.
+# Encoded audio is kept in the build folder with --incremental, so a re-run only
+# encodes what changed. Segments are encoded on jobs workers if given
+def create_m4b(
+    input_dir: str,
+    cue_file: str,
+    keep: bool = False,
+    jobs: int = None,
+    incremental: bool = False,
+) -> dict:
+    audio_files = find_audio_files(os.path.abspath(input_dir))
+
+    folder = os.path.dirname(audio_files[0]) or "./"
+    m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
+
+    # Skip the m4b an earlier run made, so the book can be rebuilt
+    audio_files = [f for f in audio_files if os.path.abspath(f) != m4b_file]
+
+    # Decide which files can be copied and encode the rest if needed
+    plan = plan_transcode(audio_files)
+    print_plan(plan)
+
+    # Get chapters from CUE file
+    cue_file = os.path.abspath(cue_file)
+    chapters = parse_cue(cue_file)
+
+    # Only an incremental build, or a resumed one, needs its inputs hashed
+    build = resume_build(folder, incremental)
+    if build:
+        work_dir = build["dir"]
+        hashes = hash_inputs(build, [*audio_files, cue_file])
+        m4b_key = output_key("cue", hashes, AAC_ARGS)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="encode_", dir=folder)
+
+    # Encode and join the audio, unless the last build made the m4b from the
+    # same files. A single input is encoded in segments cut at the chapters,
+    # so an interrupted encode resumes from the last finished segment
+    if build and is_current(build, m4b_file, m4b_key):
+        print(f"{os.path.basename(m4b_file)} is up to date")
+    else:
+        starts = [chapter["start"] for chapter in chapters]
+        concat_files, codec_args = prepare_inputs(plan, work_dir, jobs, build, starts)
+        write_m4b(concat_files, codec_args, chapters, m4b_file, folder)
+        if build:
+            mark_current(build, m4b_file, m4b_key, chapters=chapters)
+
+    # Cleanup
+    if build:
+        finish_build(build, incremental)
+    else:
+        shutil.rmtree(work_dir)
+
+    if not keep:
+        for audio_file in audio_files:
+            os.remove(audio_file)
+        os.remove(cue_file)
+
+    return {"file": m4b_file, "chapters": chapters, "plan": plan}
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Merges all audio files and a cue file into a m4b audiobook"
+    )
+    parser.add_argument(
+        "-i", "--inputdir", default="", help="Input directory", required=True
+    )
+    parser.add_argument("-c", "--cue", default="", help="Input CUE file", required=True)
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep audio files and cue file after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        help="Keep the encoded audio in a build folder next to the input files, so "
+        "a re-run only encodes what changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parallel",
+        default=False,
+        help="Encode the segments of a single long input in parallel, then join them "
+        "without re-encoding",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count(),
+        help="Number of segments to encode at once with --parallel (Default: number of cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-index",
+        default=False,
+        help="Probe every file instead of using the library index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    library_index.enabled = library_index.enabled and not args.no_index
+    if args.trace:
+        start_trace(args.trace)
+
+    # Convert mp3 files to m4b
+    create_m4b(
+        args.inputdir,
+        args.cue,
+        args.keep,
+        args.jobs if args.parallel else None,
+        args.incremental,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
-import subprocess as sp
+from transcode import plan_transcode, print_plan, prepare_inputs, joined_durations
+from transcode import numbered_chapters, concat_m4b, AAC_ARGS, LOUDNESS_TARGET
+from transcode import SEGMENT_PRIMING
+from build_manifest import resume_build, hash_inputs, output_key
+from build_manifest import is_current, mark_current, recorded, finish_build
+from library_index import index_folder, list_audio
+from timing import span, start_trace
+import library_index
+import tempfile
 import argparse
-import glob
+import shutil
 import os
 import re
 
@@ -13,90 +21,154 @@ def natural_sort(lst):
     return sorted(lst, key=sort_key)
 
 
-# Get duration of audio file
-def get_duration(file):
-    cmd = (
-        "ffprobe -v error -show_entries format=duration "
-        f'-of default=noprint_wrappers=1:nokey=1 "{file}"'
+# Finds the audio files in a folder, in natural order. With the library index,
+# the files are probed as they're found so later steps don't have to
+def find_audio_files(input_dir: str) -> list:
+    with span("find_audio_files", folder=input_dir) as details:
+        if library_index.enabled:
+            audio_files = [row["path"] for row in index_folder(input_dir)]
+        else:
+            audio_files = [path for path, _, _ in list_audio(input_dir)]
+        details["files"] = len(audio_files)
+
+        return natural_sort(audio_files)
+
+
+# Creates an m4b from the audio files in a folder, with a chapter for each file.
+# Files are encoded separately on jobs workers if given, then joined. Encoded
+# files are kept in the build folder with --incremental, so a re-run only encodes the
+# files that changed and an interrupted run resumes where it stopped. With a
+# loudness target, each file gets the gain that brings it to that loudness
+def create_m4b(
+    input_dir: str,
+    keep: bool = False,
+    jobs: int = None,
+    loudness: float = None,
+    incremental: bool = False,
+) -> dict:
+    audio_files = find_audio_files(input_dir)
+
+    # Get output file
+    folder = os.path.dirname(audio_files[0]) or "./"
+    m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
+
+    # Skip the m4b an earlier run made, so the book can be rebuilt
+    audio_files = [f for f in audio_files if os.path.abspath(f) != m4b_file]
+
+    # Decide which files can be copied and encode the rest if needed
+    plan = plan_transcode(audio_files, loudness=loudness)
+    print_plan(plan)
+
+    # Only an incremental build, or a resumed one, needs its inputs hashed
+    build = resume_build(folder, incremental)
+    if build:
+        work_dir = build["dir"]
+        hashes = hash_inputs(build, audio_files)
+        m4b_key = output_key("files", hashes, AAC_ARGS, loudness, SEGMENT_PRIMING)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="encode_", dir=folder)
+
+    # Combine audio files into M4B file with a chapter for each, unless the
+    # last build made it from the same files. Chapters are timed from the files
+    # that are joined, as encoded files can be slightly longer than their source
+    if build and is_current(build, m4b_file, m4b_key):
+        print(f"{os.path.basename(m4b_file)} is up to date")
+        chapters = recorded(build, m4b_file)["chapters"]
+    else:
+        concat_files, codec_args = prepare_inputs(plan, work_dir, jobs, build)
+        chapters = numbered_chapters(joined_durations(plan, concat_files))
+        concat_m4b(concat_files, codec_args, chapters, m4b_file, work_dir)
+        if build:
+            mark_current(build, m4b_file, m4b_key, chapters=chapters)
+
+    # Cleanup
+    if build:
+        finish_build(build, incremental)
+    else:
+        shutil.rmtree(work_dir)
+
+    if not keep:
+        for audio_file in audio_files:
+            os.remove(audio_file)
+
+    return {"file": m4b_file, "chapters": chapters, "plan": plan}
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Creates an m4b audiobook from split audio files where each file is a chapter"
     )
-    result = sp.run(cmd, shell=True, capture_output=True, text=True)
-
-    return float(result.stdout.strip())
-
-
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Creates an m4b audiobook from split audio files where each file is a chapter"
-)
-parser.add_argument(
-    "-i", "--inputdir", default="", help="Input directory", required=True
-)
-parser.add_argument(
-    "--keep",
-    default=False,
-    help="Keep audio files and cue sheet after processing",
-    action="store_true",
-)
-
-args = parser.parse_args()
-
-# Convert audio files to m4b
-glob_path = args.inputdir or input("Path to audio files: ")
-
-audio_files = glob.glob(f"{glob_path}/*.mp3")
-audio_files += glob.glob(f"{glob_path}/*.m4b")
-audio_files += glob.glob(f"{glob_path}/*.aac")
-audio_files += glob.glob(f"{glob_path}/*.m4a")
-audio_files += glob.glob(f"{glob_path}/*.wav")
-
-audio_files = natural_sort(audio_files)
-
-# Create input file for ffmpeg concat
-folder = os.path.dirname(audio_files[0]) or "./"
-m4b_file = os.path.abspath(os.path.join(folder, f"{os.path.basename(folder)}.m4b"))
-
-input_file = os.path.abspath(os.path.join(folder, "input.txt"))
-with open(input_file, "w") as f:
-    for audio_file in audio_files:
-        audio_file = audio_file.replace("'", "'\\''")
-        f.write(f"file '{os.path.abspath(audio_file)}'\n")
-
-# Get duration of each autio file
-durations = [get_duration(audio_file) for audio_file in audio_files]
-
-# Create chapters file
-chapters_file = os.path.abspath(os.path.join(folder, "chapters.txt"))
-with open(chapters_file, "w") as f:
-    total_duration = 0
-    for i, audio_file in enumerate(audio_files):
-        title = f"Chapter {i + 1}"
-        start_time = 0 if i == 0 else total_duration
-        duration = durations[i]
-
-        f.write(
-            "[CHAPTER]\n"
-            "TIMEBASE=1/1000\n"
-            f"START={int(start_time * 1000)}\n"
-            f"END={int((start_time + duration) * 1000)}\n"
-            f"title={title}\n\n"
-        )
-
-        total_duration += duration
-
-# Combine audio and chapters into M4B file
-cmd = (
-    f'ffmpeg -f concat -safe 0 -i "{input_file}" '
-    f'-f ffmetadata -i "{chapters_file}" '
-    "-map 0:a -map_chapters 1 -map_metadata 1 "
-    "-c:a aac -b:a 112k -ar 44100 "
-    f'-y "{m4b_file}"'
-)
-sp.run(cmd, shell=True, check=True)
-
-# Cleanup
-os.remove(chapters_file)
-os.remove(input_file)
-
-if not args.keep:
-    for audio_file in audio_files:
-        os.remove(audio_file)
+    parser.add_argument(
+        "-i", "--inputdir", default="", help="Input directory", required=True
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep audio files and cue sheet after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        help="Keep the encoded audio in a build folder next to the input files, so "
+        "a re-run only encodes what changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parallel",
+        default=False,
+        help="Encode each file separately in parallel, then join them without re-encoding",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count(),
+        help="Number of files to encode at once with --parallel (Default: number of cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--normalize",
+        default=False,
+        help="Even out the loudness of the files while they're encoded",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--target",
+        default=LOUDNESS_TARGET,
+        help=f"Loudness to bring each file to with --normalize, in LUFS "
+        f"(Default: {LOUDNESS_TARGET})",
+        type=float,
+    )
+    parser.add_argument(
+        "--no-index",
+        default=False,
+        help="Probe every file instead of using the library index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    library_index.enabled = library_index.enabled and not args.no_index
+    if args.trace:
+        start_trace(args.trace)
+
+    # Convert audio files to m4b
+    input_dir = args.inputdir or input("Path to audio files: ")
+    create_m4b(
+        input_dir,
+        args.keep,
+        args.jobs if args.parallel else None,
+        args.target if args.normalize else None,
+        args.incremental,
+    )
+
+
+if __name__ == "__main__":
+    main()
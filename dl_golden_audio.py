@@ -1,16 +1,141 @@
-from urllib.request import urlopen, Request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 from urllib.parse import unquote_plus
+from http_client import get, download
+from transcode import plan_step, encode_file, numbered_chapters, concat_m4b
+from probe import get_stream, get_duration
+from timing import start_trace
+import http_client
+import http.client
 import argparse
+import tempfile
+import shutil
 import readline
 import glob
 import re
 import os
 
 
-# Makes web requests
-def get(url: str):
-    req = Request(url, headers={"User-Agent": "Totally not a bot"})
-    return urlopen(req).read()
+# Gets the url and file name of each track on an audiobook page
+def find_tracks(url: str) -> list:
+    html = get(url).decode("utf-8")
+    track_urls = re.findall(r'(?<=<a href=")https://ipaudio.*?/.*?mp3(?=">)', html)
+
+    tracks = []
+    for i, track_url in enumerate(track_urls):
+        # Decode url quoting
+        match = re.search(r"(?<=uploads)(/.*?/)(.*)(?=/)", track_url)
+        filename = f"{unquote_plus(match.group(2))}_{i+1}.mp3"
+        tracks.append({"url": track_url, "filename": filename})
+
+    return tracks
+
+
+# Probes a downloaded track and encodes it unless it can be stream-copied
+def prepare_track(audio_file, out_file):
+    stream = get_stream(audio_file)
+    channels = stream["channels"] if stream else 2
+
+    step = plan_step(audio_file, stream, channels)
+    step["output"] = audio_file
+    if step["action"] == "encode":
+        step["output"] = encode_file(audio_file, out_file, channels)
+    step["duration"] = get_duration(step["output"])
+
+    return step
+
+
+# Joins prepared tracks into an m4b named after the output folder
+def build_m4b(steps, output, work_dir):
+    # Each track kept its own channel count, so re-encode any that don't match
+    # the rest of the book
+    counts = Counter(step["channels"] for step in steps)
+    channels = counts.most_common(1)[0][0]
+    for i, step in enumerate(steps):
+        if step["channels"] != channels:
+            out_file = os.path.join(work_dir, f"{i:04d}.m4a")
+            step["output"] = encode_file(step["file"], out_file, channels)
+            step["duration"] = get_duration(step["output"])
+
+    # Combine tracks into M4B file with a chapter for each, timed from the files
+    # that are joined as encoded ones can be slightly longer than their source
+    folder = os.path.abspath(output)
+    m4b_file = os.path.join(folder, f"{os.path.basename(folder)}.m4b")
+    files = [step["output"] for step in steps]
+    chapters = numbered_chapters([step["duration"] for step in steps])
+    concat_m4b(files, "-c:a copy ", chapters, m4b_file, work_dir)
+    print(f"Created '{m4b_file}'")
+
+    return m4b_file, chapters
+
+
+# Downloads tracks into a folder, and with build encodes each one as soon as it
+# arrives and joins them into an m4b once the last one lands
+def download_tracks(
+    tracks: list,
+    output: str,
+    jobs: int = 4,
+    build: bool = False,
+    encode_jobs: int = None,
+) -> dict:
+    os.makedirs(output, exist_ok=True)
+
+    print(f"Downloading {len(tracks)} files using {jobs} worker(s)...")
+    work_dir = tempfile.mkdtemp(prefix="encode_", dir=output) if build else None
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor, ThreadPoolExecutor(
+            max_workers=encode_jobs or os.cpu_count()
+        ) as encoders:
+            # Let every worker connect to the track server at once
+            limit = max(http_client.MAX_PER_HOST, jobs)
+            futures = {
+                executor.submit(
+                    download,
+                    track["url"],
+                    os.path.join(output, track["filename"]),
+                    None,
+                    limit,
+                ): i
+                for i, track in enumerate(tracks)
+            }
+
+            failed = []
+            encodes = {}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                filename = tracks[i]["filename"]
+                try:
+                    status = "Downloaded" if future.result() else "Already downloaded"
+                except (OSError, http.client.HTTPException) as e:
+                    failed.append(filename)
+                    status = f"Failed ({e})"
+                else:
+                    if build:
+                        audio_file = os.path.join(output, filename)
+                        out_file = os.path.join(work_dir, f"{i:04d}.m4a")
+                        encodes[i] = encoders.submit(
+                            prepare_track, audio_file, out_file
+                        )
+                print(f"[{done}/{len(tracks)}] {status} {filename}")
+
+            if build and not failed:
+                print("Waiting for the last tracks to finish encoding...")
+
+        result = {
+            "files": [os.path.join(output, track["filename"]) for track in tracks],
+            "failed": failed,
+            "m4b_file": None,
+            "chapters": None,
+        }
+        if build and not failed:
+            steps = [encodes[i].result() for i in range(len(tracks))]
+            result["m4b_file"], result["chapters"] = build_m4b(steps, output, work_dir)
+    finally:
+        # Cleanup, also when a download or encode failed
+        if work_dir:
+            shutil.rmtree(work_dir)
+
+    return result
 
 
 # Setup path autocomplete
@@ -19,37 +144,60 @@ def completer(text, state):
     return [x for x in glob.glob(text + "*")][state]
 
 
-readline.set_completer_delims("\t")
-readline.parse_and_bind("tab: complete")
-readline.set_completer(completer)
+def main():
+    readline.set_completer_delims("\t")
+    readline.parse_and_bind("tab: complete")
+    readline.set_completer(completer)
 
-# Setup optional arguments
-parser = argparse.ArgumentParser(
-    description="Download audiobooks from sites like goldenaudiobooks.com, hdaudiobooks.com, etc."
-)
-parser.add_argument("--url", default="", help="URL to audiobook")
-parser.add_argument("--output", default="", help="Output folder for mp3 files")
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Download audiobooks from sites like goldenaudiobooks.com, hdaudiobooks.com, etc."
+    )
+    parser.add_argument("--url", default="", help="URL to audiobook")
+    parser.add_argument("--output", default="", help="Output folder for mp3 files")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=4,
+        help="Number of files to download at once (Default: 4)",
+        type=int,
+    )
+    parser.add_argument(
+        "--build",
+        default=False,
+        help="Build an m4b from the tracks while they download, keeping the mp3 files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--encode-jobs",
+        default=os.cpu_count(),
+        help="Number of tracks to encode at once with --build (Default: number of cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
 
-args = parser.parse_args()
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
 
-# Create output folder
-output = args.output or input("Output folder: ")
-os.makedirs(output, exist_ok=True)
+    # Get track urls
+    output = args.output or input("Output folder: ")
+    url = args.url or input("Audiobook URL: ")
+    tracks = find_tracks(url)
 
-# Get track urls
-url = args.url or input("Audiobook URL: ")
-html = get(url).decode("utf-8")
-tracks = re.findall(r'(?<=<a href=")https://ipaudio.*?/.*?mp3(?=">)', html)
+    # Download tracks
+    result = download_tracks(tracks, output, args.jobs, args.build, args.encode_jobs)
+    if result["failed"]:
+        print(f"{len(result['failed'])} file(s) failed, run again to resume them")
+        raise SystemExit(1)
 
-# Download tracks
-for i, track in enumerate(tracks):
-    # Decode url quoting
-    match = re.search(r"(?<=uploads)(/.*?/)(.*)(?=/)", track)
-    filename = f"{unquote_plus(match.group(2))}_{i+1}.mp3"
+    print("Done!")
 
-    # Download file
-    print(f"Now downloading file {i+1} of {len(tracks)}")
-    with open(os.path.join(output, filename), "wb") as f:
-        f.write(get(track))
 
-print("Done!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+from concurrent.futures import ThreadPoolExecutor
+from transcode import plan_transcode, print_plan, prepare_inputs, concat_m4b
+from transcode import numbered_chapters, joined_durations
+from build_manifest import resume_build, finish_build
+from create_m4b_from_files import find_audio_files
+from create_m4b_from_cue import parse_cue
+from create_m4b_from_asin import get_audible_chapters, get_audible_cover
+from add_chapters_from_silence import detect_silences, silence_chapters
+from add_chapters_from_srt import srt_chapters
+from add_metadata_to_m4b import lookup_metadata, metadata_tags
+from mp4edit import write_metadata
+from timing import span, start_trace
+import http_client
+import argparse
+import tempfile
+import shutil
+import json
+import os
+
+# Where chapters can come from. Chapters from the input files, a CUE sheet or
+# Audible are known before encoding, the others are found in the finished audio
+CHAPTER_SOURCES = ["files", "cue", "asin", "silence", "srt"]
+
+
+# Reads a job description from a JSON file
+def load_job(job_file: str) -> dict:
+    with open(job_file, "r") as f:
+        return json.load(f)
+
+
+# Gets chapters that are known before the audio is built, or None
+def planned_chapters(source):
+    kind = source.get("source") if source else None
+    if kind == "cue":
+        return parse_cue(os.path.abspath(source["file"]))
+    if kind == "asin":
+        return get_audible_chapters(source["asin"], source.get("intro", False))
+
+    return None
+
+
+# Gets chapters that have to be found in the finished audio, or None
+def detected_chapters(source, m4b_file):
+    kind = source.get("source") if source else None
+    if kind == "silence":
+        silences = detect_silences(
+            m4b_file,
+            source["min"],
+            source["max"],
+            source.get("level", -30),
+            source.get("engine", "ffmpeg"),
+        )
+        return silence_chapters(silences)
+    if kind == "srt":
+        return srt_chapters(os.path.abspath(source["file"]), source["keywords"])
+
+    return None
+
+
+# Gets the cover named by a job: an image file, the Audible cover of the ASIN
+# used for chapters, or the cover found with the metadata (the default)
+def job_cover(job, metadata):
+    cover = job.get("cover", "metadata")
+    if cover == "metadata":
+        return metadata["cover_data"] if metadata else None
+    if cover == "asin":
+        return get_audible_cover(job["chapters"]["asin"], job.get("cover_size"))
+
+    with open(cover, "rb") as f:
+        return f.read()
+
+
+# Builds the audio of a folder once, without chapters or tags, evening out the
+# loudness of the files if a target is given, and gets the length of each file
+# it joined. Encoded audio is kept in the build folder for an incremental build
+def build_audio(audio_files, m4b_file, starts, jobs, incremental, loudness=None):
+    plan = plan_transcode(audio_files, loudness=loudness)
+    print_plan(plan)
+
+    folder = os.path.dirname(m4b_file)
+    build = resume_build(folder, incremental)
+    work_dir = build["dir"] if build else tempfile.mkdtemp(prefix="encode_", dir=folder)
+    concat_files, codec_args = prepare_inputs(plan, work_dir, jobs, build, starts)
+    concat_m4b(concat_files, codec_args, [], m4b_file, work_dir)
+    durations = joined_durations(plan, concat_files)
+
+    if build:
+        finish_build(build, incremental)
+    else:
+        shutil.rmtree(work_dir)
+
+    return durations
+
+
+# Runs a job: builds the m4b from a folder or copies an existing one at most once,
+# then writes its chapters, tags and cover in a single in-place metadata edit.
+# Metadata is looked up while the audio is being built
+def run_job(
+    job: dict, keep: bool = False, jobs: int = None, incremental: bool = False
+) -> dict:
+    input_path = os.path.abspath(job["input"])
+    source = job.get("chapters")
+    if source and source.get("source") not in CHAPTER_SOURCES:
+        raise ValueError(f"Unknown chapter source: {source.get('source')}")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        lookup = None
+        if job.get("metadata"):
+            book = job["metadata"]
+            lookup = executor.submit(
+                lookup_metadata,
+                book["title"],
+                book["author"],
+                book.get("narrator", ""),
+                job.get("cover_size"),
+            )
+
+        if os.path.isdir(input_path):
+            folder = input_path
+            m4b_file = os.path.abspath(
+                job.get("output")
+                or os.path.join(folder, f"{os.path.basename(folder)}.m4b")
+            )
+            audio_files = find_audio_files(folder)
+            audio_files = [f for f in audio_files if os.path.abspath(f) != m4b_file]
+
+            chapters = planned_chapters(source)
+            starts = [chapter["start"] for chapter in chapters] if chapters else None
+            loudness = job.get("loudness")
+            durations = build_audio(
+                audio_files, m4b_file, starts, jobs, incremental, loudness
+            )
+
+            # A chapter per file is timed from the files that were joined, as
+            # encoded files can be slightly longer than their source
+            if source and source.get("source") == "files":
+                chapters = numbered_chapters(durations)
+        else:
+            if source and source.get("source") == "files":
+                raise ValueError("Chapters from files need a folder of audio files")
+
+            audio_files = []
+            chapters = planned_chapters(source)
+            if job.get("overwrite"):
+                m4b_file = input_path
+            else:
+                m4b_file = os.path.abspath(
+                    job.get("output") or input_path.replace(".m4b", "_final.m4b")
+                )
+                with span("copy", file=m4b_file):
+                    shutil.copyfile(input_path, m4b_file)
+
+        if chapters is None:
+            chapters = detected_chapters(source, m4b_file)
+        metadata = lookup.result() if lookup else None
+
+    tags = metadata_tags(metadata) if metadata else None
+    cover = job_cover(job, metadata)
+    write_metadata(m4b_file, chapters=chapters, tags=tags, cover=cover)
+    print(f"Finished '{m4b_file}'")
+
+    if not keep:
+        for audio_file in audio_files:
+            os.remove(audio_file)
+
+    return {"file": m4b_file, "chapters": chapters, "tags": tags}
+
+
+# Builds a job description from command line arguments
+def job_from_args(args) -> dict:
+    job = {"input": args.input, "overwrite": args.overwrite}
+    if args.output:
+        job["output"] = args.output
+    if args.cover:
+        job["cover"] = args.cover
+    if args.cover_size:
+        job["cover_size"] = args.cover_size
+
+    if args.chapters == "files":
+        job["chapters"] = {"source": "files"}
+    elif args.chapters == "cue":
+        job["chapters"] = {"source": "cue", "file": args.cue}
+    elif args.chapters == "asin":
+        job["chapters"] = {"source": "asin", "asin": args.asin, "intro": args.intro}
+    elif args.chapters == "silence":
+        job["chapters"] = {
+            "source": "silence",
+            "min": args.min,
+            "max": args.max,
+            "level": args.level,
+            "engine": args.engine,
+        }
+    elif args.chapters == "srt":
+        job["chapters"] = {
+            "source": "srt",
+            "file": args.srt,
+            "keywords": args.keywords.split(","),
+        }
+
+    if args.title:
+        job["metadata"] = {
+            "title": args.title,
+            "author": args.author,
+            "narrator": args.narrator,
+        }
+
+    return job
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Builds or finishes an m4b audiobook in one pass, adding chapters, "
+        "tags and a cover with a single write"
+    )
+    parser.add_argument(
+        "--job",
+        default="",
+        help="JSON job description with input, output, chapters, metadata, cover "
+        "and loudness",
+    )
+    parser.add_argument(
+        "-i", "--input", default="", help="Input folder of audio files or m4b file"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="",
+        help="Output m4b file (Default: named after the folder, or input_final.m4b)",
+    )
+    parser.add_argument(
+        "--chapters",
+        default="",
+        help="Where to get chapters from",
+        choices=CHAPTER_SOURCES,
+    )
+    parser.add_argument("-c", "--cue", default="", help="CUE file for --chapters cue")
+    parser.add_argument(
+        "--asin", default="", help="Audible book id for --chapters asin"
+    )
+    parser.add_argument(
+        "--intro",
+        default=False,
+        help="Does book have 'This is Audible' at start?",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min", default=0, help="Minimum silence duration in seconds", type=float
+    )
+    parser.add_argument(
+        "--max", default=0, help="Maximum silence duration in seconds", type=float
+    )
+    parser.add_argument(
+        "--level", default=-30, help="Silence level in dB (Default: -30)", type=float
+    )
+    parser.add_argument(
+        "--engine",
+        default="ffmpeg",
+        help="Silence detection engine (Default: ffmpeg)",
+        choices=["ffmpeg", "numpy"],
+    )
+    parser.add_argument(
+        "-s", "--srt", default="", help="SRT or WebVTT file for --chapters srt"
+    )
+    parser.add_argument(
+        "-k",
+        "--keywords",
+        default="",
+        help="Keywords to search for in the subtitles (comma separated)",
+    )
+    parser.add_argument("-t", "--title", default="", help="Title of the audiobook")
+    parser.add_argument(
+        "-a", "--author", default="", help="Author of the audiobook (comma separated)"
+    )
+    parser.add_argument(
+        "-n",
+        "--narrator",
+        default="",
+        help="Narrator(s) of the audiobook (comma separated)",
+    )
+    parser.add_argument(
+        "--cover",
+        default="",
+        help="Cover to embed: an image file, 'asin' or 'metadata' (Default: metadata)",
+    )
+    parser.add_argument(
+        "--cover-size",
+        default=0,
+        help="Shrink the cover so neither side is bigger than this many pixels "
+        "(Default: original)",
+        type=int,
+    )
+    parser.add_argument(
+        "--overwrite",
+        default=False,
+        help="Write to the input m4b instead of a copy",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep the audio files after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        help="Keep the encoded audio in a build folder next to the input files, so "
+        "a re-run only encodes what changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        help="Number of files or segments to encode at once (Default: 1)",
+        type=int,
+    )
+    parser.add_argument(
+        "--offline",
+        default=False,
+        help="Only use cached Audible and Google Books responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+    http_client.offline = http_client.offline or args.offline
+
+    required = {
+        "cue": args.cue,
+        "asin": args.asin,
+        "silence": args.min and args.max,
+        "srt": args.srt and args.keywords,
+    }
+    if not required.get(args.chapters, True):
+        parser.error(f"Missing the options needed for --chapters {args.chapters}")
+    if args.title and not args.author:
+        parser.error("-a/--author is required with -t/--title")
+
+    if args.job:
+        job = load_job(args.job)
+    elif args.input:
+        job = job_from_args(args)
+    else:
+        parser.error("--job or -i/--input is required")
+
+    run_job(job, args.keep, args.jobs, args.incremental)
+
+
+if __name__ == "__main__":
+    main()
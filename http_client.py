@@ -0,0 +1,297 @@
+from urllib.parse import urljoin, urlsplit
+from urllib.error import HTTPError, URLError
+from timing import span
+import response_cache
+import http.client
+import threading
+import random
+import time
+import os
+
+# Request settings shared by every script
+USER_AGENT = "Totally not a bot"
+TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 60
+MAX_PER_HOST = 4
+MAX_REDIRECTS = 5
+DOWNLOAD_CHUNK = 1 << 20
+
+# Statuses worth retrying, as the server may just be busy
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+# Only serve cached responses, without touching the network
+offline = os.environ.get("AUDIOBOOK_TOOLS_OFFLINE") == "1"
+
+# Sends every request to this server instead, with the original host as the
+# start of the path, so benchmarks can run against a local stub
+stub_url = os.environ.get("AUDIOBOOK_TOOLS_STUB_URL")
+
+# Idle keep-alive connections and concurrency limits, by host
+idle_connections = {}
+host_limits = {}
+lock = threading.Lock()
+
+
+# Gets an idle connection to a host, or opens a new one
+def acquire_connection(scheme, host, reuse=True):
+    with lock:
+        idle = idle_connections.setdefault((scheme, host), [])
+        if reuse and idle:
+            return idle.pop(), True
+
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, timeout=TIMEOUT), False
+    return http.client.HTTPConnection(host, timeout=TIMEOUT), False
+
+
+# Returns a connection to the pool so later requests can reuse it
+def release_connection(scheme, host, connection):
+    with lock:
+        idle_connections[(scheme, host)].append(connection)
+
+
+# Gets the semaphore limiting concurrent requests to a host, to MAX_PER_HOST
+# unless another limit is given. Each limit has its own semaphore
+def host_limit(host, limit=None):
+    limit = limit or MAX_PER_HOST
+    with lock:
+        return host_limits.setdefault((host, limit), threading.BoundedSemaphore(limit))
+
+
+# Gets the URL a request should really go to
+def route(url):
+    if not stub_url:
+        return url
+
+    parts = urlsplit(url)
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{stub_url.rstrip('/')}/{parts.netloc}{parts.path}{query}"
+
+
+# Sends a request over a pooled connection, retrying once on a new connection
+# as servers drop idle keep-alive connections
+def send(parts, headers, method="GET"):
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    reuse = True
+    while True:
+        connection, reused = acquire_connection(parts.scheme, parts.netloc, reuse)
+        try:
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            reuse = False
+
+
+# Returns a connection whose response has been read to the pool, if it's still open
+def finish(parts, connection, response):
+    if response.will_close:
+        connection.close()
+    else:
+        release_connection(parts.scheme, parts.netloc, connection)
+
+
+# Makes a single request over a pooled connection
+def request(url, headers=None, method="GET"):
+    parts = urlsplit(route(url))
+    headers = {"User-Agent": USER_AGENT, **(headers or {})}
+
+    with host_limit(parts.netloc):
+        connection, response = send(parts, headers, method)
+        try:
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        finish(parts, connection, response)
+
+    return response, body
+
+
+# Gets how long to wait before retrying, honouring Retry-After if given
+def retry_delay(attempt, response=None):
+    delay = BACKOFF * 2**attempt * (1 + random.random())
+    retry_after = response.headers.get("Retry-After") if response else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+
+    return min(delay, MAX_BACKOFF)
+
+
+# Makes web requests, reusing connections and retrying failures with backoff.
+# Responses are cached for ttl seconds if given, or served stale when offline
+def get(url: str, headers=None, ttl=None):
+    with span("get", url=url) as details:
+        if ttl is not None or offline:
+            body = response_cache.load(url, None if offline else ttl)
+            if body is not None:
+                details.update(cached=True, bytes=len(body))
+                return body
+        if offline:
+            raise URLError(f"{url} is not cached and offline mode is on")
+
+        body = fetch(url, headers)
+        details.update(cached=False, bytes=len(body))
+        if ttl is not None:
+            response_cache.save(url, body)
+
+        return body
+
+
+# Fetches a URL, retrying failures with backoff
+def fetch(url, headers=None):
+    attempt = 0
+    redirects = 0
+    while True:
+        response = None
+        try:
+            response, body = request(url, headers)
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+        else:
+            if response.status in REDIRECT_STATUSES and redirects < MAX_REDIRECTS:
+                url = urljoin(url, response.headers["Location"])
+                redirects += 1
+                continue
+            if response.status < 400:
+                return body
+
+            error = HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+            if response.status not in RETRY_STATUSES:
+                raise error
+
+        if attempt == RETRIES:
+            raise error
+
+        delay = retry_delay(attempt, response)
+        print(f"Request to {url} failed ({error}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+# Gets the size of a URL without downloading it, or None if the server won't say
+def content_length(url, headers=None):
+    try:
+        response, _ = request(url, headers, method="HEAD")
+    except (OSError, http.client.HTTPException):
+        return None
+
+    length = response.headers.get("Content-Length")
+    if response.status >= 400 or not length or not length.isdigit():
+        return None
+
+    return int(length)
+
+
+# Streams one attempt at a download into a .part file, resuming from its end.
+# Returns whether the file is complete, and the response
+def download_part(url, part_file, headers=None, limit=None):
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    parts = urlsplit(route(url))
+    headers = {"User-Agent": USER_AGENT, **(headers or {})}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    with host_limit(parts.netloc, limit):
+        connection, response = send(parts, headers)
+        try:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status not in (200, 206):
+                response.read()
+            else:
+                # Servers that ignore Range send the whole file again
+                if response.status == 200:
+                    offset = 0
+                elif not content_range.startswith(f"bytes {offset}-"):
+                    raise http.client.HTTPException(
+                        f"unexpected Content-Range '{content_range}'"
+                    )
+
+                with open(part_file, "r+b" if offset else "wb") as f:
+                    f.seek(offset)
+                    f.truncate()
+                    while chunk := response.read(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+
+                # http.client doesn't raise if the server closes early
+                if response.length:
+                    raise http.client.IncompleteRead(b"", response.length)
+        except BaseException:
+            connection.close()
+            raise
+        finish(parts, connection, response)
+
+    # A .part file the server can't resume is either complete or has to restart
+    if response.status == 416:
+        if content_range == f"bytes */{offset}":
+            return True, response
+        os.remove(part_file)
+
+    return response.status in (200, 206), response
+
+
+# Downloads a URL to a file in chunks, keeping partial downloads in a .part file
+# that later attempts resume with Range requests. Returns False if the file was
+# already complete. At most limit downloads run at once per host if given,
+# instead of MAX_PER_HOST
+def download(url: str, out_file, headers=None, limit: int = None):
+    with span("download", url=url, file=out_file) as details:
+        downloaded = download_file(url, out_file, headers, limit)
+        details["skipped"] = not downloaded
+
+        return downloaded
+
+
+# Downloads a URL to a file, resuming or skipping what's already there
+def download_file(url, out_file, headers=None, limit=None):
+    part_file = f"{out_file}.part"
+
+    # Files the size the server reports are done, and shorter ones are resumed
+    if os.path.exists(out_file):
+        size = os.path.getsize(out_file)
+        expected = content_length(url, headers)
+        if expected == size:
+            return False
+        if expected is None or size < expected:
+            os.replace(out_file, part_file)
+        else:
+            os.remove(out_file)
+
+    attempt = 0
+    redirects = 0
+    while True:
+        response = None
+        try:
+            complete, response = download_part(url, part_file, headers, limit)
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+        else:
+            if complete:
+                with span("replace", file=out_file):
+                    os.replace(part_file, out_file)
+                return True
+            if response.status in REDIRECT_STATUSES and redirects < MAX_REDIRECTS:
+                url = urljoin(url, response.headers["Location"])
+                redirects += 1
+                continue
+
+            error = HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+            if response.status not in RETRY_STATUSES | {416}:
+                raise error
+
+        if attempt == RETRIES:
+            raise error
+
+        delay = retry_delay(attempt, response)
+        print(f"Download of {url} failed ({error}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,380 @@
+from concurrent.futures import ThreadPoolExecutor
+from response_cache import CACHE_DIR
+from probe import get_stream, get_duration, get_durations, measure_loudness
+from probe import PROBE_WORKERS
+from mp4edit import read_moov, moov_tags, moov_chapters, has_cover
+from timing import span, start_trace
+import threading
+import argparse
+import sqlite3
+import struct
+import json
+import time
+import os
+
+# Index of every audio file that has been looked at, so files are only probed
+# again when their size or modification time changes
+INDEX_FILE = os.path.join(CACHE_DIR, "library.sqlite")
+AUDIO_EXTENSIONS = (".mp3", ".m4b", ".aac", ".m4a", ".wav")
+MP4_EXTENSIONS = (".m4a", ".m4b", ".mp4")
+
+# Probed files are saved in batches, so an interrupted scan keeps most of its work
+SAVE_BATCH = 100
+
+# Folders that are never scanned, like the intermediate files of a build
+SKIP_FOLDERS = (".m4b_build",)
+
+# Stored as the loudness of files that were measured without a result, like
+# silent or undecodable ones, so they aren't measured again until they change
+NO_LOUDNESS = float("-inf")
+
+# Scripts use the index unless told not to
+enabled = True
+connection = None
+lock = threading.Lock()
+
+COLUMNS = [
+    "path",
+    "folder",
+    "size",
+    "mtime",
+    "codec",
+    "profile",
+    "sample_rate",
+    "channels",
+    "duration",
+    "chapters",
+    "cover",
+    "tags",
+    "scanned",
+    "loudness",
+]
+
+
+# Opens the index, creating it if needed
+def open_index():
+    global connection
+    if connection is None:
+        os.makedirs(os.path.dirname(INDEX_FILE), exist_ok=True)
+        connection = sqlite3.connect(
+            INDEX_FILE, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, folder TEXT NOT NULL, "
+            "size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+            "codec TEXT, profile TEXT, sample_rate INTEGER, channels INTEGER, "
+            "duration REAL, chapters INTEGER, cover INTEGER, tags TEXT, "
+            "scanned REAL NOT NULL, loudness REAL)"
+        )
+
+        # Indexes made before loudness was measured don't have its column
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(files)")]
+        if "loudness" not in columns:
+            connection.execute("ALTER TABLE files ADD COLUMN loudness REAL")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_folder ON files (folder)")
+
+    return connection
+
+
+# Lists the audio files in a folder with their size and modification time,
+# optionally including every folder below it
+def list_audio(folder, recursive=False):
+    entries = []
+    with os.scandir(folder) as scan:
+        for entry in scan:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive and entry.name not in SKIP_FOLDERS:
+                    entries += list_audio(entry.path, recursive)
+            elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_size, stat.st_mtime_ns))
+
+    return entries
+
+
+# Probes a file for its audio stream, duration, and for MP4 files their
+# chapters, tags and cover. The stream and duration come from the file's
+# headers, with ffprobe only run for what they don't give
+def probe_file(path):
+    stream = get_stream(path) or {}
+    try:
+        duration = get_duration(path)
+    except (OSError, ValueError):
+        duration = None
+
+    row = {
+        "codec": stream.get("codec_name"),
+        "profile": stream.get("profile"),
+        "sample_rate": int(stream.get("sample_rate") or 0) or None,
+        "channels": stream.get("channels"),
+        "duration": duration,
+        "chapters": None,
+        "cover": None,
+        "tags": {},
+        "loudness": None,
+    }
+
+    if path.lower().endswith(MP4_EXTENSIONS):
+        try:
+            with open(path, "rb") as f:
+                moov = read_moov(f)
+                row["chapters"] = len(moov_chapters(f, moov))
+            row["cover"] = has_cover(moov)
+            row["tags"] = moov_tags(moov)
+        except (OSError, ValueError, IndexError, KeyError, TypeError, struct.error):
+            pass
+
+    return row
+
+
+# Converts a database row to a dict
+def row_dict(row):
+    row = dict(zip(COLUMNS, row))
+    row["tags"] = json.loads(row["tags"] or "{}")
+    return row
+
+
+# Saves probed files to the index in one transaction
+def save_rows(rows):
+    values = []
+    for row in rows:
+        values.append([json.dumps(row[c]) if c == "tags" else row[c] for c in COLUMNS])
+
+    with lock:
+        db = open_index()
+        db.execute("BEGIN")
+        db.executemany(
+            f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})",
+            values,
+        )
+        db.execute("COMMIT")
+
+
+# Brings the index up to date for a list of (path, size, mtime) entries,
+# probing only the files that are new or changed, and returns their rows
+def update_index(entries: list, jobs: int = None) -> list:
+    with lock:
+        db = open_index()
+        known = {}
+        for path, _, _ in entries:
+            row = db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM files WHERE path = ?", (path,)
+            ).fetchone()
+            if row:
+                known[path] = row_dict(row)
+
+    changed = [
+        (path, size, mtime)
+        for path, size, mtime in entries
+        if path not in known
+        or (known[path]["size"], known[path]["mtime"]) != (size, mtime)
+    ]
+
+    with span("update_index", files=len(entries), probed=len(changed)):
+        with ThreadPoolExecutor(max_workers=jobs or PROBE_WORKERS) as executor:
+            probed = executor.map(probe_file, [path for path, _, _ in changed])
+
+            batch = []
+            for (path, size, mtime), info in zip(changed, probed):
+                known[path] = {
+                    "path": path,
+                    "folder": os.path.dirname(path),
+                    "size": size,
+                    "mtime": mtime,
+                    **info,
+                    "scanned": time.time(),
+                }
+                batch.append(known[path])
+                if len(batch) >= SAVE_BATCH:
+                    save_rows(batch)
+                    batch = []
+            save_rows(batch)
+
+    return [known[path] for path, _, _ in entries]
+
+
+# Removes indexed files under a folder that weren't found by the last scan
+def remove_missing(folder, found, recursive=False):
+    with lock:
+        db = open_index()
+        if recursive:
+            prefix = os.path.join(folder, "")
+            rows = db.execute(
+                "SELECT path FROM files WHERE folder = ? OR substr(folder, 1, ?) = ?",
+                (folder, len(prefix), prefix),
+            ).fetchall()
+        else:
+            rows = db.execute(
+                "SELECT path FROM files WHERE folder = ?", (folder,)
+            ).fetchall()
+
+        missing = [path for (path,) in rows if path not in found]
+        db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in missing])
+
+    return len(missing)
+
+
+# Indexes the audio files in a folder and returns their rows
+def index_folder(folder: str, recursive: bool = False, jobs: int = None) -> list:
+    folder = os.path.abspath(folder)
+    entries = list_audio(folder, recursive)
+    rows = update_index(entries, jobs)
+    remove_missing(folder, {path for path, _, _ in entries}, recursive)
+
+    return rows
+
+
+# Gets the index rows of some files, probing the ones that changed
+def index_files(files: list, jobs: int = None) -> list:
+    entries = []
+    for file in files:
+        stat = os.stat(file)
+        entries.append((os.path.abspath(file), stat.st_size, stat.st_mtime_ns))
+
+    return update_index(entries, jobs)
+
+
+# Gets the audio stream of an index row in the same form as get_stream
+def row_stream(row: dict) -> dict:
+    if not row["codec"]:
+        return None
+
+    stream = {"codec_name": row["codec"], "channels": row["channels"]}
+    if row["profile"]:
+        stream["profile"] = row["profile"]
+    if row["sample_rate"]:
+        stream["sample_rate"] = str(row["sample_rate"])
+
+    return stream
+
+
+# Gets the audio streams of some files from the index, or by probing each one
+# if the index isn't used
+def indexed_streams(files: list, jobs: int = None) -> list:
+    if not enabled:
+        with ThreadPoolExecutor(max_workers=jobs or PROBE_WORKERS) as executor:
+            return list(executor.map(get_stream, files))
+
+    return [row_stream(row) for row in index_files(files, jobs)]
+
+
+# Gets the durations of some files from the index, or from their headers or
+# ffprobe if the index isn't used
+def indexed_durations(files: list, jobs: int = None) -> list:
+    if not enabled:
+        return get_durations(files, jobs)
+
+    rows = index_files(files, jobs)
+    return [
+        row["duration"] if row["duration"] is not None else get_duration(row["path"])
+        for row in rows
+    ]
+
+
+# Gets the loudness of some files from the index, only measuring the ones that
+# haven't been measured since they last changed. Files are measured in parallel
+def indexed_loudness(files: list, jobs: int = None) -> list:
+    workers = jobs or os.cpu_count()
+    if not enabled:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(measure_loudness, files))
+
+    rows = index_files(files)
+    missing = [row for row in rows if row["loudness"] is None]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        paths = [row["path"] for row in missing]
+        for row, loudness in zip(missing, executor.map(measure_loudness, paths)):
+            row["loudness"] = NO_LOUDNESS if loudness is None else loudness
+
+    with lock:
+        open_index().executemany(
+            "UPDATE files SET loudness = ? WHERE path = ? AND size = ? AND mtime = ?",
+            [(r["loudness"], r["path"], r["size"], r["mtime"]) for r in missing],
+        )
+
+    return [None if r["loudness"] == NO_LOUDNESS else r["loudness"] for r in rows]
+
+
+# Finds indexed books under a folder that have no chapters, cover or tags
+def find_missing(what: str, folder: str = "") -> list:
+    conditions = {
+        "chapters": "chapters = 0",
+        "cover": "cover = 0",
+        "tags": "(tags IS NULL OR json_extract(tags, '$.title') IS NULL)",
+    }
+    query = (
+        f"SELECT {', '.join(COLUMNS)} FROM files "
+        f"WHERE path LIKE '%.m4b' AND {conditions[what]}"
+    )
+    args = []
+    if folder:
+        folder = os.path.abspath(folder)
+        query += " AND (folder = ? OR substr(folder, 1, ?) = ?)"
+        prefix = os.path.join(folder, "")
+        args = [folder, len(prefix), prefix]
+
+    with lock:
+        rows = open_index().execute(query + " ORDER BY path", args).fetchall()
+
+    return [row_dict(row) for row in rows]
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Indexes the audio files in a library, only probing files that "
+        "changed since the last scan"
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        default=[],
+        help="Folder to scan, can be given more than once",
+        action="append",
+    )
+    parser.add_argument(
+        "--missing",
+        default="",
+        help="List the indexed m4b files that have no chapters, cover or tags",
+        choices=["chapters", "cover", "tags"],
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=PROBE_WORKERS,
+        help=f"Number of files to probe at once (Default: {PROBE_WORKERS})",
+        type=int,
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+    if not (args.input or args.missing):
+        parser.error("-i/--input or --missing is required")
+
+    for folder in args.input:
+        started = time.perf_counter()
+        rows = index_folder(folder, recursive=True, jobs=args.jobs)
+        print(
+            f"Indexed {len(rows)} files in '{folder}' "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+    if args.missing:
+        folders = args.input or [""]
+        for folder in folders:
+            for row in find_missing(args.missing, folder):
+                print(row["path"])
+
+
+if __name__ == "__main__":
+    main()
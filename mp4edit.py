@@ -0,0 +1,614 @@
+from probe import iter_boxes
+from timing import span
+import struct
+import os
+
+# Boxes whose contents are parsed as other boxes when moov is edited
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"udta", b"meta", b"ilst", b"tref"}
+
+# Boxes that can be overwritten when moov is rewritten
+FREE_TYPES = {b"free", b"skip"}
+
+# Free space left after moov so later edits can be made in place
+PADDING = 4096
+
+# Largest mdat that is treated as old chapter text rather than audio
+MAX_CHAPTER_DATA = 1 << 20
+
+# Chapter track settings
+CHAPTER_TIMESCALE = 1000
+TKHD_IN_MOVIE = 0x2
+IDENTITY_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+UTF8_ENCODING = struct.pack(">I4sI", 12, b"encd", 0x100)
+
+# iTunes-style tag atoms, named after the matching ffmpeg metadata keys
+TAG_ATOMS = {
+    "title": b"\xa9nam",
+    "album": b"\xa9alb",
+    "artist": b"\xa9ART",
+    "album_artist": b"aART",
+    "composer": b"\xa9wrt",
+    "comment": b"\xa9cmt",
+    "description": b"desc",
+    "date": b"\xa9day",
+    "genre": b"\xa9gen",
+}
+
+# Data types of iTunes-style tag values
+DATA_UTF8 = 1
+DATA_JPEG = 13
+DATA_PNG = 14
+
+
+# Builds the bytes of a box
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+# Builds the bytes of a box with a version and flags
+def full_box(kind, version, flags, payload):
+    return box(kind, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+# Parses the boxes in a byte string, splitting containers into their children
+def parse_boxes(data):
+    boxes = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[offset : offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header or offset + size > len(data):
+            raise ValueError(f"Invalid {kind!r} box at offset {offset}")
+
+        payload = data[offset + header : offset + size]
+        boxes.append(parse_box(kind, payload))
+        offset += size
+
+    return boxes
+
+
+# Parses a single box from its type and payload
+def parse_box(kind, payload):
+    if kind not in CONTAINERS:
+        return {"type": kind, "data": payload}
+
+    # ISO meta boxes start with a version and flags, QuickTime ones don't
+    prefix = b""
+    if kind == b"meta" and payload[4:8] != b"hdlr":
+        prefix = payload[:4]
+
+    return {
+        "type": kind,
+        "prefix": prefix,
+        "children": parse_boxes(payload[len(prefix) :]),
+    }
+
+
+# Serializes a parsed box back to bytes
+def serialize(parsed):
+    if "children" not in parsed:
+        return box(parsed["type"], parsed["data"])
+
+    children = b"".join(serialize(child) for child in parsed["children"])
+    return box(parsed["type"], parsed["prefix"] + children)
+
+
+# Finds the children of a parsed box with a given type
+def children(parsed, kind):
+    return [child for child in parsed["children"] if child["type"] == kind]
+
+
+# Finds the first child of a parsed box with a given type, optionally creating it
+def child(parsed, kind, create=None):
+    found = children(parsed, kind)
+    if found:
+        return found[0]
+    if create is not None:
+        parsed["children"].append(create)
+        return create
+
+    return None
+
+
+# Removes the children of a parsed box with a given type
+def remove_children(parsed, kind):
+    parsed["children"] = [c for c in parsed["children"] if c["type"] != kind]
+
+
+# Gets the track id of a trak box
+def track_id(trak):
+    tkhd = child(trak, b"tkhd")["data"]
+    return struct.unpack(">I", tkhd[20:24] if tkhd[0] == 1 else tkhd[12:16])[0]
+
+
+# Gets the handler type of a trak box, like 'soun' or 'text'
+def track_handler(trak):
+    hdlr = child(child(trak, b"mdia"), b"hdlr")
+    return hdlr["data"][8:12] if hdlr else None
+
+
+# Gets the timescale and duration of the movie
+def movie_timing(moov):
+    mvhd = child(moov, b"mvhd")["data"]
+    if mvhd[0] == 1:
+        return struct.unpack(">IQ", mvhd[20:32])
+    return struct.unpack(">II", mvhd[12:20])
+
+
+# Gets the first chunk offset of a trak box, used to find its sample data
+def first_chunk_offset(trak):
+    stbl = child(child(child(trak, b"mdia"), b"minf"), b"stbl")
+    if not stbl:
+        return None
+
+    # stbl isn't split into children, so find stco/co64 by hand
+    for chunk_box in parse_boxes(stbl["data"]):
+        data = chunk_box["data"]
+        if chunk_box["type"] == b"stco" and len(data) >= 12:
+            return struct.unpack(">I", data[8:12])[0]
+        if chunk_box["type"] == b"co64" and len(data) >= 16:
+            return struct.unpack(">Q", data[8:16])[0]
+
+    return None
+
+
+# Removes the chapter tracks referenced by the audio track and returns
+# the audio track and the first data offset of the removed chapters
+def remove_chapter_tracks(moov):
+    traks = children(moov, b"trak")
+    audio = next((t for t in traks if track_handler(t) == b"soun"), None)
+    if not audio:
+        raise ValueError("No audio track found")
+
+    tref = child(audio, b"tref")
+    chap = child(tref, b"chap") if tref else None
+    chapter_ids = set()
+    if chap:
+        chapter_ids = set(struct.unpack(f">{len(chap['data']) // 4}I", chap["data"]))
+        remove_children(tref, b"chap")
+        if not tref["children"]:
+            remove_children(audio, b"tref")
+
+    old_offset = None
+    for trak in traks:
+        if track_id(trak) in chapter_ids:
+            old_offset = first_chunk_offset(trak)
+            moov["children"].remove(trak)
+
+    return audio, old_offset
+
+
+# Builds the text samples of a QuickTime chapter track
+def chapter_samples(chapters):
+    samples = []
+    for chapter in chapters:
+        title = chapter["title"].encode("utf-8")
+        samples.append(struct.pack(">H", len(title)) + title + UTF8_ENCODING)
+
+    return samples
+
+
+# Builds a QuickTime chapter track whose samples start at a file offset
+def chapter_track(chapters, samples, new_id, timing, data_offset):
+    timescale, duration = timing
+    total = round(duration / timescale * CHAPTER_TIMESCALE)
+
+    # Each chapter lasts until the next one starts, the last until the end
+    starts = [max(round(c["start"] * CHAPTER_TIMESCALE), 0) for c in chapters]
+    starts[0] = 0
+    ends = starts[1:] + [max(total, starts[-1])]
+    durations = [max(end - start, 0) for start, end in zip(starts, ends)]
+
+    tkhd = full_box(
+        b"tkhd",
+        0,
+        TKHD_IN_MOVIE,
+        struct.pack(
+            ">IIIII8xhhhh", 0, 0, new_id, 0, min(duration, 0xFFFFFFFF), 0, 0, 0, 0
+        )
+        + IDENTITY_MATRIX
+        + struct.pack(">II", 0, 0),
+    )
+    mdhd = full_box(
+        b"mdhd",
+        0,
+        0,
+        struct.pack(">IIIIHH", 0, 0, CHAPTER_TIMESCALE, total, 0x55C4, 0),
+    )
+    hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"text") + b"Chapters\0")
+
+    # Generic media header with the extra atom QuickTime expects for text
+    gmin = full_box(b"gmin", 0, 0, struct.pack(">HHHHhH", 0x40, *[0x8000] * 3, 0, 0))
+    text = box(
+        b"text", struct.pack(">H3IL3I", 1, 0, 0, 0, 1, 0, 0, 0) + b"\0\0\x40\0\0\0"
+    )
+    gmhd = box(b"gmhd", gmin + text)
+    dinf = box(
+        b"dinf",
+        full_box(b"dref", 0, 0, struct.pack(">I", 1) + full_box(b"url ", 0, 1, b"")),
+    )
+
+    # Text sample description with default display settings
+    text_entry = box(b"text", struct.pack(">6xHII", 1, 0, 1) + bytes(36))
+    stsd = full_box(b"stsd", 0, 0, struct.pack(">I", 1) + text_entry)
+    stts = full_box(
+        b"stts",
+        0,
+        0,
+        struct.pack(
+            f">I{len(durations) * 2}I",
+            len(durations),
+            *[v for d in durations for v in (1, d)],
+        ),
+    )
+    # All samples are stored back to back in a single chunk
+    stsc = full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, len(samples), 1))
+    stsz = full_box(
+        b"stsz",
+        0,
+        0,
+        struct.pack(f">II{len(samples)}I", 0, len(samples), *[len(s) for s in samples]),
+    )
+    if data_offset > 0xFFFFFFFF:
+        stco = full_box(b"co64", 0, 0, struct.pack(">IQ", 1, data_offset))
+    else:
+        stco = full_box(b"stco", 0, 0, struct.pack(">II", 1, data_offset))
+
+    stbl = box(b"stbl", stsd + stts + stsc + stsz + stco)
+    minf = box(b"minf", gmhd + dinf + stbl)
+    mdia = box(b"mdia", mdhd + hdlr + minf)
+
+    return parse_boxes(box(b"trak", tkhd + mdia))[0]
+
+
+# Builds a Nero chapter list, which many players read instead of the chapter track
+def chpl_box(chapters):
+    entries = b""
+    for chapter in chapters[:255]:
+        title = chapter["title"].encode("utf-8")[:255]
+        title = title.decode("utf-8", "ignore").encode("utf-8")
+        start = max(round(chapter["start"] * 10_000_000), 0)
+        entries += struct.pack(">QB", start, len(title)) + title
+
+    payload = struct.pack(">IB", 0, len(chapters[:255])) + entries
+    return parse_box(b"chpl", full_box(b"chpl", 1, 0, payload)[8:])
+
+
+# Replaces the chapter track and chpl list, returning the chapter text data
+def set_chapters(moov, chapters, data_offset):
+    audio, _ = remove_chapter_tracks(moov)
+    udta = child(moov, b"udta", {"type": b"udta", "prefix": b"", "children": []})
+    remove_children(udta, b"chpl")
+    if not chapters:
+        return b""
+
+    chapters = sorted(chapters, key=lambda c: c["start"])
+    samples = chapter_samples(chapters)
+
+    # Use the first unused track id and point the audio track at it
+    mvhd = child(moov, b"mvhd")
+    new_id = max(track_id(trak) for trak in children(moov, b"trak")) + 1
+    next_id = max(struct.unpack(">I", mvhd["data"][-4:])[0], new_id + 1)
+    mvhd["data"] = mvhd["data"][:-4] + struct.pack(">I", next_id)
+
+    tref = child(audio, b"tref", {"type": b"tref", "prefix": b"", "children": []})
+    tref["children"].append({"type": b"chap", "data": struct.pack(">I", new_id)})
+
+    timing = movie_timing(moov)
+    trak = chapter_track(chapters, samples, new_id, timing, data_offset)
+    moov["children"].append(trak)
+    udta["children"].insert(0, chpl_box(chapters))
+
+    return b"".join(samples)
+
+
+# Replaces iTunes-style tags and the cover in udta/meta/ilst
+def set_tags(moov, tags, cover):
+    udta = child(moov, b"udta", {"type": b"udta", "prefix": b"", "children": []})
+    hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I4s4s8x", 0, b"mdir", b"appl") + b"\0")
+    meta = child(
+        udta,
+        b"meta",
+        {"type": b"meta", "prefix": bytes(4), "children": parse_boxes(hdlr)},
+    )
+    ilst = child(meta, b"ilst", {"type": b"ilst", "prefix": b"", "children": []})
+
+    for key, value in (tags or {}).items():
+        atom = TAG_ATOMS[key]
+        remove_children(ilst, atom)
+        if value:
+            data = struct.pack(">II", DATA_UTF8, 0) + str(value).encode("utf-8")
+            ilst["children"].append({"type": atom, "data": box(b"data", data)})
+
+    if cover:
+        data_type = DATA_PNG if cover.startswith(b"\x89PNG") else DATA_JPEG
+        remove_children(ilst, b"covr")
+        data = struct.pack(">II", data_type, 0) + cover
+        ilst["children"].append({"type": b"covr", "data": box(b"data", data)})
+
+
+# Reads the moov box of an MP4 file
+def read_moov(f):
+    size = os.fstat(f.fileno()).st_size
+    for kind, body_start, body_end in iter_boxes(f, 0, size):
+        if kind == b"moov":
+            f.seek(body_start)
+            return parse_box(kind, f.read(body_end - body_start))
+
+    raise ValueError("No moov box found")
+
+
+# Reads the iTunes-style text tags of an MP4 file, by ffmpeg metadata key
+def read_tags(path):
+    with open(path, "rb") as f:
+        moov = read_moov(f)
+
+    return moov_tags(moov)
+
+
+# Gets the iTunes-style text tags of a parsed moov box
+def moov_tags(moov):
+    udta = child(moov, b"udta")
+    meta = child(udta, b"meta") if udta else None
+    ilst = child(meta, b"ilst") if meta else None
+    if not ilst:
+        return {}
+
+    keys = {atom: key for key, atom in TAG_ATOMS.items()}
+    tags = {}
+    for item in ilst["children"]:
+        data = item["data"]
+        if item["type"] in keys and data[4:8] == b"data":
+            if struct.unpack(">I", data[8:12])[0] == DATA_UTF8:
+                tags[keys[item["type"]]] = data[16:].decode("utf-8", "replace")
+
+    return tags
+
+
+# Gets the cover image of a parsed moov box, or None if it has none
+def moov_cover(moov):
+    udta = child(moov, b"udta")
+    meta = child(udta, b"meta") if udta else None
+    ilst = child(meta, b"ilst") if meta else None
+    covers = children(ilst, b"covr") if ilst else []
+    if not covers or covers[0]["data"][4:8] != b"data":
+        return None
+
+    # Only the first image is used if there are several
+    data = covers[0]["data"]
+    return data[16 : struct.unpack(">I", data[:4])[0]]
+
+
+# Checks if a parsed moov box has a cover image
+def has_cover(moov):
+    return moov_cover(moov) is not None
+
+
+# Gets the file offset of every sample from the boxes of a sample table
+def sample_offsets(tables, sizes):
+    width = "I" if b"stco" in tables else "Q"
+    stco = tables.get(b"stco") or tables[b"co64"]
+    count = struct.unpack(">I", stco[4:8])[0]
+    chunks = struct.unpack(
+        f">{count}{width}", stco[8 : 8 + count * struct.calcsize(width)]
+    )
+
+    stsc = tables[b"stsc"]
+    entries = [
+        struct.unpack(">III", stsc[8 + i * 12 : 20 + i * 12])
+        for i in range(struct.unpack(">I", stsc[4:8])[0])
+    ]
+
+    offsets = []
+    for i, (first, per_chunk, _) in enumerate(entries):
+        last = entries[i + 1][0] - 1 if i + 1 < len(entries) else len(chunks)
+        for chunk in range(first, last + 1):
+            offset = chunks[chunk - 1]
+            for size in sizes[len(offsets) : len(offsets) + per_chunk]:
+                offsets.append(offset)
+                offset += size
+
+    return offsets
+
+
+# Reads the chapters of a QuickTime chapter track, or None if there isn't one
+def read_chapter_track(f, moov):
+    chapter_ids = set()
+    for trak in children(moov, b"trak"):
+        tref = child(trak, b"tref")
+        for chap in children(tref, b"chap") if tref else []:
+            chapter_ids.update(
+                struct.unpack(f">{len(chap['data']) // 4}I", chap["data"])
+            )
+
+    for trak in children(moov, b"trak"):
+        if track_id(trak) not in chapter_ids or track_handler(trak) != b"text":
+            continue
+
+        mdia = child(trak, b"mdia")
+        mdhd = child(mdia, b"mdhd")["data"]
+        timescale = struct.unpack(">I", mdhd[20:24] if mdhd[0] == 1 else mdhd[12:16])[0]
+        # stbl isn't split into children, so split it here
+        stbl = child(child(mdia, b"minf"), b"stbl")
+        tables = {table["type"]: table["data"] for table in parse_boxes(stbl["data"])}
+
+        stts = tables[b"stts"]
+        deltas = []
+        for i in range(struct.unpack(">I", stts[4:8])[0]):
+            count, delta = struct.unpack(">II", stts[8 + i * 8 : 16 + i * 8])
+            deltas += [delta] * count
+
+        stsz = tables[b"stsz"]
+        sample_size, count = struct.unpack(">II", stsz[4:12])
+        sizes = [sample_size] * count
+        if not sample_size:
+            sizes = list(struct.unpack(f">{count}I", stsz[12 : 12 + count * 4]))
+
+        chapters = []
+        start = 0
+        for offset, size, delta in zip(sample_offsets(tables, sizes), sizes, deltas):
+            f.seek(offset)
+            sample = f.read(size)
+            length = struct.unpack(">H", sample[:2])[0] if len(sample) >= 2 else 0
+            title = sample[2 : 2 + length]
+            if title.startswith((b"\xfe\xff", b"\xff\xfe")):
+                title = title.decode("utf-16", "replace")
+            else:
+                title = title.decode("utf-8", "replace")
+
+            chapters.append({"title": title, "start": start / timescale})
+            start += delta
+
+        return chapters
+
+    return None
+
+
+# Reads the chapters of a Nero chpl list
+def read_chpl(moov):
+    udta = child(moov, b"udta")
+    chpl = child(udta, b"chpl") if udta else None
+    if not chpl:
+        return []
+
+    data = chpl["data"]
+    offset = 9 if data[0] == 1 else 5
+    chapters = []
+    for _ in range(data[offset - 1]):
+        start, length = struct.unpack(">QB", data[offset : offset + 9])
+        title = data[offset + 9 : offset + 9 + length].decode("utf-8", "replace")
+        chapters.append({"title": title, "start": start / 10_000_000})
+        offset += 9 + length
+
+    return chapters
+
+
+# Gets the chapters of a parsed moov box, from its chapter track or else its
+# chpl list, with each one ending where the next starts
+def moov_chapters(f, moov):
+    chapters = read_chapter_track(f, moov)
+    if chapters is None:
+        chapters = read_chpl(moov)
+
+    timescale, duration = movie_timing(moov)
+    ends = [chapter["start"] for chapter in chapters[1:]] + [duration / timescale]
+    for chapter, end in zip(chapters, ends):
+        chapter["end"] = max(end, chapter["start"])
+
+    return chapters
+
+
+# Reads the chapters of an MP4 file, in seconds
+def read_chapters(path):
+    with open(path, "rb") as f:
+        return moov_chapters(f, read_moov(f))
+
+
+# Builds the new moov, and the chapter text mdat if chapters are replaced.
+# The chapter text offset can depend on the size of moov, so it's a function
+def build_moov(moov_data, chapters, tags, cover, chapter_offset):
+    offset = chapter_offset(len(moov_data))
+    while True:
+        moov = parse_boxes(moov_data)[0]
+        chapter_data = b""
+        if chapters is not None:
+            chapter_data = set_chapters(moov, chapters, offset)
+        if tags or cover:
+            set_tags(moov, tags, cover)
+
+        data = serialize(moov)
+        if not chapter_data or offset == chapter_offset(len(data)):
+            break
+        offset = chapter_offset(len(data))
+
+    return data, box(b"mdat", chapter_data) if chapter_data else b""
+
+
+# Rewrites the chapters, tags and cover of an MP4 file without touching its audio.
+# The file is laid out as moov, free padding, then the chapter text mdat
+def write_metadata(path, chapters=None, tags=None, cover=None):
+    with span("write_metadata", file=path), open(path, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        boxes = []
+        start = 0
+        for kind, _, end in iter_boxes(f, 0, size):
+            boxes.append((kind, start, end))
+            start = end
+
+        moov_index = next((i for i, b in enumerate(boxes) if b[0] == b"moov"), None)
+        if moov_index is None:
+            raise ValueError("No moov box found")
+        _, moov_start, moov_end = boxes[moov_index]
+        f.seek(moov_start)
+        moov_data = f.read(moov_end - moov_start)
+
+        # Free space after moov can be reused, and so can the old chapter
+        # text if the chapters are being replaced
+        old_offset = None
+        if chapters is not None:
+            old_offset = remove_chapter_tracks(parse_boxes(moov_data)[0])[1]
+
+        region_end = moov_end
+        for kind, start, end in boxes[moov_index + 1 :]:
+            chapter_data = (
+                kind == b"mdat"
+                and old_offset is not None
+                and start <= old_offset < end
+                and end - start <= MAX_CHAPTER_DATA
+            )
+            if kind not in FREE_TYPES and not chapter_data:
+                break
+            region_end = end
+
+        # Chapter text is written after the padding that follows moov, or at
+        # the end of the old space when rewriting in place
+        chapter_size = 0
+        if chapters:
+            samples = chapter_samples(sorted(chapters, key=lambda c: c["start"]))
+            chapter_size = 8 + sum(len(sample) for sample in samples)
+
+        def after_padding(start):
+            return lambda moov_size: start + moov_size + PADDING + 8
+
+        padding = box(b"free", bytes(PADDING - 8))
+        if region_end >= size:
+            # moov is already at the end, so the file can grow or shrink
+            moov, chapter_mdat = build_moov(
+                moov_data, chapters, tags, cover, after_padding(moov_start)
+            )
+            f.seek(moov_start)
+            f.write(moov + padding + chapter_mdat)
+            f.truncate()
+            return
+
+        region = region_end - moov_start
+        offset = region_end - chapter_size + 8
+        moov, chapter_mdat = build_moov(
+            moov_data, chapters, tags, cover, lambda moov_size: offset
+        )
+        gap = region - len(moov) - chapter_size
+        if gap == 0 or gap >= 8:
+            f.seek(moov_start)
+            f.write(moov)
+            if gap:
+                f.write(box(b"free", bytes(gap - 8)))
+            f.write(chapter_mdat)
+            return
+
+        # Move moov to the end, only freeing the old one once the new one is written
+        moov, chapter_mdat = build_moov(
+            moov_data, chapters, tags, cover, after_padding(size)
+        )
+        f.seek(size)
+        f.write(moov + padding + chapter_mdat)
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(moov_start)
+        f.write(struct.pack(">I4s", region, b"free"))
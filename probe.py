@@ -0,0 +1,554 @@
+from concurrent.futures import ThreadPoolExecutor
+from timing import span
+import subprocess as sp
+import struct
+import json
+import mmap
+import os
+import re
+
+# MPEG audio bitrates in kbps, indexed by [mpeg1][layer]
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# MPEG audio sample rates, indexed by the version bits of the frame header
+MP3_SAMPLE_RATES = {
+    0: [11025, 12000, 8000],  # MPEG 2.5
+    2: [22050, 24000, 16000],  # MPEG 2
+    3: [44100, 48000, 32000],  # MPEG 1
+}
+
+# Number of files to read or probe at once
+PROBE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Number of frames to check before assuming an MP3 is constant bitrate
+MP3_CBR_SCAN_FRAMES = 64
+
+# Codec names ffprobe uses for MPEG audio layers
+MP3_CODECS = {1: "mp1", 2: "mp2", 3: "mp3"}
+
+# Sample rates of AAC, indexed by the frequency index of its AudioSpecificConfig
+AAC_SAMPLE_RATES = [
+    96000,
+    88200,
+    64000,
+    48000,
+    44100,
+    32000,
+    24000,
+    22050,
+    16000,
+    12000,
+    11025,
+    8000,
+    7350,
+]
+
+# Channel counts of AAC channel configurations, where 0 means it's given elsewhere
+AAC_CHANNELS = [0, 1, 2, 3, 4, 5, 6, 8]
+
+# Profile names ffprobe uses for AAC audio object types
+AAC_PROFILES = {1: "Main", 2: "LC", 3: "SSR", 4: "LTP", 5: "HE-AAC", 29: "HE-AACv2"}
+
+# MPEG-4 object types that hold AAC audio
+AAC_OBJECT_TYPES = (0x40, 0x66, 0x67, 0x68)
+
+# Codec names ffprobe uses for WAV sample formats, by format code and bit depth
+WAV_CODECS = {
+    (1, 8): "pcm_u8",
+    (1, 16): "pcm_s16le",
+    (1, 24): "pcm_s24le",
+    (1, 32): "pcm_s32le",
+    (3, 32): "pcm_f32le",
+    (3, 64): "pcm_f64le",
+}
+WAV_EXTENSIBLE = 0xFFFE
+
+
+# Parses an MPEG audio frame header, or returns None if it isn't one
+def parse_mp3_header(data, offset):
+    if (
+        offset + 4 > len(data)
+        or data[offset] != 0xFF
+        or data[offset + 1] & 0xE0 != 0xE0
+    ):
+        return None
+
+    version = (data[offset + 1] >> 3) & 3
+    layer = 4 - ((data[offset + 1] >> 1) & 3)
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (data[offset + 2] >> 1) & 1
+    mono = data[offset + 3] >> 6 == 3
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    # Size of the layer III side info that precedes a Xing/Info header
+    side_info = (32 if not mono else 17) if mpeg1 else (17 if not mono else 9)
+
+    return {
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "channels": 1 if mono else 2,
+        "samples": samples,
+        "length": length,
+        "side_info": side_info,
+    }
+
+
+# Finds where the frames of an MP3 file start and end, skipping its ID3 tags.
+# Returns the first frame that is followed by another valid frame, its header
+# and the end of the audio, or None if there isn't one
+def mp3_first_frame(data):
+    # Skip ID3v2 tags
+    start = 0
+    while data[start : start + 3] == b"ID3" and len(data) >= start + 10:
+        size = 0
+        for byte in data[start + 6 : start + 10]:
+            size = (size << 7) | (byte & 0x7F)
+        start += 10 + size + (10 if data[start + 5] & 0x10 else 0)
+
+    # Skip ID3v1 tag
+    end = len(data)
+    if end >= 128 and data[end - 128 : end - 125] == b"TAG":
+        end -= 128
+
+    # Find the first frame that is followed by another valid frame
+    offset = start
+    limit = min(end, start + 65536)
+    while offset < limit:
+        offset = data.find(b"\xff", offset, limit)
+        if offset == -1:
+            return None
+
+        header = parse_mp3_header(data, offset)
+        if header and (
+            offset + header["length"] >= end
+            or parse_mp3_header(data, offset + header["length"])
+        ):
+            break
+        offset += 1
+    else:
+        return None
+
+    return offset, header, end
+
+
+# Reads the duration of an MP3 file from its Xing/Info/VBRI header or frames
+def mp3_duration(data):
+    first = mp3_first_frame(data)
+    if not first:
+        return None
+    offset, header, end = first
+
+    # Use the frame count from a Xing/Info or VBRI header
+    xing = offset + 4 + header["side_info"]
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4 : xing + 8])[0]
+        if flags & 1:
+            frames = struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+            return frames * header["samples"] / header["sample_rate"]
+
+    vbri = offset + 36
+    if data[vbri : vbri + 4] == b"VBRI":
+        frames = struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+        return frames * header["samples"] / header["sample_rate"]
+
+    # Count frames, stopping early if the first ones share a bitrate
+    frames = 0
+    samples = 0
+    position = offset
+    constant = True
+    while position < end:
+        frame = parse_mp3_header(data, position)
+        if not frame:
+            break
+        if frame["bitrate"] != header["bitrate"]:
+            constant = False
+        if constant and frames == MP3_CBR_SCAN_FRAMES:
+            return (end - offset) * 8 / header["bitrate"]
+
+        frames += 1
+        samples += frame["samples"]
+        position += frame["length"]
+
+    return samples / header["sample_rate"] if frames else None
+
+
+# Iterates over the MP4 boxes between two offsets of a file
+def iter_boxes(f, start, end):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+# Finds the first MP4 box along a path of box types
+def find_box(f, start, end, path):
+    for kind, body_start, body_end in iter_boxes(f, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return body_start, body_end
+            found = find_box(f, body_start, body_end, path[1:])
+            if found:
+                return found
+
+    return None
+
+
+# Reads the timescale and duration of an mvhd/mdhd box
+def read_media_header(f, box):
+    f.seek(box[0])
+    version = f.read(4)[0]
+    if version == 1:
+        f.seek(16, os.SEEK_CUR)
+        timescale, duration = struct.unpack(">IQ", f.read(12))
+    else:
+        f.seek(8, os.SEEK_CUR)
+        timescale, duration = struct.unpack(">II", f.read(8))
+
+    return duration / timescale if timescale else None
+
+
+# Reads the duration of an MP4/M4A/M4B file from its mvhd or mdhd box
+def mp4_duration(f, size):
+    moov = find_box(f, 0, size, [b"moov"])
+    if not moov:
+        return None
+
+    mvhd = find_box(f, *moov, [b"mvhd"])
+    duration = read_media_header(f, mvhd) if mvhd else None
+    if not duration:
+        mdhd = find_box(f, *moov, [b"trak", b"mdia", b"mdhd"])
+        duration = read_media_header(f, mdhd) if mdhd else None
+
+    return duration
+
+
+# Reads the duration of a WAV file from its fmt and data chunks
+def wav_duration(f, size):
+    byte_rate = None
+    offset = 12
+    while offset + 8 <= size:
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack("<8xI", f.read(12))[0]
+        elif chunk_id == b"data":
+            # Streamed WAVs may leave the data size unset
+            data_size = min(chunk_size, size - offset - 8)
+            return data_size / byte_rate if byte_rate else None
+
+        offset += 8 + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+# Gets the audio stream of an MP3 file from its first frame
+def mp3_stream(data):
+    first = mp3_first_frame(data)
+    if not first:
+        return None
+
+    header = first[1]
+    return {
+        "codec_name": MP3_CODECS[header["layer"]],
+        "sample_rate": str(header["sample_rate"]),
+        "channels": header["channels"],
+    }
+
+
+# Reads the length of an MP4 descriptor, stored 7 bits per byte
+def descriptor_length(data, offset):
+    length = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+
+    return length, offset
+
+
+# Gets the codec, profile, sample rate and channels of AAC audio from its
+# esds box, or None if it isn't AAC
+def esds_stream(data, entry_channels):
+    offset = 4
+    config = None
+    object_type = None
+    while offset + 2 <= len(data):
+        tag = data[offset]
+        length, offset = descriptor_length(data, offset + 1)
+        if tag == 3:
+            # ES descriptor, which holds the others after its optional fields
+            flags = data[offset + 2]
+            offset += 3
+            if flags & 0x80:
+                offset += 2
+            if flags & 0x40:
+                offset += 1 + data[offset]
+            if flags & 0x20:
+                offset += 2
+        elif tag == 4:
+            # Decoder config, followed by the decoder specific info
+            object_type = data[offset]
+            offset += 13
+        elif tag == 5:
+            config = data[offset : offset + length]
+            break
+        else:
+            offset += length
+
+    if object_type not in AAC_OBJECT_TYPES or not config or len(config) < 2:
+        return None
+
+    # The AudioSpecificConfig starts with the object type, sample rate and
+    # channel layout, with escape values for longer fields
+    bits = int.from_bytes(config[:8].ljust(8, b"\0"), "big")
+    position = 64
+
+    def read(count):
+        nonlocal position
+        position -= count
+        return bits >> position & ((1 << count) - 1)
+
+    audio_object_type = read(5)
+    if audio_object_type == 31:
+        audio_object_type = 32 + read(6)
+    frequency_index = read(4)
+    if frequency_index == 15:
+        sample_rate = read(24)
+    elif frequency_index < len(AAC_SAMPLE_RATES):
+        sample_rate = AAC_SAMPLE_RATES[frequency_index]
+    else:
+        return None
+
+    channel_config = read(4)
+    channels = AAC_CHANNELS[channel_config] if channel_config < 8 else 0
+    if audio_object_type not in AAC_PROFILES:
+        return None
+
+    return {
+        "codec_name": "aac",
+        "profile": AAC_PROFILES[audio_object_type],
+        "sample_rate": str(sample_rate),
+        "channels": channels or entry_channels,
+    }
+
+
+# Gets the first audio stream of an MP4 file from its sample description,
+# or None if it isn't AAC or can't be read
+def mp4_stream(f, size):
+    moov = find_box(f, 0, size, [b"moov"])
+    if not moov:
+        return None
+
+    for kind, trak_start, trak_end in iter_boxes(f, *moov):
+        if kind != b"trak":
+            continue
+
+        hdlr = find_box(f, trak_start, trak_end, [b"mdia", b"hdlr"])
+        if not hdlr:
+            continue
+        f.seek(hdlr[0] + 8)
+        if f.read(4) != b"soun":
+            continue
+
+        stsd = find_box(f, trak_start, trak_end, [b"mdia", b"minf", b"stbl", b"stsd"])
+        if not stsd:
+            return None
+
+        # The first sample entry, with the QuickTime sound fields that come
+        # before its child boxes in version 1
+        f.seek(stsd[0] + 8)
+        entry_size, entry_type = struct.unpack(">I4s", f.read(8))
+        entry = f.read(entry_size - 8)
+        version, channels = struct.unpack(">H6xH", entry[8:18])
+        if entry_type != b"mp4a" or version > 1:
+            return None
+
+        boxes_start = 28 + (16 if version == 1 else 0)
+        offset = boxes_start
+        while offset + 8 <= len(entry):
+            box_size, box_type = struct.unpack(">I4s", entry[offset : offset + 8])
+            if box_type == b"esds":
+                return esds_stream(entry[offset + 8 : offset + box_size], channels)
+            if box_size < 8:
+                break
+            offset += box_size
+
+        return None
+
+    return None
+
+
+# Gets the audio stream of a WAV file from its fmt chunk
+def wav_stream(f, size):
+    offset = 12
+    while offset + 8 <= size:
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size)
+            audio_format, channels, sample_rate = struct.unpack("<HHI", fmt[:8])
+            bits = struct.unpack("<H", fmt[14:16])[0]
+            if audio_format == WAV_EXTENSIBLE and len(fmt) >= 26:
+                audio_format = struct.unpack("<H", fmt[24:26])[0]
+
+            codec = WAV_CODECS.get((audio_format, bits))
+            if not codec:
+                return None
+            return {
+                "codec_name": codec,
+                "sample_rate": str(sample_rate),
+                "channels": channels,
+            }
+
+        offset += 8 + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+# Reads the audio stream of a file from its headers, in the same form as
+# probe_audio, or None if it can't
+def read_stream(file):
+    try:
+        with open(file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            magic = f.read(12)
+            if len(magic) < 12:
+                return None
+
+            if magic[:4] == b"RIFF" and magic[8:12] == b"WAVE":
+                return wav_stream(f, size)
+            if magic[4:8] == b"ftyp":
+                return mp4_stream(f, size)
+            if magic[:3] == b"ID3" or magic[0] == 0xFF:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return mp3_stream(data)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+    return None
+
+
+# Reads the duration of an audio file from its headers, or None if it can't
+def read_duration(file):
+    try:
+        with open(file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            magic = f.read(12)
+            if len(magic) < 12:
+                return None
+
+            if magic[:4] == b"RIFF" and magic[8:12] == b"WAVE":
+                return wav_duration(f, size)
+            if magic[4:8] == b"ftyp":
+                return mp4_duration(f, size)
+            if magic[:3] == b"ID3" or magic[0] == 0xFF:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return mp3_duration(data)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+    return None
+
+
+# Get duration of audio file with ffprobe
+def ffprobe_duration(file):
+    cmd = (
+        "ffprobe -v error -show_entries format=duration "
+        f'-of default=noprint_wrappers=1:nokey=1 "{file}"'
+    )
+    with span("ffprobe", file=file, entries="duration"):
+        result = sp.run(cmd, shell=True, capture_output=True, text=True)
+
+    return float(result.stdout.strip())
+
+
+# Get codec, profile, sample rate and channels of the first audio stream
+def probe_audio(file):
+    cmd = (
+        "ffprobe -v error -select_streams a:0 "
+        "-show_entries stream=codec_name,profile,sample_rate,channels "
+        f'-of json "{file}"'
+    )
+    with span("ffprobe", file=file, entries="stream"):
+        result = sp.run(cmd, shell=True, capture_output=True, text=True)
+    streams = json.loads(result.stdout or "{}").get("streams", [])
+
+    return streams[0] if streams else None
+
+
+# Measure the EBU R128 integrated loudness of an audio file in LUFS, or None if
+# it has no audio
+def measure_loudness(file):
+    cmd = (
+        f'ffmpeg -hide_banner -nostdin -nostats -i "{file}" -map 0:a:0 '
+        "-af ebur128=framelog=quiet -f null -"
+    )
+    with span("measure_loudness", file=file) as details:
+        result = sp.run(
+            cmd, shell=True, capture_output=True, text=True, errors="replace"
+        )
+        matches = re.findall(r"^\s*I:\s+(-?[\d.]+|-inf) LUFS", result.stderr, re.M)
+        if result.returncode != 0 or not matches or matches[-1] == "-inf":
+            return None
+
+        details["loudness"] = float(matches[-1])
+        return float(matches[-1])
+
+
+# Get the first audio stream of a file, only starting ffprobe if the headers
+# can't be read
+def get_stream(file):
+    with span("get_stream", file=file) as details:
+        stream = read_stream(file)
+        details["source"] = "header" if stream is not None else "ffprobe"
+
+        return stream if stream is not None else probe_audio(file)
+
+
+# Get duration of audio file, only starting ffprobe if the headers can't be read
+def get_duration(file):
+    with span("get_duration", file=file) as details:
+        duration = read_duration(file)
+        details["source"] = "header" if duration is not None else "ffprobe"
+
+        return duration if duration is not None else ffprobe_duration(file)
+
+
+# Get durations of several audio files concurrently
+def get_durations(files, jobs=None):
+    with ThreadPoolExecutor(max_workers=jobs or PROBE_WORKERS) as executor:
+        return list(executor.map(get_duration, files))
@@ -0,0 +1,93 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import threading
+import sqlite3
+import time
+import os
+
+# Location and size limit of the shared response cache
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "audiobooktools",
+)
+CACHE_FILE = os.path.join(CACHE_DIR, "responses.sqlite")
+MAX_CACHE_BYTES = 256 << 20
+
+# How long responses stay fresh, in seconds
+DAY = 24 * 60 * 60
+SEARCH_TTL = DAY  # Catalog searches, which change as books are added
+METADATA_TTL = 30 * DAY  # Book details and chapters, which rarely change
+
+connection = None
+lock = threading.Lock()
+
+
+# Normalizes a URL so equivalent requests share a cache entry
+def normalize_url(url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, "")
+    )
+
+
+# Opens the cache database, creating it if needed
+def open_cache():
+    global connection
+    if connection is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        connection = sqlite3.connect(
+            CACHE_FILE, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, "
+            "fetched REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+
+    return connection
+
+
+# Gets a cached response, or None if it's missing or older than the ttl
+def load(url, ttl=None):
+    key = normalize_url(url)
+    with lock:
+        db = open_cache()
+        row = db.execute(
+            "SELECT body, fetched FROM responses WHERE url = ?", (key,)
+        ).fetchone()
+        if row is None or (ttl is not None and time.time() - row[1] > ttl):
+            return None
+
+        db.execute(
+            "UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), key)
+        )
+        return row[0]
+
+
+# Saves a response, evicting the least recently used ones if over the size cap
+def save(url, body):
+    key = normalize_url(url)
+    now = time.time()
+    with lock:
+        db = open_cache()
+        db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, body, len(body), now, now),
+        )
+
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= MAX_CACHE_BYTES:
+            return
+
+        rows = db.execute(
+            "SELECT url, size FROM responses ORDER BY accessed"
+        ).fetchall()
+        for old_key, size in rows:
+            db.execute("DELETE FROM responses WHERE url = ?", (old_key,))
+            total -= size
+            if total <= MAX_CACHE_BYTES:
+                break
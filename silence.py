@@ -0,0 +1,281 @@
+import subprocess as sp
+import hashlib
+import json
+import time
+import os
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Width of the progress line, so silence lines can overwrite it
+PROGRESS_WIDTH = 72
+
+# Silences up to this much longer than --max still count as chapter breaks
+MAX_TOLERANCE = 0.25
+
+# Decoding settings for the NumPy engine
+SAMPLE_RATE = 8000
+FRAME_SECONDS = 0.01
+FRAME_SAMPLES = int(SAMPLE_RATE * FRAME_SECONDS)
+CHUNK_FRAMES = 6000  # 60 seconds of audio per chunk
+
+# Level caches are stored next to the audiobook as .<name>.levels
+CACHE_SUFFIX = ".levels"
+HASH_BLOCK = 1 << 20
+
+
+# Prints how far silence detection has got and how fast it is going
+def print_progress(position, speed, total_duration):
+    progress = f"{position / 3600:.2f}h"
+    if total_duration:
+        progress += f" of {total_duration / 3600:.2f}h"
+        progress += f" ({position / total_duration * 100:.0f}%)"
+
+    line = f"Decoded {progress} at {speed:.1f}x realtime"
+    print(f"\r{line}".ljust(PROGRESS_WIDTH), end="", flush=True)
+
+
+# Checks whether a silence is long enough, but not too long, to be a chapter break
+def keep_silence(silence, min_silence, max_silence):
+    return min_silence <= silence["duration"] <= max_silence + MAX_TOLERANCE
+
+
+# Starts ffmpeg so that Ctrl+C only reaches this script, which stops ffmpeg itself
+def start_ffmpeg(cmd, **kwargs):
+    return sp.Popen(cmd, shell=True, start_new_session=True, **kwargs)
+
+
+# Stops ffmpeg if detection was cancelled before it finished
+def stop_ffmpeg(process):
+    if process.poll() is None:
+        process.terminate()
+    process.wait()
+
+
+# Runs ffmpeg silencedetect and yields each silence as soon as it is found
+def ffmpeg_silences(input_file, noise_level, min_silence, total_duration=None):
+    cmd = (
+        f'ffmpeg -hide_banner -nostdin -i "{input_file}" '
+        f"-af silencedetect=n={noise_level}dB:d={min_silence} -f null -"
+    )
+
+    # ffmpeg ends progress lines with \r, which text mode also splits on
+    process = start_ffmpeg(cmd, stderr=sp.PIPE, text=True, errors="replace")
+    try:
+        for line in process.stderr:
+            if "silence_start" in line:
+                start_time = float(line.split()[-1])
+            elif "silence_end" in line:
+                end_time = float(line.split()[4])
+                duration = float(line.split()[7])
+                yield {"start": start_time, "end": end_time, "duration": duration}
+            elif "speed=" in line:
+                match = re.search(
+                    r"time=(\d+):(\d+):([\d.]+).*speed=\s*([\d.]+)x", line
+                )
+                if match:
+                    hh, mm, ss, speed = match.groups()
+                    position = int(hh) * 3600 + int(mm) * 60 + float(ss)
+                    print_progress(position, float(speed), total_duration)
+    finally:
+        stop_ffmpeg(process)
+
+    if process.returncode != 0:
+        raise sp.CalledProcessError(process.returncode, cmd)
+
+
+# Decodes audio to low-rate mono PCM and yields the level of each frame in dB
+def decode_levels(input_file, total_duration=None):
+    cmd = (
+        f'ffmpeg -v error -nostdin -i "{input_file}" '
+        f"-map 0:a:0 -ac 1 -ar {SAMPLE_RATE} -f s16le -"
+    )
+    chunk_bytes = CHUNK_FRAMES * FRAME_SAMPLES * 2
+
+    process = start_ffmpeg(cmd, stdout=sp.PIPE)
+    try:
+        started = time.perf_counter()
+        frames = 0
+        while data := process.stdout.read(chunk_bytes):
+            samples = np.frombuffer(data, dtype="<i2")
+            samples = samples[: len(samples) // FRAME_SAMPLES * FRAME_SAMPLES]
+            samples = samples.reshape(-1, FRAME_SAMPLES).astype(np.float32) / 32768
+
+            rms = np.sqrt(np.mean(samples**2, axis=1))
+            yield 20 * np.log10(np.maximum(rms, 1e-10))
+
+            frames += len(rms)
+            position = frames * FRAME_SECONDS
+            speed = position / max(time.perf_counter() - started, 1e-6)
+            print_progress(position, speed, total_duration)
+    finally:
+        stop_ffmpeg(process)
+
+    if process.returncode != 0:
+        raise sp.CalledProcessError(process.returncode, cmd)
+
+
+# Finds runs of frames below the noise level and yields them as silences
+def level_silences(level_chunks, noise_level, min_silence):
+    frames = 0
+    open_start = None
+    for levels in level_chunks:
+        silent = (levels < noise_level).astype(np.int8)
+        changes = np.diff(silent, prepend=np.int8(open_start is not None))
+
+        starts = np.flatnonzero(changes == 1) + frames
+        ends = np.flatnonzero(changes == -1) + frames
+        if open_start is not None:
+            starts = np.concatenate(([open_start], starts))
+
+        # Starts and ends alternate, so any extra start is still open
+        open_start = starts[-1] if len(starts) > len(ends) else None
+        frames += len(levels)
+
+        for start, end in zip(starts, ends):
+            duration = (end - start) * FRAME_SECONDS
+            if duration >= min_silence:
+                yield {
+                    "start": float(start * FRAME_SECONDS),
+                    "end": float(end * FRAME_SECONDS),
+                    "duration": float(duration),
+                }
+
+    # Close a silence that runs to the end of the file
+    if open_start is not None:
+        duration = (frames - open_start) * FRAME_SECONDS
+        if duration >= min_silence:
+            yield {
+                "start": float(open_start * FRAME_SECONDS),
+                "end": float(frames * FRAME_SECONDS),
+                "duration": float(duration),
+            }
+
+
+# Gets the cache files for an audiobook's levels and their key
+def cache_paths(input_file):
+    folder, name = os.path.split(os.path.abspath(input_file))
+    levels_file = os.path.join(folder, f".{name}{CACHE_SUFFIX}")
+
+    return levels_file, f"{levels_file}.json"
+
+
+# Hashes the size and the start, middle and end of a file
+def content_hash(input_file):
+    size = os.path.getsize(input_file)
+    digest = hashlib.sha1(str(size).encode())
+    with open(input_file, "rb") as f:
+        for offset in (0, size // 2, max(size - HASH_BLOCK, 0)):
+            f.seek(offset)
+            digest.update(f.read(HASH_BLOCK))
+
+    return digest.hexdigest()
+
+
+# Gets the key that cached levels must match to be reused
+def cache_key(input_file):
+    stat = os.stat(input_file)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": content_hash(input_file),
+        "settings": [SAMPLE_RATE, FRAME_SECONDS],
+    }
+
+
+# Removes the cached levels of an audiobook
+def remove_cache(input_file):
+    for cache_file in cache_paths(input_file):
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+
+# Removes cached levels whose audiobook no longer exists
+def evict_orphaned_caches(folder):
+    for entry in os.scandir(folder):
+        if entry.name.startswith(".") and entry.name.endswith(CACHE_SUFFIX):
+            name = entry.name[1 : -len(CACHE_SUFFIX)]
+            if not os.path.exists(os.path.join(folder, name)):
+                remove_cache(os.path.join(folder, name))
+
+
+# Memory-maps the cached levels of an audiobook, removing them if they are stale
+def load_levels(input_file):
+    levels_file, key_file = cache_paths(input_file)
+    try:
+        with open(key_file) as f:
+            key = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Only hash the file again if it was touched without changing size
+    stat = os.stat(input_file)
+    valid = key.get("size") == stat.st_size
+    valid = valid and key.get("settings") == [SAMPLE_RATE, FRAME_SECONDS]
+    if valid and key.get("mtime") != stat.st_mtime:
+        valid = key.get("hash") == content_hash(input_file)
+        if valid:
+            save_key(input_file)
+
+    if not valid or not os.path.isfile(levels_file) or not os.path.getsize(levels_file):
+        remove_cache(input_file)
+        return None
+
+    return np.memmap(levels_file, dtype=np.float16, mode="r")
+
+
+# Writes the key of an audiobook's cached levels
+def save_key(input_file):
+    with open(cache_paths(input_file)[1], "w") as f:
+        json.dump(cache_key(input_file), f)
+
+
+# Saves levels to the cache as they pass through, if they all arrive
+def save_levels(input_file, level_chunks):
+    levels_file, key_file = cache_paths(input_file)
+    temp_file = f"{levels_file}.part"
+    try:
+        with open(temp_file, "wb") as f:
+            for levels in level_chunks:
+                f.write(levels.astype(np.float16).tobytes())
+                yield levels
+
+        os.replace(temp_file, levels_file)
+        save_key(input_file)
+    finally:
+        level_chunks.close()
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+# Yields cached levels in the same chunks they were decoded in
+def cached_level_chunks(levels):
+    for i in range(0, len(levels), CHUNK_FRAMES):
+        yield levels[i : i + CHUNK_FRAMES].astype(np.float32)
+
+
+# Decodes the audio once and finds silences with NumPy instead of silencedetect
+def numpy_silences(
+    input_file, noise_level, min_silence, total_duration=None, use_cache=True
+):
+    levels = None
+    if use_cache:
+        evict_orphaned_caches(os.path.dirname(os.path.abspath(input_file)))
+        levels = load_levels(input_file)
+
+    if levels is not None:
+        print(f"Using cached levels from '{cache_paths(input_file)[0]}'")
+        level_chunks = cached_level_chunks(levels)
+    else:
+        level_chunks = decode_levels(input_file, total_duration)
+        if use_cache:
+            level_chunks = save_levels(input_file, level_chunks)
+
+    try:
+        yield from level_silences(level_chunks, noise_level, min_silence)
+    finally:
+        level_chunks.close()
@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from mp4edit import read_moov, moov_chapters, moov_tags, moov_cover, write_metadata
+from timing import run_ffmpeg, span, start_trace
+import argparse
+import re
+import os
+
+# Characters that can't be in file names on common systems, or would be
+# expanded by the shell inside the quoted ffmpeg command
+UNSAFE_CHARACTERS = re.compile(r'[<>:"/\\|?*$`\x00-\x1f]')
+
+
+# Gets a file name for a chapter, numbered so the files sort in order
+def chapter_filename(number, count, title, extension):
+    title = UNSAFE_CHARACTERS.sub("", title).strip(" .")
+    name = f"{number:0{len(str(count))}d}"
+    return f"{name} - {title}{extension}" if title else f"{name}{extension}"
+
+
+# Cuts one chapter out of an m4b without re-encoding, then gives it the book's
+# tags with the chapter as its title, and the book's cover
+def split_chapter(m4b_file, chapter, out_file, tags, cover):
+    duration = chapter["end"] - chapter["start"]
+    cmd = (
+        f'ffmpeg -v error -ss {chapter["start"]} -i "{m4b_file}" -t {duration} '
+        "-map 0:a -c copy -map_metadata -1 -map_chapters -1 "
+        f'-y "{out_file}"'
+    )
+    run_ffmpeg(cmd, "split_chapter", file=out_file, start=chapter["start"])
+    write_metadata(out_file, tags=tags, cover=cover)
+
+    return out_file
+
+
+# Splits an m4b into a file per chapter, cutting jobs chapters at once. Every
+# chapter is stream-copied, so this is limited by the disk rather than the CPU
+def split_m4b(
+    m4b_file: str, output_dir: str = "", extension: str = ".m4a", jobs: int = None
+) -> list:
+    with open(m4b_file, "rb") as f:
+        moov = read_moov(f)
+        chapters = moov_chapters(f, moov)
+    if not chapters:
+        raise ValueError(f"'{m4b_file}' has no chapters")
+
+    book_tags = moov_tags(moov)
+    cover = moov_cover(moov)
+    output_dir = output_dir or os.path.splitext(m4b_file)[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # The book's title becomes the album of every chapter file
+    album = book_tags.get("album") or book_tags.get("title", "")
+    out_files = []
+    chapter_tags = []
+    for i, chapter in enumerate(chapters):
+        name = chapter_filename(i + 1, len(chapters), chapter["title"], extension)
+        out_files.append(os.path.join(output_dir, name))
+        chapter_tags.append({**book_tags, "title": chapter["title"], "album": album})
+
+    count = len(chapters)
+    print(f"Splitting {count} chapters using {jobs or os.cpu_count()} worker(s)...")
+    with span("split_m4b", file=m4b_file, chapters=count):
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            list(
+                executor.map(
+                    split_chapter,
+                    [m4b_file] * count,
+                    chapters,
+                    out_files,
+                    chapter_tags,
+                    [cover] * count,
+                )
+            )
+
+    print(f"Wrote {count} chapter files to '{output_dir}'")
+    return out_files
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Splits an m4b audiobook into a file per chapter without "
+        "re-encoding, keeping its tags and cover"
+    )
+    parser.add_argument(
+        "-i", "--input", default="", help="Input M4B file", required=True
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="",
+        help="Folder to write the chapter files to (Default: named after the input)",
+    )
+    parser.add_argument(
+        "--extension",
+        default=".m4a",
+        help="Extension of the chapter files (Default: .m4a)",
+        choices=[".m4a", ".m4b"],
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=os.cpu_count(),
+        help="Number of chapters to cut at once (Default: number of cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+
+    split_m4b(os.path.abspath(args.input), args.output, args.extension, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
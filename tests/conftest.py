@@ -0,0 +1,5 @@
+import sys
+import os
+
+# The scripts are run from the repository root, and import each other from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+from mp4edit import box, full_box, IDENTITY_MATRIX
+import struct
+
+# A stand-in for encoded audio, which is never decoded by the code under test
+AUDIO = bytes(range(256)) * 16
+
+
+# Builds an AudioSpecificConfig for an AAC object type, sample rate index and
+# channel configuration
+def aac_config(object_type=2, frequency_index=4, channel_config=2):
+    bits = object_type << 11 | frequency_index << 7 | channel_config << 3
+    return struct.pack(">H", bits)
+
+
+# Builds an esds box holding an AudioSpecificConfig
+def esds(config, object_type=0x40):
+    specific = bytes([5, len(config)]) + config
+    decoder = bytes([4, 13 + len(specific), object_type, 0x15]) + bytes(11) + specific
+    es = bytes([3, 3 + len(decoder) + 3]) + b"\0\1\0" + decoder + bytes([6, 1, 2])
+    return full_box(b"esds", 0, 0, es)
+
+
+# Builds the moov box of a file with one audio track whose only chunk starts
+# at audio_offset
+def audio_moov(audio_offset, duration=60, channels=2, config=None, object_type=0x40):
+    mvhd = full_box(
+        b"mvhd",
+        0,
+        0,
+        struct.pack(">IIIIIH10x", 0, 0, 1000, duration * 1000, 0x10000, 0x100)
+        + IDENTITY_MATRIX
+        + bytes(24)
+        + struct.pack(">I", 2),
+    )
+    tkhd = full_box(
+        b"tkhd",
+        0,
+        7,
+        struct.pack(">IIIII8xhhhh", 0, 0, 1, 0, duration * 1000, 0, 0, 0x100, 0)
+        + IDENTITY_MATRIX
+        + struct.pack(">II", 0, 0),
+    )
+    mdhd = full_box(
+        b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, 44100, duration * 44100, 0x55C4, 0)
+    )
+    hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"soun") + b"\0")
+
+    # A version 0 mp4a sample entry, with the sample rate as 16.16 fixed point
+    mp4a = box(
+        b"mp4a",
+        bytes(6)
+        + struct.pack(">HHH4sHHHHI", 1, 0, 0, bytes(4), channels, 16, 0, 0, 44100 << 16)
+        + esds(config or aac_config(), object_type),
+    )
+    stsd = full_box(b"stsd", 0, 0, struct.pack(">I", 1) + mp4a)
+    stco = full_box(b"stco", 0, 0, struct.pack(">II", 1, audio_offset))
+    stbl = box(b"stbl", stsd + stco)
+    mdia = box(b"mdia", mdhd + hdlr + box(b"minf", stbl))
+
+    return box(b"moov", mvhd + box(b"trak", tkhd + mdia))
+
+
+# Builds an M4A file with moov before or after the audio, optionally followed
+# by free space
+def mp4_file(moov_first=True, padding=0, **moov_args):
+    ftyp = box(b"ftyp", b"M4A \0\0\0\0isomM4A ")
+    free = box(b"free", bytes(padding - 8)) if padding else b""
+    mdat = box(b"mdat", AUDIO)
+
+    moov_size = len(audio_moov(0, **moov_args))
+    if moov_first:
+        offset = len(ftyp) + moov_size + len(free) + 8
+        return ftyp + audio_moov(offset, **moov_args) + free + mdat
+
+    offset = len(ftyp) + 8
+    return ftyp + mdat + audio_moov(offset, **moov_args) + free
@@ -0,0 +1,112 @@
+from benchmark import start_stub
+import http_client
+import pytest
+import os
+
+URL = "https://tracks.example/book/track.mp3"
+BODY = bytes(range(256)) * 40
+
+
+# Starts the stub serving BODY at URL and sends every request to it
+@pytest.fixture
+def stub(monkeypatch):
+    servers = []
+
+    def start(drop_after=None, ranges=True):
+        server, stub_url = start_stub(
+            {"/tracks.example/book/track.mp3": BODY}, drop_after, ranges
+        )
+        servers.append(server)
+        monkeypatch.setattr(http_client, "stub_url", stub_url)
+        monkeypatch.setattr(http_client, "BACKOFF", 0)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+    assert not os.path.exists(f"{out_file}.part")
+
+
+def test_download_resumes_after_dropped_connections(stub, tmp_path):
+    stub(drop_after=len(BODY) // 3 + 1)
+    out_file = tmp_path / "track.mp3"
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_gives_up_on_short_reads(stub, tmp_path):
+    stub(drop_after=len(BODY) // 10)
+    out_file = tmp_path / "track.mp3"
+
+    with pytest.raises(http_client.http.client.IncompleteRead):
+        http_client.download(URL, str(out_file))
+
+    # What did arrive is kept for the next attempt
+    part = (tmp_path / "track.mp3.part").read_bytes()
+    assert part == BODY[: len(part)]
+    assert len(part) == (http_client.RETRIES + 1) * (len(BODY) // 10)
+
+
+def test_download_resumes_part_file(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+    (tmp_path / "track.mp3.part").write_bytes(BODY[:1000])
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_restarts_when_range_is_ignored(stub, tmp_path):
+    stub(ranges=False)
+    out_file = tmp_path / "track.mp3"
+    (tmp_path / "track.mp3.part").write_bytes(BODY[:1000])
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_finishes_complete_part_file(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+    (tmp_path / "track.mp3.part").write_bytes(BODY)
+
+    # The server answers 416 with the full size, so the file is done
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_restarts_oversized_part_file(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+    (tmp_path / "track.mp3.part").write_bytes(BODY + b"junk")
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_skips_complete_file(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+    out_file.write_bytes(BODY)
+
+    assert not http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
+
+
+def test_download_resumes_short_file(stub, tmp_path):
+    stub()
+    out_file = tmp_path / "track.mp3"
+    out_file.write_bytes(BODY[:500])
+
+    assert http_client.download(URL, str(out_file))
+    assert out_file.read_bytes() == BODY
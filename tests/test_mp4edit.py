@@ -0,0 +1,121 @@
+from mp4edit import write_metadata, read_chapters, read_tags, read_moov
+from mp4edit import moov_cover, children, track_handler, first_chunk_offset
+from probe import iter_boxes
+from synthetic import AUDIO, mp4_file
+import os
+
+COVER = b"\xff\xd8\xff\xe0" + bytes(2000)
+TAGS = {"title": "The Book", "artist": "An Author"}
+
+
+# Gets chapters that split a 60 second book evenly
+def even_chapters(count, title="Chapter"):
+    length = 60 / count
+    return [
+        {"title": f"{title} {i + 1}", "start": i * length, "end": (i + 1) * length}
+        for i in range(count)
+    ]
+
+
+# Writes a synthetic M4A to a temporary folder
+def make_file(tmp_path, **args):
+    path = tmp_path / "book.m4a"
+    path.write_bytes(mp4_file(**args))
+    return str(path)
+
+
+# Gets the top level box types of a file, in order
+def box_types(path):
+    with open(path, "rb") as f:
+        return [kind for kind, _, _ in iter_boxes(f, 0, os.path.getsize(path))]
+
+
+# Reads the audio where the audio track says it is
+def read_audio(path):
+    with open(path, "rb") as f:
+        moov = read_moov(f)
+        audio = next(t for t in children(moov, b"trak") if track_handler(t) == b"soun")
+        f.seek(first_chunk_offset(audio))
+        return f.read(len(AUDIO))
+
+
+# Checks a file has the given chapters, and that its audio is where it was
+def assert_chapters(path, chapters):
+    read = read_chapters(path)
+    assert [c["title"] for c in read] == [c["title"] for c in chapters]
+    assert [c["start"] for c in read] == [round(c["start"], 3) for c in chapters]
+    assert read[-1]["end"] == 60
+    assert read_audio(path) == AUDIO
+
+
+def test_moov_at_end(tmp_path):
+    path = make_file(tmp_path, moov_first=False)
+
+    write_metadata(path, chapters=even_chapters(3), tags=TAGS, cover=COVER)
+
+    assert_chapters(path, even_chapters(3))
+    assert read_tags(path) == TAGS
+    with open(path, "rb") as f:
+        assert moov_cover(read_moov(f)) == COVER
+    assert box_types(path) == [b"ftyp", b"mdat", b"moov", b"free", b"mdat"]
+
+
+def test_moov_at_end_grows_and_shrinks(tmp_path):
+    path = make_file(tmp_path, moov_first=False)
+
+    write_metadata(path, chapters=even_chapters(2))
+    small = os.path.getsize(path)
+    assert_chapters(path, even_chapters(2))
+
+    write_metadata(path, chapters=even_chapters(40, "A much longer title"))
+    assert os.path.getsize(path) > small
+    assert_chapters(path, even_chapters(40, "A much longer title"))
+
+    write_metadata(path, chapters=even_chapters(2))
+    assert os.path.getsize(path) == small
+    assert_chapters(path, even_chapters(2))
+    assert box_types(path) == [b"ftyp", b"mdat", b"moov", b"free", b"mdat"]
+
+
+def test_moov_at_start_is_moved_when_it_outgrows_its_space(tmp_path):
+    path = make_file(tmp_path)
+    size = os.path.getsize(path)
+
+    write_metadata(path, chapters=even_chapters(3), tags=TAGS)
+
+    # The old moov is freed and the audio is left where it was
+    assert box_types(path) == [b"ftyp", b"free", b"mdat", b"moov", b"free", b"mdat"]
+    assert os.path.getsize(path) > size
+    assert_chapters(path, even_chapters(3))
+    assert read_tags(path) == TAGS
+
+
+def test_moov_at_start_is_rewritten_in_its_padding(tmp_path):
+    path = make_file(tmp_path, padding=8192)
+    size = os.path.getsize(path)
+
+    write_metadata(path, chapters=even_chapters(10), tags=TAGS, cover=COVER)
+    assert os.path.getsize(path) == size
+    assert box_types(path)[:2] == [b"ftyp", b"moov"]
+    assert_chapters(path, even_chapters(10))
+
+    # Fewer chapters leave more free space, and their old text is reused
+    write_metadata(path, chapters=even_chapters(2))
+    assert os.path.getsize(path) == size
+    assert box_types(path) == [b"ftyp", b"moov", b"free", b"mdat", b"mdat"]
+    assert_chapters(path, even_chapters(2))
+    assert read_tags(path) == TAGS
+
+    write_metadata(path, chapters=even_chapters(12))
+    assert os.path.getsize(path) == size
+    assert_chapters(path, even_chapters(12))
+
+
+def test_tags_only_keep_chapters(tmp_path):
+    path = make_file(tmp_path, moov_first=False)
+    write_metadata(path, chapters=even_chapters(4))
+
+    write_metadata(path, tags={"title": "Renamed"})
+
+    assert_chapters(path, even_chapters(4))
+    assert read_tags(path) == {"title": "Renamed"}
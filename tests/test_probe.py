@@ -0,0 +1,141 @@
+from probe import read_stream, read_duration, parse_mp3_header
+from synthetic import aac_config, mp4_file
+import struct
+
+# Frame headers of 128 kbps MPEG-1 layer III and 160 kbps layer II at 44100 Hz
+MP3_STEREO = b"\xff\xfb\x90\x00"
+MP3_MONO = b"\xff\xfb\x90\xc0"
+MP2_STEREO = b"\xff\xfd\x90\x00"
+
+
+# Builds MPEG audio of some frames that all have the same header
+def mpeg_frames(header, count):
+    length = parse_mp3_header(header, 0)["length"]
+    return (header + bytes(length - 4)) * count
+
+
+# Builds a WAV file of silence
+def wav_file(seconds=1, channels=2, bits=16, audio_format=1, extensible=False):
+    block = channels * bits // 8
+    fmt = struct.pack(
+        "<HHIIHH", audio_format, channels, 44100, 44100 * block, block, bits
+    )
+    if extensible:
+        fmt = struct.pack(
+            "<HHIIHH", 0xFFFE, channels, 44100, 44100 * block, block, bits
+        )
+        fmt += struct.pack("<HHIH14x", 22, bits, 0, audio_format)
+
+    data = bytes(44100 * block * seconds)
+    chunks = (
+        b"WAVE"
+        + struct.pack("<4sI", b"fmt ", len(fmt))
+        + fmt
+        + struct.pack("<4sI", b"data", len(data))
+        + data
+    )
+    return b"RIFF" + struct.pack("<I", len(chunks)) + chunks
+
+
+# Writes a file to a temporary folder
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_mp3(tmp_path):
+    path = write(tmp_path, "a.mp3", mpeg_frames(MP3_STEREO, 10))
+
+    stream = read_stream(path)
+    assert stream == {"codec_name": "mp3", "sample_rate": "44100", "channels": 2}
+    assert read_duration(path) == 10 * 1152 / 44100
+
+
+def test_mp3_mono_after_id3_tag(tmp_path):
+    id3 = b"ID3\x03\x00\x00\x00\x00\x00\x0a" + bytes(10)
+    path = write(tmp_path, "a.mp3", id3 + mpeg_frames(MP3_MONO, 10))
+
+    assert read_stream(path)["channels"] == 1
+    assert read_duration(path) == 10 * 1152 / 44100
+
+
+def test_mp3_xing_frame_count(tmp_path):
+    first = bytearray(mpeg_frames(MP3_STEREO, 1))
+    first[36:48] = b"Xing" + struct.pack(">II", 1, 1000)
+    path = write(tmp_path, "a.mp3", bytes(first) + mpeg_frames(MP3_STEREO, 9))
+
+    assert read_duration(path) == 1000 * 1152 / 44100
+
+
+def test_mp2(tmp_path):
+    path = write(tmp_path, "a.mp2", mpeg_frames(MP2_STEREO, 10))
+
+    assert read_stream(path)["codec_name"] == "mp2"
+
+
+def test_wav(tmp_path):
+    path = write(tmp_path, "a.wav", wav_file(seconds=2))
+
+    stream = read_stream(path)
+    assert stream == {"codec_name": "pcm_s16le", "sample_rate": "44100", "channels": 2}
+    assert read_duration(path) == 2
+
+
+def test_wav_extensible(tmp_path):
+    path = write(
+        tmp_path,
+        "a.wav",
+        wav_file(channels=1, bits=32, audio_format=3, extensible=True),
+    )
+
+    stream = read_stream(path)
+    assert stream == {"codec_name": "pcm_f32le", "sample_rate": "44100", "channels": 1}
+
+
+def test_mp4_aac_lc(tmp_path):
+    path = write(tmp_path, "a.m4a", mp4_file())
+
+    stream = read_stream(path)
+    assert stream == {
+        "codec_name": "aac",
+        "profile": "LC",
+        "sample_rate": "44100",
+        "channels": 2,
+    }
+    assert read_duration(path) == 60
+
+
+def test_mp4_he_aac_with_channels_from_sample_entry(tmp_path):
+    config = aac_config(object_type=5, frequency_index=7, channel_config=0)
+    path = write(tmp_path, "a.m4a", mp4_file(channels=1, config=config))
+
+    stream = read_stream(path)
+    assert stream["profile"] == "HE-AAC"
+    assert stream["sample_rate"] == "22050"
+    assert stream["channels"] == 1
+
+
+def test_mp4_without_aac(tmp_path):
+    path = write(tmp_path, "a.m4a", mp4_file(object_type=0x6B))
+
+    assert read_stream(path) is None
+
+
+def test_truncated_files(tmp_path):
+    mp4 = mp4_file()
+    mvhd = mp4.index(b"mvhd")
+    for name, data in [
+        ("short.m4a", mp4[:8]),
+        ("header.m4a", mp4[: mvhd + 10]),
+        ("header.wav", wav_file()[:30]),
+        ("frame.mp3", mpeg_frames(MP3_STEREO, 1)[:3]),
+    ]:
+        path = write(tmp_path, name, data)
+        assert read_stream(path) is None, name
+        assert read_duration(path) is None, name
+
+    # The duration comes from mvhd, which comes before the cut
+    path = write(tmp_path, "stsd.m4a", mp4[: mp4.index(b"esds") + 10])
+    assert read_stream(path) is None
+    assert read_duration(path) == 60
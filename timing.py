@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+import subprocess as sp
+import threading
+import atexit
+import json
+import time
+import os
+
+# Where spans are written, if anywhere. Files ending in .json use Chrome's trace
+# format, for chrome://tracing or Perfetto, and others get a JSON line per span
+trace_file = None
+chrome_format = False
+lock = threading.Lock()
+
+
+# Starts writing spans to a file. JSON lines are appended, so several scripts
+# can share one trace
+def start_trace(path):
+    global trace_file, chrome_format
+    stop_trace()
+
+    chrome_format = path.endswith(".json")
+    trace_file = open(path, "w" if chrome_format else "a", buffering=1)
+    if chrome_format:
+        # Chrome doesn't need the closing bracket, so a cut-off trace still loads
+        trace_file.write("[\n")
+
+
+# Stops writing spans
+def stop_trace():
+    global trace_file
+    with lock:
+        if trace_file is not None:
+            trace_file.close()
+            trace_file = None
+
+
+# Writes a finished span
+def record(name, start, duration, args):
+    if chrome_format:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        line = f"{json.dumps(event)},\n"
+    else:
+        event = {
+            "name": name,
+            "start": start,
+            "duration": duration,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            **args,
+        }
+        line = f"{json.dumps(event)}\n"
+
+    with lock:
+        if trace_file is not None:
+            trace_file.write(line)
+
+
+# Times a stage of work. The yielded dict can be filled in with more details
+@contextmanager
+def span(name, **args):
+    if trace_file is None:
+        yield args
+        return
+
+    start = time.time()
+    began = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        record(name, start, time.perf_counter() - began, args)
+
+
+# Gets the encode speed, bitrate and output size from ffmpeg -progress output
+def progress_stats(progress):
+    stats = {}
+    speed = progress.get("speed", "").rstrip("x")
+    if speed.replace(".", "", 1).isdigit():
+        stats["speed"] = float(speed)
+
+    bitrate = progress.get("bitrate", "").replace("kbits/s", "")
+    if bitrate.replace(".", "", 1).isdigit():
+        stats["bitrate_kbps"] = float(bitrate)
+
+    if progress.get("out_time_us", "").isdigit():
+        stats["output_seconds"] = int(progress["out_time_us"]) / 1e6
+    if progress.get("total_size", "").isdigit():
+        stats["output_bytes"] = int(progress["total_size"])
+
+    return stats
+
+
+# Runs an ffmpeg command. While tracing, it's timed and its -progress output is
+# read to record how fast it ran compared to realtime and the bitrate it wrote
+def run_ffmpeg(cmd, name="ffmpeg", **args):
+    if trace_file is None:
+        sp.run(cmd, shell=True, check=True)
+        return
+
+    with span(name, **args) as span_args:
+        cmd = cmd.replace("ffmpeg ", "ffmpeg -progress pipe:1 ", 1)
+        process = sp.Popen(cmd, shell=True, stdout=sp.PIPE, text=True)
+
+        progress = {}
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            progress[key] = value
+
+        if process.wait() != 0:
+            raise sp.CalledProcessError(process.returncode, cmd)
+        span_args.update(progress_stats(progress))
+
+
+if os.environ.get("AUDIOBOOK_TOOLS_TRACE"):
+    start_trace(os.environ["AUDIOBOOK_TOOLS_TRACE"])
+
+atexit.register(stop_trace)
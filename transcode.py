@@ -0,0 +1,457 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from probe import get_duration
+from library_index import indexed_streams, indexed_loudness, indexed_durations
+from build_manifest import input_hash, hash_inputs, output_key
+from build_manifest import build_path, is_current, mark_current
+from timing import run_ffmpeg
+import shutil
+import os
+
+# Audio format every audiobook is encoded to
+AAC_ARGS = "-c:a aac -b:a 112k -ar 44100 "
+SAMPLE_RATE = 44100
+
+# Containers whose AAC streams can be joined by the concat demuxer as-is
+COPY_EXTENSIONS = (".m4a", ".m4b", ".mp4")
+
+# Long inputs are encoded in segments cut on AAC frame boundaries. Each segment
+# is encoded with some of the audio around it, whose frames are then dropped
+# along with the encoder's priming frame, so the joins decode without gaps
+AAC_FRAME = 1024
+SEGMENT_PRIMING = 1  # Frames of encoder delay at the start of every encode
+SEGMENT_ROLL = 2  # Frames of neighbouring audio encoded on each side
+SEGMENT_LENGTH = 600  # Longest segment in seconds, when chapters are longer
+
+# Inputs ffmpeg can seek to an exact sample in. Others, like VBR MP3s, are
+# decoded to WAV once so every segment is cut at the right place
+EXACT_SEEK_EXTENSIONS = (".wav", ".flac", ".m4a", ".m4b", ".mp4")
+
+# Loudness normalization brings each file to a target EBU R128 loudness with a
+# gain applied while it's encoded. Smaller changes aren't worth an encode
+LOUDNESS_TARGET = -18
+MAX_GAIN = 20
+MIN_GAIN = 0.5
+
+
+# Gets the reason a file has to be re-encoded, or None if it can be copied
+def encode_reason(audio_file, stream, channels):
+    if not stream:
+        return "no audio stream found"
+    if stream.get("codec_name") != "aac" or stream.get("profile") != "LC":
+        return (
+            f"codec is {stream.get('codec_name')} {stream.get('profile', '')}".strip()
+        )
+    if not audio_file.lower().endswith(COPY_EXTENSIONS):
+        return f"{os.path.splitext(audio_file)[1] or 'file'} is not an MP4 container"
+    if int(stream.get("sample_rate", 0)) != SAMPLE_RATE:
+        return f"sample rate is {stream.get('sample_rate')} Hz"
+    if stream.get("channels") != channels:
+        return f"has {stream.get('channels')} channels instead of {channels}"
+
+    return None
+
+
+# Gets the gain in dB that brings a file to the target loudness, or None if
+# it's close enough or couldn't be measured
+def loudness_gain(loudness, target):
+    if loudness is None:
+        return None
+
+    gain = round(max(min(target - loudness, MAX_GAIN), -MAX_GAIN), 1)
+    return gain if abs(gain) >= MIN_GAIN else None
+
+
+# Probes each file, or looks it up in the library index, and decides whether to
+# stream-copy or re-encode it. With a loudness target, every file is measured
+# in parallel and the ones that are too loud or quiet get a gain
+def plan_transcode(audio_files, jobs=None, loudness=None):
+    streams = indexed_streams(audio_files, jobs)
+
+    # Every file has to end up with the channel count most of the book uses
+    counts = Counter(stream["channels"] for stream in streams if stream)
+    channels = counts.most_common(1)[0][0] if counts else 2
+
+    gains = [None] * len(audio_files)
+    if loudness is not None:
+        measured = indexed_loudness(audio_files)
+        gains = [loudness_gain(level, loudness) for level in measured]
+
+    return [
+        plan_step(f, s, channels, gain)
+        for f, s, gain in zip(audio_files, streams, gains)
+    ]
+
+
+# Decides whether a probed file can be stream-copied or has to be re-encoded
+def plan_step(audio_file, stream, channels, gain=None):
+    reason = encode_reason(audio_file, stream, channels)
+    if gain and not reason:
+        reason = f"needs {gain:+.1f} dB to match the book's loudness"
+    elif gain:
+        reason = f"{reason}, {gain:+.1f} dB"
+
+    return {
+        "file": audio_file,
+        "action": "encode" if reason else "copy",
+        "reason": reason or "already AAC-LC at 44100 Hz",
+        "channels": channels,
+        "gain": gain,
+    }
+
+
+# Prints the action chosen for each file
+def print_plan(plan):
+    print("Transcode plan:")
+    for step in plan:
+        name = os.path.basename(step["file"])
+        print(f"  {step['action']:<6}  {name} ({step['reason']})")
+
+    copied = sum(step["action"] == "copy" for step in plan)
+    print(f"{copied} file(s) stream-copied, {len(plan) - copied} re-encoded\n")
+
+
+# Gets the ffmpeg filter args that apply a gain in dB
+def gain_args(gain):
+    return f"-af volume={gain}dB " if gain else ""
+
+
+# Encode a single audio file to an intermediate AAC file, with a gain if given,
+# recording it in the build if given. The file is encoded to ADTS first so the
+# encoder's priming frame can be dropped, then put in an MP4 container to be
+# joined with the copied files, so the joins have no silence between them
+def encode_file(audio_file, out_file, channels=None, build=None, key=None, gain=None):
+    adts_file = f"{os.path.splitext(out_file)[0]}.aac"
+    cmd = (
+        f'ffmpeg -v error -i "{audio_file}" '
+        f"-map 0:a {gain_args(gain)}{AAC_ARGS}"
+        f"{f'-ac {channels} ' if channels else ''}"
+        f'-f adts -y "{adts_file}"'
+    )
+    run_ffmpeg(cmd, "encode", file=audio_file)
+
+    with open(adts_file, "rb") as f:
+        frames = list(adts_frames(f.read()))
+    with open(adts_file, "wb") as f:
+        f.write(b"".join(frames[SEGMENT_PRIMING:]))
+
+    cmd = f'ffmpeg -v error -i "{adts_file}" -c:a copy -y "{out_file}"'
+    run_ffmpeg(cmd, "remux", file=audio_file)
+    os.remove(adts_file)
+
+    if build:
+        mark_current(build, out_file, key, input=audio_file)
+    return out_file
+
+
+# Encodes the planned files and returns the files to concat and their codec args.
+# With a build, encoded files are kept in it and reused by later runs, and a
+# single input with chapter starts is encoded in segments cut at the chapters
+def prepare_inputs(plan, work_dir, jobs=None, build=None, starts=None):
+    single = len(plan) == 1 and plan[0]["action"] == "encode"
+    if single and starts is not None and (jobs or build):
+        step = plan[0]
+        boundaries = segment_boundaries(starts, get_duration(step["file"]))
+        joined_file = os.path.join(work_dir, "joined.aac")
+        encode_segmented(
+            step["file"],
+            boundaries,
+            joined_file,
+            work_dir,
+            jobs or 1,
+            step["channels"],
+            build,
+            step.get("gain"),
+        )
+        return [joined_file], "-c:a copy "
+
+    # Without a worker count, encode everything in the final pass if nothing is
+    # copied and no file needs its own gain
+    single_pass = all(s["action"] == "encode" and not s.get("gain") for s in plan)
+    if not jobs and not build and single_pass:
+        return [step["file"] for step in plan], AAC_ARGS
+
+    encode_steps = [step for step in plan if step["action"] == "encode"]
+    if build:
+        hashes = hash_inputs(build, [step["file"] for step in encode_steps])
+        keys = [
+            output_key(
+                "encode",
+                source,
+                AAC_ARGS,
+                step["channels"],
+                step.get("gain"),
+                SEGMENT_PRIMING,
+            )
+            for source, step in zip(hashes, encode_steps)
+        ]
+        out_files = [build_path(build, key, ".m4a") for key in keys]
+    else:
+        keys = [None] * len(encode_steps)
+        out_files = [
+            os.path.join(work_dir, f"{i:04d}.m4a") for i in range(len(encode_steps))
+        ]
+
+    # Inputs with the same content share an output, which is only encoded once
+    pending = []
+    seen = set()
+    reused = 0
+    for i, out_file in enumerate(out_files):
+        if out_file in seen:
+            continue
+        seen.add(out_file)
+        if build and is_current(build, out_file, keys[i]):
+            reused += 1
+        else:
+            pending.append(i)
+
+    if reused:
+        print(f"Reusing {reused} file(s) from the last build")
+    if pending:
+        print(f"Encoding {len(pending)} file(s) using {jobs or 1} worker(s)...")
+        with ThreadPoolExecutor(max_workers=jobs or 1) as executor:
+            list(
+                executor.map(
+                    encode_file,
+                    [encode_steps[i]["file"] for i in pending],
+                    [out_files[i] for i in pending],
+                    [encode_steps[i]["channels"] for i in pending],
+                    [build] * len(pending),
+                    [keys[i] for i in pending],
+                    [encode_steps[i].get("gain") for i in pending],
+                )
+            )
+
+    encoded_files = {step["file"]: f for step, f in zip(encode_steps, out_files)}
+    files = [encoded_files.get(step["file"], step["file"]) for step in plan]
+
+    return files, "-c:a copy "
+
+
+# Gets the length of each file prepare_inputs made for a plan. Encoded files
+# are probed, as they were trimmed to whole AAC frames, and the rest come from
+# the library index
+def joined_durations(plan, files):
+    durations = indexed_durations([step["file"] for step in plan])
+    return [
+        duration if file == step["file"] else get_duration(file)
+        for step, file, duration in zip(plan, files, durations)
+    ]
+
+
+# Gets where to cut a long input, in samples on AAC frame boundaries, at each
+# chapter start and every max_length seconds within longer chapters
+def segment_boundaries(starts, duration, max_length=SEGMENT_LENGTH):
+    total_frames = int(duration * SAMPLE_RATE) // AAC_FRAME
+    window = max(int(max_length * SAMPLE_RATE) // AAC_FRAME, 1)
+
+    frames = sorted({round(start * SAMPLE_RATE / AAC_FRAME) for start in starts})
+    frames = [frame for frame in frames if 0 < frame < total_frames]
+    edges = [0, *frames, total_frames]
+
+    boundaries = []
+    for start, end in zip(edges, edges[1:]):
+        boundaries.extend(range(start, end, window))
+
+    return [frame * AAC_FRAME for frame in boundaries]
+
+
+# Splits ADTS data into its frames
+def adts_frames(data):
+    offset = 0
+    while offset + 7 <= len(data):
+        if data[offset] != 0xFF or data[offset + 1] & 0xF0 != 0xF0:
+            raise ValueError(f"Invalid ADTS frame at offset {offset}")
+
+        length = (
+            (data[offset + 3] & 0x03) << 11
+            | data[offset + 4] << 3
+            | data[offset + 5] >> 5
+        )
+        yield data[offset : offset + length]
+        offset += length
+
+
+# Encodes part of an input to ADTS, with extra frames of audio before and after,
+# then keeps only the frames that belong to the part
+def encode_segment(
+    audio_file,
+    start,
+    end,
+    out_file,
+    channels=None,
+    build=None,
+    key=None,
+    gain=None,
+    source=None,
+):
+    roll = SEGMENT_ROLL * AAC_FRAME
+    read_start = max(start - roll, 0)
+    skip = SEGMENT_PRIMING + (start - read_start) // AAC_FRAME
+
+    limit = ""
+    if end is not None:
+        limit = f"-t {(end + roll - read_start) / SAMPLE_RATE} "
+
+    cmd = (
+        f"ffmpeg -v error -ss {read_start / SAMPLE_RATE} {limit}"
+        f'-i "{audio_file}" -map 0:a {gain_args(gain)}{AAC_ARGS}'
+        f"{f'-ac {channels} ' if channels else ''}"
+        f'-f adts -y "{out_file}"'
+    )
+    run_ffmpeg(cmd, "encode_segment", file=audio_file, start=start / SAMPLE_RATE)
+
+    with open(out_file, "rb") as f:
+        frames = list(adts_frames(f.read()))
+
+    # The last segment keeps everything up to the end of the input
+    if end is not None:
+        frames = frames[skip : skip + (end - start) // AAC_FRAME]
+    else:
+        frames = frames[skip:]
+
+    with open(out_file, "wb") as f:
+        f.write(b"".join(frames))
+
+    if build:
+        mark_current(build, out_file, key, input=source or audio_file, start=start)
+    return out_file
+
+
+# Decodes an input to a WAV file that can be cut at exact samples
+def decode_wav(audio_file, out_file):
+    cmd = (
+        f'ffmpeg -v error -i "{audio_file}" -map 0:a -ar {SAMPLE_RATE} '
+        f'-rf64 auto -y "{out_file}"'
+    )
+    run_ffmpeg(cmd, "decode", file=audio_file)
+    return out_file
+
+
+# Encodes one long input as segments in parallel and joins their frames into
+# a single ADTS file, keeping the timeline sample-exact so chapters still line up.
+# With a build, segments are kept in it and only the ones that changed or never
+# finished are encoded again. Inputs that can't be seeked exactly are decoded
+# once first, and the segments are cut from that
+def encode_segmented(
+    audio_file,
+    boundaries,
+    out_file,
+    work_dir,
+    jobs,
+    channels=None,
+    build=None,
+    gain=None,
+):
+    starts = boundaries
+    ends = [*boundaries[1:], None]
+    count = len(starts)
+
+    if build:
+        source = input_hash(build, audio_file)
+        keys = [
+            output_key(
+                "segment", source, start, end, channels, gain, AAC_ARGS, SEGMENT_ROLL
+            )
+            for start, end in zip(starts, ends)
+        ]
+        segment_files = [build_path(build, key, ".aac") for key in keys]
+    else:
+        keys = [None] * count
+        segment_files = [
+            os.path.join(work_dir, f"{start:012d}.aac") for start in starts
+        ]
+
+    pending = [
+        i
+        for i, segment_file in enumerate(segment_files)
+        if not (build and is_current(build, segment_file, keys[i]))
+    ]
+    if len(pending) < count:
+        print(f"Reusing {count - len(pending)} segment(s) from the last build")
+    if pending:
+        cut_file = audio_file
+        if not audio_file.lower().endswith(EXACT_SEEK_EXTENSIONS):
+            print("Decoding the input so it can be cut exactly...")
+            cut_file = decode_wav(audio_file, os.path.join(work_dir, "decoded.wav"))
+
+        print(f"Encoding {len(pending)} segment(s) using {jobs} worker(s)...")
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(
+                    executor.map(
+                        encode_segment,
+                        [cut_file] * len(pending),
+                        [starts[i] for i in pending],
+                        [ends[i] for i in pending],
+                        [segment_files[i] for i in pending],
+                        [channels] * len(pending),
+                        [build] * len(pending),
+                        [keys[i] for i in pending],
+                        [gain] * len(pending),
+                        [audio_file] * len(pending),
+                    )
+                )
+        finally:
+            if cut_file != audio_file:
+                os.remove(cut_file)
+
+    with open(out_file, "wb") as f:
+        for segment_file in segment_files:
+            with open(segment_file, "rb") as segment:
+                shutil.copyfileobj(segment, f)
+            if not build:
+                os.remove(segment_file)
+
+    return out_file
+
+
+# Gets a chapter for each file, named Chapter 1, Chapter 2, etc.
+def numbered_chapters(durations):
+    chapters = []
+    start_time = 0
+    for i, duration in enumerate(durations):
+        chapter = {
+            "title": f"Chapter {i + 1}",
+            "start": start_time,
+            "end": start_time + duration,
+        }
+        chapters.append(chapter)
+        start_time += duration
+
+    return chapters
+
+
+# Joins audio files into an m4b with the given chapters
+def concat_m4b(files, codec_args, chapters, m4b_file, work_dir):
+    # Create input file for ffmpeg concat
+    input_file = os.path.abspath(os.path.join(work_dir, "input.txt"))
+    with open(input_file, "w") as f:
+        for audio_file in files:
+            audio_file = audio_file.replace("'", "'\\''")
+            f.write(f"file '{os.path.abspath(audio_file)}'\n")
+
+    # Create chapters file
+    chapters_file = os.path.abspath(os.path.join(work_dir, "chapters.txt"))
+    with open(chapters_file, "w") as f:
+        for chapter in chapters:
+            f.write(
+                "[CHAPTER]\n"
+                "TIMEBASE=1/1000\n"
+                f"START={int(chapter['start'] * 1000)}\n"
+                f"END={int(chapter['end'] * 1000)}\n"
+                f"title={chapter['title']}\n\n"
+            )
+
+    # Combine audio and chapters into M4B file
+    cmd = (
+        f'ffmpeg -f concat -safe 0 -i "{input_file}" '
+        f'-f ffmetadata -i "{chapters_file}" '
+        "-map 0:a -map_chapters 1 -map_metadata 1 "
+        f"{codec_args}"
+        f'-y "{m4b_file}"'
+    )
+    run_ffmpeg(cmd, "concat", file=m4b_file, inputs=len(files))
+
+    os.remove(chapters_file)
+    os.remove(input_file)
@@ -0,0 +1,460 @@
+from concurrent.futures import ThreadPoolExecutor
+from finalize_m4b import run_job, load_job
+from transcode import COPY_EXTENSIONS
+from build_manifest import BUILD_DIR
+from library_index import AUDIO_EXTENSIONS
+from timing import start_trace
+import ctypes.util
+import traceback
+import argparse
+import ctypes
+import select
+import json
+import glob
+import time
+import os
+
+JOB_FILE = "job.json"
+OUTPUT_SUFFIX = "_final.m4b"
+
+# A folder is only picked up once nothing in it has changed for SETTLE seconds,
+# and while no download into it is still in progress
+SETTLE = 60
+PARTIAL_EXTENSIONS = (".part",)
+
+# Without inotify, folders are rescanned every POLL seconds
+POLL = 30
+TICK = 1
+
+# inotify events that mean a file was added, finished or removed
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+# Starts watching for file changes with inotify, or returns None to poll instead
+def open_watcher():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    return {"libc": libc, "fd": fd, "paths": {}}
+
+
+# Adds a folder to the watched ones. A folder that can't be watched, like when
+# the system's watch limit is reached, is still found by the periodic rescans
+def watch_path(watcher, path):
+    if not watcher or path in watcher["paths"]:
+        return
+
+    wd = watcher["libc"].inotify_add_watch(watcher["fd"], path.encode(), WATCH_MASK)
+    if wd < 0:
+        error = ctypes.get_errno()
+        print(f"Can't watch '{path}' ({os.strerror(error)}), rescanning it instead")
+        wd = None
+    watcher["paths"][path] = wd
+
+
+# Stops watching the folders that aren't in keep, like deleted or finished ones
+def unwatch_paths(watcher, keep):
+    if not watcher:
+        return
+
+    for path in [p for p in watcher["paths"] if p not in keep]:
+        wd = watcher["paths"].pop(path)
+        # The watch of a deleted folder is already gone, so errors are expected
+        if wd is not None:
+            watcher["libc"].inotify_rm_watch(watcher["fd"], wd)
+
+
+# Waits up to timeout seconds for a change, returning True if there was one
+def wait_for_changes(watcher, timeout):
+    if not watcher:
+        time.sleep(timeout)
+        return False
+
+    readable, _, _ = select.select([watcher["fd"]], [], [], timeout)
+    if not readable:
+        return False
+
+    # The events themselves aren't needed, only that something changed
+    try:
+        while os.read(watcher["fd"], 1 << 16):
+            pass
+    except BlockingIOError:
+        pass
+    return True
+
+
+# Loads the saved state of every job, requeueing the ones that were running.
+# Interrupted builds resume from their build folder
+def load_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {"jobs": {}}
+
+    for job in state["jobs"].values():
+        if job["status"] == "running":
+            job["status"] = "queued"
+
+    return state
+
+
+# Writes the job state, replacing the old one only once it's complete
+def save_state(state, state_file):
+    with open(f"{state_file}.part", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{state_file}.part", state_file)
+
+
+# Gets the file count, total size and latest change of the files in a folder
+def folder_signature(files):
+    stats = [os.stat(file) for file in files]
+    return [
+        len(stats),
+        sum(stat.st_size for stat in stats),
+        max((stat.st_mtime for stat in stats), default=0),
+    ]
+
+
+# Leaves out the files the jobs write, so a kept build isn't redone
+def book_files(folder, files):
+    output = f"{os.path.basename(folder)}.m4b"
+    return [f for f in files if f != output and not f.endswith(OUTPUT_SUFFIX)]
+
+
+# Gets the signature of a book folder as find_books sees it
+def book_signature(folder):
+    files = book_files(folder, os.listdir(folder))
+    return folder_signature([os.path.join(folder, f) for f in files])
+
+
+# Finds book folders: folders with a job file or audio files other than the
+# m4b built from them, and whose files have stopped changing. Also counts the
+# ones that are still changing. Finished folders aren't watched, so only the
+# folders that can still produce a job use up inotify watches
+def find_books(folders, watcher, settle, finished=()):
+    books = {}
+    settling = 0
+    watched = set()
+    now = time.time()
+    for root_folder in folders:
+        for folder, dirs, files in os.walk(os.path.abspath(root_folder)):
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+            if folder not in finished:
+                watch_path(watcher, folder)
+                watched.add(folder)
+
+            files = book_files(folder, files)
+            audio = [f for f in files if f.lower().endswith(AUDIO_EXTENSIONS)]
+            if not audio and JOB_FILE not in files:
+                continue
+
+            # Files can be renamed or removed while the folder is scanned, like
+            # a download moving its .part file into place, and a job file can
+            # be half written. Such folders are looked at again once settled
+            try:
+                signature = folder_signature([os.path.join(folder, f) for f in files])
+                if JOB_FILE in files:
+                    load_job(os.path.join(folder, JOB_FILE))
+            except (OSError, ValueError):
+                settling += 1
+                continue
+
+            partial = any(f.endswith(PARTIAL_EXTENSIONS) for f in files)
+            if not partial and now - signature[2] >= settle:
+                books[folder] = {"signature": signature, "audio": audio}
+            else:
+                settling += 1
+
+    unwatch_paths(watcher, watched)
+    return books, settling
+
+
+# Decides what a new book needs, and how heavy the job is. Folders of files
+# that can't be stream-copied need encoding, the rest are only remuxed
+def plan_job(folder, book, tag):
+    job_file = os.path.join(folder, JOB_FILE)
+    if os.path.exists(job_file):
+        job = load_job(job_file)
+        job["input"] = os.path.join(folder, job.get("input", "."))
+    else:
+        job = {"input": folder, "chapters": {"source": "files"}}
+        cue_files = glob.glob(os.path.join(glob.escape(folder), "*.cue"))
+        if cue_files:
+            job["chapters"] = {"source": "cue", "file": cue_files[0]}
+
+        # Books laid out as Author/Title are looked up by those names
+        if tag:
+            job["metadata"] = {
+                "title": os.path.basename(folder),
+                "author": os.path.basename(os.path.dirname(folder)),
+            }
+
+    encode = os.path.isdir(job["input"]) and any(
+        not f.lower().endswith(COPY_EXTENSIONS) for f in book["audio"]
+    )
+    return {
+        "job": job,
+        "kind": "encode" if encode else "remux",
+        "priority": job.get("priority", 0),
+        "size": book["signature"][1],
+        "signature": book["signature"],
+        "status": "queued",
+        "queued": time.time(),
+    }
+
+
+# Queues books that are new or changed since they were last processed
+def queue_books(state, books, tag):
+    queued = 0
+    for folder, book in books.items():
+        entry = state["jobs"].get(folder)
+        if entry and entry["signature"] == book["signature"]:
+            continue
+        if entry and entry["status"] == "running":
+            continue
+
+        try:
+            state["jobs"][folder] = plan_job(folder, book, tag)
+        except (OSError, ValueError) as e:
+            print(f"Skipping '{folder}' for now: {e}")
+            continue
+        print(f"Queued '{folder}'")
+        queued += 1
+
+    return queued
+
+
+# Picks the next jobs that fit in the free encode and remux slots. Lower
+# priorities go first, then smaller books, so short jobs don't wait behind
+# long encodes
+def next_jobs(state, slots):
+    queued = [
+        (job["priority"], job["size"], job["queued"], folder)
+        for folder, job in state["jobs"].items()
+        if job["status"] == "queued"
+    ]
+
+    picked = []
+    free = dict(slots)
+    for _, _, _, folder in sorted(queued):
+        kind = state["jobs"][folder]["kind"]
+        if free[kind] > 0:
+            free[kind] -= 1
+            picked.append(folder)
+
+    return picked
+
+
+# Runs one job, returning its result or error instead of raising
+def run_folder_job(job, keep, jobs, incremental):
+    try:
+        result = run_job(dict(job), keep, jobs, incremental)
+        return {"status": "done", "output": result["file"]}
+    except Exception as e:
+        traceback.print_exc()
+        return {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+
+# Watches folders for finished audiobooks and builds them, running at most
+# encode_slots encodes and io_slots remuxes at once
+def watch(
+    folders: list,
+    state_file: str,
+    encode_slots: int = None,
+    io_slots: int = 1,
+    settle: float = SETTLE,
+    poll: float = POLL,
+    tag: bool = False,
+    keep: bool = False,
+    once: bool = False,
+    incremental: bool = False,
+):
+    cores = os.cpu_count() or 1
+    encode_slots = encode_slots or max(cores // 4, 1)
+    slots = {"encode": encode_slots, "remux": io_slots}
+
+    # Each encode gets an even share of the cores for its files or segments
+    encode_jobs = max(cores // encode_slots, 1)
+
+    state = load_state(state_file)
+    save_state(state, state_file)
+    watcher = None if once else open_watcher()
+    print(
+        f"Watching {len(folders)} folder(s) with "
+        f"{'inotify' if watcher else 'polling'}, running up to {encode_slots} "
+        f"encode(s) and {io_slots} remux(es) at once"
+    )
+
+    running = {}
+    last_scan = 0
+    settling = 0
+    changed = True
+    with ThreadPoolExecutor(max_workers=encode_slots + io_slots) as executor:
+        while True:
+            # Record finished jobs
+            for folder, future in list(running.items()):
+                if future.done():
+                    entry = state["jobs"][folder]
+                    entry.update(future.result(), finished=time.time())
+
+                    # A job can change its own folder, by overwriting its
+                    # input or removing the source files, so the folder is
+                    # taken as it is now to not queue it again
+                    try:
+                        entry["signature"] = book_signature(folder)
+                    except OSError:
+                        pass
+                    print(f"{entry['status'].capitalize()}: '{folder}'")
+                    del running[folder]
+                    save_state(state, state_file)
+
+            # Look for new books when something changed, and while folders are
+            # settling, often enough to notice when they're done
+            interval = min(settle, poll) if settling else poll
+            if changed or time.time() - last_scan >= interval:
+                last_scan = time.time()
+                finished = {
+                    folder
+                    for folder, job in state["jobs"].items()
+                    if job["status"] in ("done", "failed")
+                }
+                books, settling = find_books(
+                    folders, watcher, 0 if once else settle, finished
+                )
+                if queue_books(state, books, tag):
+                    save_state(state, state_file)
+
+            # Start as many jobs as there are free slots
+            free = dict(slots)
+            for folder in running:
+                free[state["jobs"][folder]["kind"]] -= 1
+            for folder in next_jobs(state, free):
+                entry = state["jobs"][folder]
+                entry.update(status="running", started=time.time())
+                jobs = encode_jobs if entry["kind"] == "encode" else None
+                running[folder] = executor.submit(
+                    run_folder_job, entry["job"], keep, jobs, incremental
+                )
+                print(f"Started {entry['kind']}: '{folder}'")
+            if running:
+                save_state(state, state_file)
+
+            if once and not running:
+                queued = [j for j in state["jobs"].values() if j["status"] == "queued"]
+                if not queued:
+                    return state
+
+            if running or once:
+                interval = TICK
+            changed = wait_for_changes(watcher, interval)
+
+
+def main():
+    # Setup optional arguments
+    parser = argparse.ArgumentParser(
+        description="Watches folders for finished audiobooks and builds each one "
+        "into an m4b, a few at a time"
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        default=[],
+        help="Folder to watch, can be given more than once",
+        action="append",
+        required=True,
+    )
+    parser.add_argument(
+        "--state",
+        default="watch_state.json",
+        help="File to keep the job queue in, so it survives restarts "
+        "(Default: watch_state.json)",
+    )
+    parser.add_argument(
+        "--encode-slots",
+        default=0,
+        help="Number of books to encode at once (Default: a quarter of the cores)",
+        type=int,
+    )
+    parser.add_argument(
+        "--io-slots",
+        default=1,
+        help="Number of books to remux without encoding at once (Default: 1)",
+        type=int,
+    )
+    parser.add_argument(
+        "--settle",
+        default=SETTLE,
+        help=f"Seconds a folder must go unchanged before it's built (Default: {SETTLE})",
+        type=float,
+    )
+    parser.add_argument(
+        "--poll",
+        default=POLL,
+        help=f"Seconds between rescans when inotify isn't available (Default: {POLL})",
+        type=float,
+    )
+    parser.add_argument(
+        "--tag",
+        default=False,
+        help="Look up metadata for books laid out as Author/Title",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep",
+        default=False,
+        help="Keep the audio files after processing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        help="Keep the encoded audio in a build folder next to the input files, so "
+        "a re-run only encodes what changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--once",
+        default=False,
+        help="Build the books that are there now and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        help="Write how long each step took to this file, as JSON lines or as a "
+        "Chrome trace if it ends in .json",
+    )
+
+    args = parser.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+
+    try:
+        watch(
+            args.input,
+            os.path.abspath(args.state),
+            args.encode_slots,
+            args.io_slots,
+            args.settle,
+            args.poll,
+            args.tag,
+            args.keep,
+            args.once,
+            args.incremental,
+        )
+    except KeyboardInterrupt:
+        print("\nStopped, unfinished jobs will resume on the next start")
+
+
+if __name__ == "__main__":
+    main()